@@ -0,0 +1,234 @@
+"""
+Local result cache for the Sparkify analytical queries.
+
+Results are stored in a SQLite file keyed by a hash of the query text and its
+parameters. Entries expire after a TTL, the least recently used ones are
+evicted when the cache grows past its limits, and everything is invalidated
+when a new load version is recorded: by etl.py before its first write and
+again once the load finished, and by create_tables.py before it drops the
+tables.
+"""
+import hashlib
+import json
+import pickle
+import sqlite3
+import time
+from contextlib import closing
+
+
+CREATE_RESULTS_TABLE = """
+    CREATE TABLE IF NOT EXISTS results (
+        cache_key TEXT PRIMARY KEY,
+        query_name TEXT,
+        load_version TEXT,
+        created_at REAL NOT NULL,
+        last_access REAL NOT NULL,
+        size INTEGER NOT NULL,
+        payload BLOB NOT NULL
+    )
+"""
+
+CREATE_LOAD_VERSION_TABLE = """
+    CREATE TABLE IF NOT EXISTS load_version (
+        id INTEGER PRIMARY KEY CHECK (id = 1),
+        version TEXT NOT NULL,
+        recorded_at REAL NOT NULL
+    )
+"""
+
+
+def get_cache_key(query, params=None):
+    """
+    Build the cache key of a query and its parameters.
+
+    Args:
+        query: SQL query text
+        params: Query parameters (must be JSON serializable)
+
+    Returns:
+        str: SHA-256 hex digest
+    """
+    payload = json.dumps({"query": query, "params": params}, sort_keys=True, default=str)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class QueryResultCache:
+    """
+    SQLite-backed cache of query results with TTL, LRU/size eviction and
+    load-version invalidation.
+    """
+
+    def __init__(self, path, ttl=3600, max_entries=256, max_bytes=64 * 1024 * 1024):
+        """
+        Args:
+            path: SQLite file used to store the cache
+            ttl: Seconds an entry stays valid
+            max_entries: Maximum number of cached results
+            max_bytes: Maximum total size of the cached results
+        """
+        self.path = path
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+
+        with closing(self._connect()) as db, db:
+            db.execute(CREATE_RESULTS_TABLE)
+            db.execute(CREATE_LOAD_VERSION_TABLE)
+
+    def _connect(self):
+        """
+        Open a connection to the cache file (one per operation, so threads can share the cache).
+        """
+        return sqlite3.connect(self.path, timeout=30)
+
+    def get_load_version(self):
+        """
+        Return the load version the cached results belong to.
+
+        Returns:
+            str: Last version recorded by etl.py, or None
+        """
+        with closing(self._connect()) as db:
+            row = db.execute("SELECT version FROM load_version WHERE id = 1").fetchone()
+        return row[0] if row else None
+
+    def set_load_version(self, version):
+        """
+        Record a new load version and drop every result computed before it.
+
+        Args:
+            version: Identifier of the load that just finished
+
+        Returns:
+            bool: True if the version changed and the cache was invalidated
+        """
+        with closing(self._connect()) as db, db:
+            row = db.execute("SELECT version FROM load_version WHERE id = 1").fetchone()
+            if row and row[0] == version:
+                return False
+
+            db.execute(
+                "INSERT OR REPLACE INTO load_version (id, version, recorded_at) VALUES (1, ?, ?)",
+                (version, time.time())
+            )
+            deleted = db.execute("DELETE FROM results").rowcount
+
+        print(f"Analytics cache invalidated for load version {version} ({deleted} entries removed)")
+        return True
+
+    def get(self, query, params=None):
+        """
+        Look up a cached result.
+
+        Args:
+            query: SQL query text
+            params: Query parameters
+
+        Returns:
+            The cached value, or None on a miss or an expired entry
+        """
+        key = get_cache_key(query, params)
+        now = time.time()
+
+        with closing(self._connect()) as db, db:
+            row = db.execute(
+                """
+                SELECT r.payload
+                FROM results r
+                LEFT JOIN load_version v ON v.id = 1
+                WHERE r.cache_key = ?
+                AND r.created_at > ?
+                AND r.load_version IS v.version
+                """,
+                (key, now - self.ttl)
+            ).fetchone()
+
+            if row is None:
+                return None
+
+            db.execute("UPDATE results SET last_access = ? WHERE cache_key = ?", (now, key))
+
+        return pickle.loads(row[0])
+
+    def put(self, query, value, params=None, query_name=None):
+        """
+        Store a result and evict old entries if the cache is over its limits.
+
+        Args:
+            query: SQL query text
+            value: Result to cache (must be picklable)
+            params: Query parameters
+            query_name: Descriptive name kept for inspection
+        """
+        payload = pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+        if len(payload) > self.max_bytes:
+            return
+
+        now = time.time()
+
+        with closing(self._connect()) as db, db:
+            db.execute(
+                """
+                INSERT OR REPLACE INTO results
+                    (cache_key, query_name, load_version, created_at, last_access, size, payload)
+                VALUES (?, ?, (SELECT version FROM load_version WHERE id = 1), ?, ?, ?, ?)
+                """,
+                (get_cache_key(query, params), query_name, now, now, len(payload), payload)
+            )
+            db.execute("DELETE FROM results WHERE created_at <= ?", (now - self.ttl,))
+            self._evict(db)
+
+    def _evict(self, db):
+        """
+        Remove least recently used entries until the cache fits its limits.
+        """
+        count, total_size = db.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM results").fetchone()
+
+        rows = db.execute("SELECT cache_key, size FROM results ORDER BY last_access").fetchall()
+        for key, size in rows:
+            if count <= self.max_entries and total_size <= self.max_bytes:
+                break
+            db.execute("DELETE FROM results WHERE cache_key = ?", (key,))
+            count -= 1
+            total_size -= size
+
+    def clear(self):
+        """
+        Remove every cached result.
+        """
+        with closing(self._connect()) as db, db:
+            db.execute("DELETE FROM results")
+
+
+def get_result_cache(config):
+    """
+    Create the analytics result cache from the [CACHE] section of dwh.cfg.
+
+    Args:
+        config: Configuration parser
+
+    Returns:
+        QueryResultCache: The cache, or None when caching is disabled
+    """
+    if not config.getboolean('CACHE', 'ENABLED', fallback=False):
+        return None
+
+    return QueryResultCache(
+        config.get('CACHE', 'PATH', fallback='.analytics_cache.sqlite'),
+        ttl=config.getfloat('CACHE', 'TTL', fallback=3600),
+        max_entries=config.getint('CACHE', 'MAX_ENTRIES', fallback=256),
+        max_bytes=config.getint('CACHE', 'MAX_BYTES', fallback=64 * 1024 * 1024)
+    )
+
+
+def record_load_version(config, load_version):
+    """
+    Invalidate the cached results when the warehouse changes (or is about to).
+
+    Args:
+        config: Configuration parser with the [CACHE] settings
+        load_version: Identifier of the load, or None if nothing was loaded
+    """
+    cache = get_result_cache(config)
+    if cache is not None and load_version is not None:
+        cache.set_load_version(load_version)
@@ -0,0 +1,183 @@
+"""
+Date-partitioned backfills of log_data for the Sparkify Data Warehouse.
+
+log_data is laid out as log_data/<year>/<month>/<year>-<month>-<day>-events.json
+(see generate_data.py), so a day or a month of events can be copied from its
+own S3 prefix. A backfill splits a date range into partitions, copies their
+files with a single manifest COPY (Redshift serializes COPY statements into
+the same table) and tracks the outcome of every partition in
+etl_log_partitions:
+
+    empty    no file under the partition's prefix
+    copied   the partition is in staging_events
+    failed   the COPY failed
+    loaded   its songplays were rebuilt
+
+Partitions are assumed to hold the events of their own UTC dates, which is
+what lets their songplays be replaced by start_time range.
+"""
+from datetime import date, datetime, timedelta
+from incremental import list_s3_files
+from sql_queries import (
+    log_partitions_table_create,
+    select_loaded_partitions,
+    delete_log_partition,
+    insert_log_partition
+)
+
+
+# S3 key prefix of a partition under [S3] LOG_DATA, per granularity
+PARTITION_PREFIXES = {
+    "day": "{:%Y/%m/%Y-%m-%d}",
+    "month": "{:%Y/%m/}"
+}
+
+
+def parse_date(value):
+    """
+    Parse a YYYY-MM-DD date.
+    """
+    return datetime.strptime(value, "%Y-%m-%d").date()
+
+
+def iter_partitions(start, end, granularity="day"):
+    """
+    Split an inclusive date range into day or month partitions.
+
+    Month partitions cover whole months, including days of the first and last
+    month that fall outside the range.
+
+    Args:
+        start: First date of the range
+        end: Last date of the range
+        granularity: "day" or "month"
+
+    Returns:
+        list: (partition key, first day, first day after the partition) tuples
+    """
+    if granularity not in PARTITION_PREFIXES:
+        raise ValueError(f"Unknown partition granularity '{granularity}', expected one of {', '.join(PARTITION_PREFIXES)}")
+    if end < start:
+        raise ValueError(f"Backfill range ends ({end}) before it starts ({start})")
+
+    partitions = []
+    if granularity == "day":
+        day = start
+        while day <= end:
+            partitions.append((f"{day:%Y-%m-%d}", day, day + timedelta(days=1)))
+            day += timedelta(days=1)
+    else:
+        month = date(start.year, start.month, 1)
+        while month <= end:
+            next_month = date(month.year + month.month // 12, month.month % 12 + 1, 1)
+            partitions.append((f"{month:%Y-%m}", month, next_month))
+            month = next_month
+
+    return partitions
+
+
+def get_partition_prefix(log_data, first_day, granularity="day"):
+    """
+    Return the S3 prefix holding the log files of a partition.
+
+    Args:
+        log_data: s3:// URL of log_data ([S3] LOG_DATA)
+        first_day: First day of the partition
+        granularity: "day" or "month"
+
+    Returns:
+        str: s3:// URL prefix
+    """
+    return f"{log_data.rstrip('/')}/{PARTITION_PREFIXES[granularity].format(first_day)}"
+
+
+def merge_ranges(ranges):
+    """
+    Merge overlapping or adjacent [first day, end) ranges.
+    """
+    merged = []
+    for start, end in sorted(ranges):
+        if merged and start <= merged[-1][1]:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+        else:
+            merged.append((start, end))
+    return merged
+
+
+def build_range_filter(column, ranges, epoch_millis=False):
+    """
+    Build a SQL condition matching any of a list of date ranges.
+
+    Args:
+        column: Column compared with the ranges
+        ranges: (first day, first day after the range) tuples
+        epoch_millis: Whether the column holds epoch milliseconds (e.g. staging_events.ts)
+            rather than a timestamp
+
+    Returns:
+        str: Condition in parentheses, FALSE when there is no range
+    """
+    conditions = []
+    for start, end in merge_ranges(ranges):
+        if epoch_millis:
+            lower, upper = ((day - date(1970, 1, 1)).days * 86400000 for day in (start, end))
+        else:
+            lower, upper = f"TIMESTAMP '{start:%Y-%m-%d}'", f"TIMESTAMP '{end:%Y-%m-%d}'"
+        conditions.append(f"({column} >= {lower} AND {column} < {upper})")
+
+    return f"({' OR '.join(conditions)})" if conditions else "FALSE"
+
+
+def find_partition_files(s3, partitions, log_data, granularity="day"):
+    """
+    List the log files of each partition.
+
+    Args:
+        s3: S3 client
+        partitions: Output of iter_partitions
+        log_data: s3:// URL of log_data
+        granularity: "day" or "month"
+
+    Returns:
+        dict: Mapping of partition key to (prefix, list of s3:// URLs)
+    """
+    files = {}
+    for key, first_day, _ in partitions:
+        prefix = get_partition_prefix(log_data, first_day, granularity)
+        files[key] = (prefix, list_s3_files(s3, prefix))
+    return files
+
+
+def get_loaded_partitions(cur, conn):
+    """
+    Return the keys of the partitions whose songplays were already rebuilt.
+
+    Args:
+        cur: Database cursor
+        conn: Database connection
+
+    Returns:
+        set: Partition keys with status "loaded"
+    """
+    cur.execute(log_partitions_table_create)
+    cur.execute(select_loaded_partitions)
+    loaded = {row[0] for row in cur.fetchall()}
+    conn.commit()
+    return loaded
+
+
+def record_partition(cur, conn, key, prefix, status):
+    """
+    Set the status of a partition in etl_log_partitions.
+
+    Args:
+        cur: Database cursor
+        conn: Database connection
+        key: Partition key
+        prefix: S3 prefix of the partition
+        status: "empty", "copied", "failed" or "loaded"
+    """
+    cur.execute(delete_log_partition, (key,))
+    cur.execute(insert_log_partition, (key, prefix, status))
+    if getattr(conn, 'transaction_batch', None) is None:
+        conn.commit()
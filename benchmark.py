@@ -0,0 +1,188 @@
+"""
+End-to-end benchmark of the Sparkify pipeline at several data volumes.
+
+For each scale factor, a synthetic dataset is generated (see generate_data.py)
+and every stage of the existing scripts is run against it:
+
+    setup      drop_tables / create_tables (create_tables.py)
+    staging    local load of staging_events / staging_songs (local_ingest.py)
+    inserts    insert_tables (etl.py)
+    analytics  every query in analytics_queries (run_analytics.py)
+
+The per-statement timings returned by execute_query, with the row counts
+they produced, are appended as JSON lines to the output file so throughput
+(rows/sec) can be tracked across changes.
+
+Usage:
+    python benchmark.py --scales 1 10 100 --output benchmark_results.jsonl
+"""
+import argparse
+import json
+import os
+import time
+import uuid
+from datetime import datetime, timezone
+from create_tables import create_tables, drop_tables
+from dialects import get_dialect
+from etl import build_song_match_keys, insert_tables
+from generate_data import JSONPATH_FILE, generate_dataset
+from local_ingest import load_staging_tables_local
+from run_analytics import fetch_analytics_result
+from sql_queries import analytics_queries
+from utils import get_config, get_git_commit, get_connection_pool, close_connection_pool
+
+
+def count_rows(cur, conn, table):
+    """
+    Return the number of rows of a table.
+    """
+    cur.execute(f"SELECT COUNT(*) FROM {table}")
+    rows = cur.fetchone()[0]
+    conn.commit()
+    return rows
+
+
+def make_record(context, stage, step, seconds, rows=None):
+    """
+    Build one benchmark result record.
+    """
+    return {
+        **context,
+        "stage": stage,
+        "step": step,
+        "seconds": round(seconds, 4),
+        "rows": rows,
+        "rows_per_sec": round(rows / seconds, 1) if rows and seconds else None
+    }
+
+
+def benchmark_scale(cur, conn, config, data_dir, context):
+    """
+    Run every pipeline stage on one dataset.
+
+    Args:
+        cur: Database cursor
+        conn: Database connection
+        config: Configuration parser; its [LOCAL] paths are pointed at data_dir
+        data_dir: Directory holding song_data/ and log_data/
+        context: Fields shared by every record (run id, scale, ...)
+
+    Returns:
+        list: Benchmark records
+    """
+    records = []
+
+    # Setup
+    for table, seconds in drop_tables(cur, conn).items():
+        records.append(make_record(context, "setup", f"drop {table}", seconds))
+    for table, seconds in create_tables(cur, conn).items():
+        records.append(make_record(context, "setup", f"create {table}", seconds))
+
+    # Staging
+    if not config.has_section('LOCAL'):
+        config.add_section('LOCAL')
+    config.set('LOCAL', 'LOG_DATA', os.path.join(data_dir, "log_data"))
+    config.set('LOCAL', 'SONG_DATA', os.path.join(data_dir, "song_data"))
+    jsonpath = os.path.join(data_dir, JSONPATH_FILE)
+    config.set('LOCAL', 'LOG_JSONPATH', jsonpath if os.path.exists(jsonpath) else '')
+
+    for table, stats in load_staging_tables_local(cur, conn, config).items():
+        records.append(make_record(context, "staging", table, stats["seconds"], stats["rows"]))
+
+    start_time = time.time()
+    build_song_match_keys(cur, conn)
+    records.append(make_record(context, "staging", "song match keys", time.time() - start_time))
+
+    # Inserts
+    for table, seconds in insert_tables(cur, conn).items():
+        records.append(make_record(context, "inserts", table, seconds, count_rows(cur, conn, table)))
+
+    # Analytics
+    for query_name, query in analytics_queries.items():
+        start_time = time.time()
+        _, rows = fetch_analytics_result(conn, cur, query_name, query)
+        records.append(make_record(context, "analytics", query_name, time.time() - start_time, len(rows)))
+
+    return records
+
+
+def print_summary(records):
+    """
+    Print the time and throughput of each step.
+    """
+    print("\n" + "=" * 80)
+    print("BENCHMARK SUMMARY")
+    print("=" * 80)
+    print(f"{'Scale':>8}  {'Stage':<10} {'Step':<40} {'Seconds':>10} {'Rows':>12} {'Rows/sec':>12}")
+    for record in records:
+        rows = record["rows"] if record["rows"] is not None else ""
+        rate = f"{record['rows_per_sec']:,.0f}" if record["rows_per_sec"] else ""
+        print(f"{record['scale']:>8g}  {record['stage']:<10} {record['step'][:40]:<40} "
+              f"{record['seconds']:>10.2f} {rows:>12} {rate:>12}")
+
+
+def run_benchmark(scales, data_dir="data", output="benchmark_results.jsonl", seed=42):
+    """
+    Benchmark the pipeline at each scale factor and append the results to a JSON lines file.
+
+    Args:
+        scales: Scale factors to run (e.g. [1, 10, 100])
+        data_dir: Directory where the datasets are generated (reused if present)
+        output: JSON lines file receiving the results
+        seed: Random seed of the generated datasets
+
+    Returns:
+        list: Benchmark records
+    """
+    config = get_config()
+    run_id = uuid.uuid4().hex[:12]
+    base_context = {
+        "run_id": run_id,
+        "recorded_at": datetime.now(timezone.utc).isoformat(),
+        "git_commit": get_git_commit(),
+        "dialect": get_dialect(config)
+    }
+
+    print("\n" + "=" * 80)
+    print(f"SPARKIFY BENCHMARK {run_id}")
+    print("=" * 80)
+
+    records = []
+
+    try:
+        with get_connection_pool(config).connection() as (conn, cur):
+            for scale in scales:
+                scale_dir = os.path.join(data_dir, f"scale_{scale:g}")
+                if not os.path.isdir(os.path.join(scale_dir, "log_data")):
+                    generate_dataset(scale_dir, scale, seed)
+
+                print(f"\nRunning benchmark at scale {scale:g}...")
+                context = {**base_context, "scale": scale}
+                scale_records = benchmark_scale(cur, conn, config, scale_dir, context)
+                records.extend(scale_records)
+
+                with open(output, "a") as f:
+                    for record in scale_records:
+                        f.write(json.dumps(record) + "\n")
+    finally:
+        close_connection_pool()
+
+    print_summary(records)
+    print(f"\nResults appended to {output}")
+
+    return records
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the Sparkify pipeline at several data volumes")
+    parser.add_argument("--scales", type=float, nargs="+", default=[1, 10, 100], help="Scale factors to run")
+    parser.add_argument("--data-dir", default="data", help="Directory of the generated datasets")
+    parser.add_argument("--output", default="benchmark_results.jsonl", help="JSON lines file for the results")
+    parser.add_argument("--seed", type=int, default=42, help="Random seed of the generated datasets")
+    args = parser.parse_args()
+
+    run_benchmark(args.scales, args.data_dir, args.output, args.seed)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,175 @@
+"""
+Checkpoints for resumable full loads of the Sparkify Data Warehouse.
+
+Each step of a full load (one COPY, the keyed staging copies, one insert,
+the aggregate refresh) is recorded in etl_checkpoints together with a
+fingerprint of the input files and of the SQL it ran. The checkpoint is
+written in the same transaction as the step (see etl.run_checkpointed_step
+and utils.transaction), so both commit or roll back together and a resumed
+run never repeats a step that committed.
+
+A run started with etl.py --resume skips the steps whose checkpoint matches
+the current inputs and SQL and continues from the first incomplete one.
+Once a step runs again, every step that depends on it runs too. Any other
+run clears the checkpoints before it starts.
+
+The input fingerprint hashes the key, size and ETag of every S3 object under
+[S3] LOG_DATA and SONG_DATA, or the path, size and modification time of every
+file under [LOCAL] LOG_DATA and SONG_DATA.
+"""
+import hashlib
+import os
+from incremental import create_s3_client, parse_s3_url
+from local_ingest import find_json_files
+from sql_queries import (
+    checkpoints_table_create,
+    checkpoints_clear,
+    select_checkpoints,
+    delete_checkpoint,
+    insert_checkpoint
+)
+
+
+def fingerprint_s3_prefix(s3, url):
+    """
+    Hash the key, size and ETag of every object under an S3 prefix.
+
+    Args:
+        s3: S3 client
+        url: s3://bucket/prefix to list
+
+    Returns:
+        str: Hex digest
+    """
+    bucket, prefix = parse_s3_url(url)
+    paginator = s3.get_paginator('list_objects_v2')
+
+    digest = hashlib.sha256()
+    for page in paginator.paginate(Bucket=bucket, Prefix=prefix):
+        for obj in page.get('Contents', []):
+            digest.update(f"{obj['Key']}\t{obj['Size']}\t{obj['ETag']}\n".encode())
+
+    return digest.hexdigest()
+
+
+def fingerprint_local_directory(directory):
+    """
+    Hash the relative path, size and modification time of every JSON file in a directory.
+
+    Args:
+        directory: Root directory (e.g. data/log_data)
+
+    Returns:
+        str: Hex digest
+    """
+    digest = hashlib.sha256()
+    for path in find_json_files(directory):
+        stat = os.stat(path)
+        digest.update(f"{os.path.relpath(path, directory)}\t{stat.st_size}\t{stat.st_mtime_ns}\n".encode())
+
+    return digest.hexdigest()
+
+
+def get_input_fingerprint(config):
+    """
+    Fingerprint the song and log files a full load would read.
+
+    Args:
+        config: Configuration parser with the [ETL] SOURCE and its paths
+
+    Returns:
+        str: Hex digest of the inputs
+    """
+    if config.get('ETL', 'SOURCE', fallback='s3').lower() == 'local':
+        parts = [
+            fingerprint_local_directory(config.get('LOCAL', 'LOG_DATA')),
+            fingerprint_local_directory(config.get('LOCAL', 'SONG_DATA'))
+        ]
+    else:
+        s3 = create_s3_client()
+        parts = [
+            fingerprint_s3_prefix(s3, config.get('S3', 'LOG_DATA')),
+            fingerprint_s3_prefix(s3, config.get('S3', 'SONG_DATA'))
+        ]
+
+    return hashlib.sha256("\n".join(parts).encode()).hexdigest()
+
+
+class CheckpointStore:
+    """
+    Completed steps of a full load, kept in the etl_checkpoints table.
+    """
+
+    def __init__(self, fingerprint, resume=False):
+        """
+        Args:
+            fingerprint: Fingerprint of the inputs of this run
+            resume: Skip the steps completed by a previous run on the same inputs
+        """
+        self.fingerprint = fingerprint
+        self.resume = resume
+        self.completed = {}
+
+    def load(self, cur, conn):
+        """
+        Create the checkpoint table and read the completed steps, or clear them when not resuming.
+
+        Args:
+            cur: Database cursor
+            conn: Database connection
+        """
+        cur.execute(checkpoints_table_create)
+        if self.resume:
+            cur.execute(select_checkpoints)
+            self.completed = dict(cur.fetchall())
+        else:
+            cur.execute(checkpoints_clear)
+        conn.commit()
+
+        if self.resume:
+            print(f"Resuming: {len(self.completed)} checkpointed step(s) found")
+
+    def step_fingerprint(self, query):
+        """
+        Combine the input fingerprint with the SQL of a step.
+        """
+        return hashlib.sha256(f"{self.fingerprint}\n{query}".encode()).hexdigest()
+
+    def is_done(self, step, query):
+        """
+        Check whether a step can be skipped.
+
+        Args:
+            step: Step name
+            query: SQL the step would run
+
+        Returns:
+            bool: True if resuming and the step completed on the same inputs and SQL
+        """
+        return self.resume and self.completed.get(step) == self.step_fingerprint(query)
+
+    def stop_resuming(self):
+        """
+        Run every remaining step, e.g. once a step they depend on ran again.
+        """
+        self.resume = False
+
+    def mark_done(self, cur, conn, step, query):
+        """
+        Record that a step completed.
+
+        The checkpoint is committed right away unless a transaction is open
+        on the connection, in which case it commits with the step it records.
+
+        Args:
+            cur: Cursor of the connection that ran the step
+            conn: Connection that ran the step
+            step: Step name
+            query: SQL the step ran
+        """
+        fingerprint = self.step_fingerprint(query)
+        cur.execute(delete_checkpoint, (step,))
+        cur.execute(insert_checkpoint, (step, fingerprint))
+        if getattr(conn, 'transaction_batch', None) is None:
+            conn.commit()
+        self.completed[step] = fingerprint
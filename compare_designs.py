@@ -0,0 +1,221 @@
+"""
+A/B comparison of two table-design profiles (see table_designs.py).
+
+For each profile, every table is dropped and recreated with the profile's
+design, the same data is loaded through the ETL's staging and insert stages,
+and the analytical queries are run several times. The harness then compares:
+
+    load       seconds of the staging and insert stages
+    storage    size of each table (SVV_TABLE_INFO on Redshift, pg_total_relation_size on PostgreSQL)
+    analytics  median latency of each query over the repeated runs
+
+Staging uses the [ETL] SOURCE of dwh.cfg (S3 on Redshift). With --data-dir,
+the staging tables are loaded from a local dataset instead (e.g. one written
+by generate_data.py).
+
+Usage:
+    python compare_designs.py baseline dimensions_all --repeats 5
+"""
+import argparse
+import json
+import os
+import statistics
+import time
+import metrics
+from create_tables import create_tables, drop_tables
+from dialects import POSTGRES, get_dialect
+from etl import run_insert_stage, run_staging_stage
+from generate_data import JSONPATH_FILE
+from run_analytics import fetch_analytics_result
+from sql_queries import analytics_queries
+from table_designs import get_profile
+from utils import get_config, get_git_commit, get_connection_pool, close_connection_pool
+
+
+DESIGN_TABLES = ("staging_events", "staging_songs", "songplays", "users", "songs", "artists", "time")
+
+# Size of each table in MB, per dialect
+TABLE_SIZE_QUERIES = {
+    "redshift": """
+        SELECT "table", size
+        FROM svv_table_info
+        WHERE "table" IN %s
+    """,
+    POSTGRES: """
+        SELECT relname, pg_total_relation_size(relid) / 1048576.0
+        FROM pg_stat_user_tables
+        WHERE relname IN %s
+    """
+}
+
+
+def get_table_sizes(cur, conn, dialect):
+    """
+    Return the storage size of each table in MB.
+    """
+    cur.execute(TABLE_SIZE_QUERIES[dialect], (DESIGN_TABLES,))
+    sizes = {table: float(size) for table, size in cur.fetchall()}
+    conn.commit()
+    return sizes
+
+
+def get_stage_seconds(records, stage):
+    """
+    Sum the seconds of the statements recorded for a stage.
+    """
+    return sum(record["seconds"] for record in records if record["stage"] == stage)
+
+
+def run_profile(cur, conn, config, profile_name, repeats):
+    """
+    Rebuild the tables with a profile, load them and time the analytical queries.
+
+    Args:
+        cur: Database cursor
+        conn: Database connection
+        config: Configuration parser
+        profile_name: Table-design profile to apply
+        repeats: Number of runs of each analytical query
+
+    Returns:
+        dict: load seconds per stage, table sizes and median latency per query
+    """
+    print("\n" + "=" * 80)
+    print(f"TABLE-DESIGN PROFILE: {profile_name}")
+    print("=" * 80)
+
+    metrics.clear()
+
+    metrics.set_stage("setup")
+    drop_tables(cur, conn)
+    create_tables(cur, conn, get_profile(profile_name))
+
+    run_staging_stage(cur, conn, config)
+    run_insert_stage(cur, conn, config)
+
+    metrics.set_stage("analytics")
+    for _ in range(repeats):
+        for query_name, query in analytics_queries.items():
+            fetch_analytics_result(conn, cur, query_name, query)
+
+    records = metrics.get_records()
+    latencies = {
+        query_name: statistics.median(
+            record["seconds"] for record in records
+            if record["stage"] == "analytics" and record["statement"] == query_name
+        )
+        for query_name in analytics_queries
+    }
+
+    return {
+        "load": {stage: get_stage_seconds(records, stage) for stage in ("staging", "inserts")},
+        "storage": get_table_sizes(cur, conn, get_dialect(config)),
+        "analytics": latencies
+    }
+
+
+def format_change(a, b):
+    """
+    Format the relative change from a to b.
+    """
+    return f"{b / a - 1:+.0%}" if a else "-"
+
+
+def print_comparison(names, results):
+    """
+    Print the load time, storage and analytics latency of two profiles side by side.
+    """
+    a, b = (results[name] for name in names)
+
+    print("\n" + "=" * 80)
+    print(f"TABLE-DESIGN COMPARISON: {names[0]} vs {names[1]}")
+    print("=" * 80)
+    print(f"{'Metric':<44} {names[0][:14]:>14} {names[1][:14]:>14} {'Change':>8}")
+
+    sections = [
+        ("load", "Load (s)", "{:.2f}"),
+        ("storage", "Storage (MB)", "{:.1f}"),
+        ("analytics", "Analytics median latency (s)", "{:.3f}")
+    ]
+    for key, title, value_format in sections:
+        print(f"\n{title}")
+        names_in_section = list(a[key]) + [name for name in b[key] if name not in a[key]]
+        for name in names_in_section:
+            value_a, value_b = a[key].get(name, 0.0), b[key].get(name, 0.0)
+            print(f"  {name[:42]:<42} {value_format.format(value_a):>14} "
+                  f"{value_format.format(value_b):>14} {format_change(value_a, value_b):>8}")
+
+        total_a, total_b = sum(a[key].values()), sum(b[key].values())
+        print(f"  {'Total':<42} {value_format.format(total_a):>14} "
+              f"{value_format.format(total_b):>14} {format_change(total_a, total_b):>8}")
+
+
+def compare_designs(profiles, repeats=3, data_dir=None, output=None):
+    """
+    Load the same data under two table-design profiles and compare them.
+
+    Args:
+        profiles: Names of the two profiles to compare
+        repeats: Number of runs of each analytical query per profile
+        data_dir: Local dataset with song_data/ and log_data/ (None to use [ETL] SOURCE)
+        output: JSON lines file receiving the results (optional)
+
+    Returns:
+        dict: Results per profile
+    """
+    for name in profiles:
+        get_profile(name)
+
+    config = get_config()
+    metrics.configure(config)
+
+    if data_dir:
+        for section in ('ETL', 'LOCAL'):
+            if not config.has_section(section):
+                config.add_section(section)
+        config.set('ETL', 'SOURCE', 'local')
+        config.set('LOCAL', 'LOG_DATA', os.path.join(data_dir, "log_data"))
+        config.set('LOCAL', 'SONG_DATA', os.path.join(data_dir, "song_data"))
+        jsonpath = os.path.join(data_dir, JSONPATH_FILE)
+        config.set('LOCAL', 'LOG_JSONPATH', jsonpath if os.path.exists(jsonpath) else '')
+
+    results = {}
+
+    try:
+        with get_connection_pool(config).connection() as (conn, cur):
+            for name in profiles:
+                results[name] = run_profile(cur, conn, config, name, repeats)
+    finally:
+        close_connection_pool()
+
+    print_comparison(profiles, results)
+
+    if output:
+        recorded_at = time.time()
+        with open(output, "a") as f:
+            for name, result in results.items():
+                f.write(json.dumps({
+                    "recorded_at": recorded_at,
+                    "git_commit": get_git_commit(),
+                    "dialect": get_dialect(config),
+                    "profile": name,
+                    **result
+                }) + "\n")
+        print(f"\nResults appended to {output}")
+
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare two table-design profiles on the same data")
+    parser.add_argument("profiles", nargs=2, help="Names of the two profiles (see table_designs.py)")
+    parser.add_argument("--repeats", type=int, default=3, help="Runs of each analytical query per profile")
+    parser.add_argument("--data-dir", help="Local dataset to load instead of the configured source")
+    parser.add_argument("--output", help="JSON lines file for the results")
+    args = parser.parse_args()
+
+    compare_designs(args.profiles, args.repeats, args.data_dir, args.output)
+
+
+if __name__ == "__main__":
+    main()
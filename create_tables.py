@@ -1,8 +1,14 @@
 import time
+import metrics
+from analytics_cache import record_load_version
 from sql_queries import create_table_queries, drop_table_queries
+from table_designs import apply_table_design, get_table_design
 from utils import (
-    connect_to_redshift,
-    execute_query
+    get_config,
+    get_connection_pool,
+    close_connection_pool,
+    execute_query,
+    transaction
 )
 
 
@@ -13,29 +19,42 @@ def drop_tables(cur, conn):
     Parameters:
         cur: cursor for executing SQL commands
         conn: database connection
+        
+    Returns:
+        dict: execution time in seconds per table
     """
     print("Dropping existing tables...")
     
+    timings = {}
     for i, query in enumerate(drop_table_queries, 1):
         table_name = query.split("DROP TABLE")[1].split(";")[0].strip() if "DROP TABLE" in query else f"Table {i}"
         print(f"  Dropping {table_name}...")
-        execute_query(cur, conn, query, f"Dropping {table_name}")
+        timings[table_name] = execute_query(cur, conn, query, f"Dropping {table_name}")
+    
+    return timings
 
 
-def create_tables(cur, conn):
+def create_tables(cur, conn, profile=None):
     """
     Creates all tables defined in create_table_queries.
     
     Parameters:
         cur: cursor for executing SQL commands
         conn: database connection
+        profile: table-design profile (table name -> design) applied to the DDL
+        
+    Returns:
+        dict: execution time in seconds per table
     """
     print("\nCreating tables...")
     
+    timings = {}
     for i, query in enumerate(create_table_queries, 1):
         table_name = query.split("CREATE TABLE")[1].split("(")[0].strip() if "CREATE TABLE" in query else f"Table {i}"
         print(f"  Creating {table_name}...")
-        execute_query(cur, conn, query, f"Creating {table_name}")
+        timings[table_name] = execute_query(cur, conn, apply_table_design(query, profile or {}), f"Creating {table_name}")
+    
+    return timings
 
 
 def run_setup():
@@ -48,16 +67,22 @@ def run_setup():
     
     start_time = time.time()
     
-    conn = None
-    cur = None
+    config = get_config()
+    metrics.configure(config)
+    metrics.set_stage("setup")
+    profile_name, profile = get_table_design(config)
+    print(f"Table-design profile: {profile_name}")
     
     try:
-        # Connect to the database
-        conn, cur = connect_to_redshift()
+        # Cached analytics results describe tables that are about to be dropped
+        record_load_version(config, f"setup-{metrics.get_run_id()}")
         
-        # Execute database operations
-        drop_tables(cur, conn)
-        create_tables(cur, conn)
+        # Borrow a connection from the shared pool
+        with get_connection_pool(config).connection() as (conn, cur):
+            # Execute database operations, as one transaction with [ETL] BATCH_TRANSACTIONS
+            with transaction(conn, "setup", config.getboolean('ETL', 'BATCH_TRANSACTIONS', fallback=False)):
+                drop_tables(cur, conn)
+                create_tables(cur, conn, profile)
         
         # Calculate and display total time
         elapsed_time = time.time() - start_time
@@ -67,12 +92,12 @@ def run_setup():
         print(f"Error during table setup: {e}")
         raise
     finally:
-        # Close connections directly
-        if cur:
-            cur.close()
-        if conn:
-            conn.close()
+        # Close pooled connections
+        close_connection_pool()
         print("Database connection closed.")
+        
+        # Export per-statement metrics
+        metrics.export(config)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,170 @@
+"""
+SQL dialect support for the Sparkify Data Warehouse.
+
+sql_queries.py is written for Redshift. The PostgreSQL dialect translates
+those statements at execution time so that create_tables.py, etl.py and
+run_analytics.py can run against a local PostgreSQL database:
+
+- IDENTITY(seed, step) becomes a standard identity column
+- DISTKEY / DISTSTYLE / ENCODE clauses are dropped and SORTKEY columns become indexes
+- Redshift-only functions and settings are mapped to their PostgreSQL equivalents
+- COPY ... FROM 's3://...' is replaced by a local-file load (see local_ingest)
+"""
+import re
+import psycopg2.extensions
+from psycopg2 import sql
+from local_ingest import copy_s3_query_locally
+
+
+REDSHIFT = 'redshift'
+POSTGRES = 'postgres'
+DIALECTS = (REDSHIFT, POSTGRES)
+
+CREATE_TABLE_PATTERN = re.compile(
+    r"CREATE\s+(?:TEMP\s+|TEMPORARY\s+)?TABLE\s+(?:IF\s+NOT\s+EXISTS\s+)?(\w+)", re.IGNORECASE
+)
+S3_COPY_PATTERN = re.compile(r"^\s*COPY\s+\w+.*?\bFROM\s+'s3://", re.IGNORECASE | re.DOTALL)
+
+# (pattern, replacement) pairs applied to every statement in the PostgreSQL dialect
+POSTGRES_REWRITES = [
+    (re.compile(r"\bIDENTITY\s*\(\s*(\d+)\s*,\s*(\d+)\s*\)", re.IGNORECASE),
+     r"GENERATED BY DEFAULT AS IDENTITY (START WITH \1 INCREMENT BY \2 MINVALUE \1)"),
+    (re.compile(r"\s*\b(?:COMPOUND\s+|INTERLEAVED\s+)?SORTKEY\s*\([^)]*\)", re.IGNORECASE), ""),
+    (re.compile(r"\s*\bDISTKEY\s*\([^)]*\)", re.IGNORECASE), ""),
+    (re.compile(r"\s*\bDISTSTYLE\s+\w+", re.IGNORECASE), ""),
+    (re.compile(r"\s+\b(?:SORTKEY|DISTKEY)\b", re.IGNORECASE), ""),
+    (re.compile(r"\s+\bENCODE\s+\w+", re.IGNORECASE), ""),
+    (re.compile(r"\bGETDATE\s*\(\s*\)", re.IGNORECASE), "NOW()"),
+    (re.compile(r"\bEXTRACT\s*\(\s*weekday\s+FROM", re.IGNORECASE), "EXTRACT(dow FROM"),
+    (re.compile(r"\bSET\s+query_group\s+TO\b", re.IGNORECASE), "SET application_name TO"),
+]
+
+
+def get_dialect(config):
+    """
+    Read the SQL dialect of the target database from [CLUSTER] DIALECT.
+
+    Args:
+        config: Configuration parser
+
+    Returns:
+        str: 'redshift' (default) or 'postgres'
+    """
+    dialect = config.get('CLUSTER', 'DIALECT', fallback=REDSHIFT).strip().lower()
+    if dialect not in DIALECTS:
+        raise ValueError(f"Unknown SQL dialect '{dialect}', expected one of {', '.join(DIALECTS)}")
+    return dialect
+
+
+def get_sort_key_columns(query):
+    """
+    Return the sort key columns declared in a Redshift CREATE TABLE statement.
+
+    Both table-level SORTKEY (a, b) and column-level "col TYPE ... SORTKEY" are recognised.
+
+    Args:
+        query: CREATE TABLE statement
+
+    Returns:
+        list: Column names in sort key order
+    """
+    table_level = re.search(r"\bSORTKEY\s*\(([^)]*)\)", query, re.IGNORECASE)
+    if table_level:
+        return [column.strip() for column in table_level.group(1).split(",") if column.strip()]
+
+    return re.findall(r"^\s*(\w+)\s[^,\n]*\bSORTKEY\b", query, re.IGNORECASE | re.MULTILINE)
+
+
+def translate_postgres(query):
+    """
+    Translate a Redshift statement into PostgreSQL.
+
+    Sort keys of CREATE TABLE statements are kept as a B-tree index created
+    right after the table.
+
+    Args:
+        query: Redshift SQL statement(s)
+
+    Returns:
+        str: PostgreSQL SQL statement(s)
+    """
+    create_table = CREATE_TABLE_PATTERN.match(query.strip())
+    sort_columns = get_sort_key_columns(query) if create_table else []
+
+    # A single-column sort key on the primary key is already covered by its index
+    if len(sort_columns) == 1 and re.search(
+        rf"^\s*{sort_columns[0]}\s[^,\n]*\bPRIMARY\s+KEY\b", query, re.IGNORECASE | re.MULTILINE
+    ):
+        sort_columns = []
+
+    for pattern, replacement in POSTGRES_REWRITES:
+        query = pattern.sub(replacement, query)
+
+    if sort_columns:
+        table_name = create_table.group(1)
+        index_name = f"{table_name}_{'_'.join(sort_columns)}_idx"
+        query = (
+            f"{query.rstrip().rstrip(';')};\n"
+            f"CREATE INDEX IF NOT EXISTS {index_name} ON {table_name} ({', '.join(sort_columns)})"
+        )
+
+    return query
+
+
+def translate(query, dialect):
+    """
+    Translate a Redshift statement into the given dialect.
+
+    Args:
+        query: Redshift SQL statement(s)
+        dialect: Target dialect
+
+    Returns:
+        str: Statement(s) for the target dialect
+    """
+    if dialect == POSTGRES:
+        return translate_postgres(query)
+    return query
+
+
+def is_s3_copy(query):
+    """
+    Check whether a statement is a COPY from S3.
+    """
+    return bool(S3_COPY_PATTERN.match(query))
+
+
+class DialectCursor(psycopg2.extensions.cursor):
+    """
+    Cursor that translates every statement into the dialect of its connection.
+
+    On PostgreSQL, COPY statements from S3 are run as local-file loads.
+    """
+
+    def execute(self, query, vars=None):
+        dialect = getattr(self.connection, 'dialect', REDSHIFT)
+        if dialect == REDSHIFT:
+            return super().execute(query, vars)
+
+        if isinstance(query, sql.Composable):
+            query = query.as_string(self)
+        if isinstance(query, str):
+            if is_s3_copy(query):
+                copy_s3_query_locally(self, self.connection, query, self.connection.config)
+                return None
+            query = translate(query, dialect)
+
+        return super().execute(query, vars)
+
+
+class DialectConnection(psycopg2.extensions.connection):
+    """
+    Connection that knows its SQL dialect and hands out DialectCursor objects.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.dialect = REDSHIFT
+        self.config = None
+        self.transaction_batch = None
+        self.cursor_factory = DialectCursor
@@ -1,14 +1,75 @@
-import psycopg2
+import argparse
+import re
+import threading
 import time
-from sql_queries import copy_table_queries, insert_table_queries
+import metrics
+from datetime import datetime, timedelta
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, as_completed, wait
+from functools import partial
+from analytics_cache import record_load_version
+from backfill import (
+    build_range_filter,
+    find_partition_files,
+    get_loaded_partitions,
+    iter_partitions,
+    parse_date,
+    record_partition
+)
+from checkpoints import CheckpointStore, get_input_fingerprint
+from local_ingest import load_staging_tables_local
+from maintenance import run_maintenance
+from prepare_inputs import get_prepared_copy_queries
+from run_history import save_run
+from incremental import (
+    create_s3_client,
+    find_new_files,
+    get_events_watermark,
+    record_load,
+    write_manifest
+)
+from sql_queries import (
+    copy_table_queries,
+    song_match_key_queries,
+    song_match_report_legacy,
+    song_match_report_keyed,
+    insert_table_queries,
+    insert_table_dag,
+    state_table_queries,
+    staging_events_truncate,
+    staging_events_manifest_copy,
+    staging_songs_manifest_copy,
+    songplay_table_incremental_insert,
+    user_table_upsert,
+    song_table_upsert,
+    artist_table_upsert,
+    time_table_incremental_insert,
+    songplays_range_delete,
+    songplay_table_backfill_insert,
+    user_table_backfill_insert,
+    time_table_backfill_insert,
+    time_calendar_digits,
+    time_calendar_insert,
+    select_time_calendar_bounds,
+    select_staging_events_max_ts,
+    aggregate_table_queries,
+    aggregate_refresh_queries,
+    agg_tables_clear,
+    agg_refresh_state_insert,
+    select_agg_refresh_state,
+    select_songplays_count_until,
+    select_songplays_id_max,
+    songplays_id_range_filter
+)
 from utils import (
     get_config, 
-    connect_to_redshift,
-    execute_query
+    get_connection_pool,
+    close_connection_pool,
+    execute_query,
+    transaction
 )
 
 
-def load_staging_tables(cur, conn, config):
+def load_staging_tables(cur, conn, config, queries=copy_table_queries, checkpoints=None):
     """
     Load data from S3 into staging tables.
     
@@ -16,15 +77,22 @@ def load_staging_tables(cur, conn, config):
         cur: Database cursor
         conn: Database connection
         config: Configuration parser with S3 paths
+        queries: COPY statements to run (defaults to copy_table_queries)
+        checkpoints: CheckpointStore recording each completed load (optional)
+        
+    Returns:
+        dict: Elapsed time in seconds for each staging table
     """
+    timings = {}
+    
     try:
         print("\n" + "=" * 80)
         print("STARTING DATA LOADING TO STAGING")
         print("=" * 80)
         
-        for i, query in enumerate(copy_table_queries):
+        for i, query in enumerate(queries):
             try:
-                print(f"\nExecuting staging query {i+1}/{len(copy_table_queries)}")
+                print(f"\nExecuting staging query {i+1}/{len(queries)}")
                 
                 # Identify which staging is being loaded
                 if "staging_events" in query.lower():
@@ -32,7 +100,10 @@ def load_staging_tables(cur, conn, config):
                 elif "staging_songs" in query.lower():
                     print(f"Loading staging_songs...")
                 
-                execute_query(cur, conn, query, f"Staging query {i+1}")
+                table_name = get_staging_table_name(query, f"staging query {i+1}")
+                timings[table_name] = run_checkpointed_step(
+                    cur, conn, query, f"Staging query {i+1}", checkpoints, f"staging {table_name}"
+                )
                 
             except Exception as e:
                 print(f"Error in staging query {i+1}: {e}")
@@ -45,26 +116,185 @@ def load_staging_tables(cur, conn, config):
         print(f"Error during data loading to staging: {e}")
         conn.rollback()
         raise
+    
+    return timings
+
+
+def run_checkpointed_step(cur, conn, query, query_name, checkpoints=None, step=None):
+    """
+    Run a statement and record its checkpoint in the same transaction.
+    
+    Without a batched transaction, execute_query would commit the statement
+    before the checkpoint is written, and a crash between the two commits
+    would make --resume run the statement again. With checkpoints, both are
+    committed together instead (inside a batch, with the batch).
+    
+    Args:
+        cur: Database cursor
+        conn: Database connection
+        query: Statement to run
+        query_name: Statement name for logs and metrics
+        checkpoints: CheckpointStore (optional)
+        step: Checkpoint step name
+        
+    Returns:
+        float: Elapsed time of the statement in seconds
+    """
+    with transaction(conn, query_name, checkpoints is not None):
+        elapsed_time = execute_query(cur, conn, query, query_name)
+        if checkpoints is not None:
+            checkpoints.mark_done(cur, conn, step, query)
+    return elapsed_time
+
+
+def get_staging_table_name(query, default=None):
+    """
+    Extract the target table of a COPY statement.
+    
+    Args:
+        query: COPY statement
+        default: Value returned when the statement is not a COPY
+        
+    Returns:
+        str: Name of the staging table being loaded
+    """
+    return query.split("COPY ")[1].split()[0] if "COPY " in query else default
+
+
+def _run_on_own_connection(query, task_name, config, active_conns, lock, cancelled, on_success=None):
+    """
+    Run a single statement on a dedicated connection.
+    
+    The connection is borrowed from the shared pool and registered in
+    active_conns while the statement is running so that a failure in another
+    task can cancel it server-side. on_success, if given, is called with the
+    cursor and connection after the statement, and commits in the same
+    transaction (e.g. a checkpoint of the statement).
+    
+    Returns:
+        float: Elapsed time of the statement in seconds
+    """
+    with get_connection_pool(config).connection() as (conn, cur):
+        try:
+            with lock:
+                if cancelled.is_set():
+                    raise RuntimeError(f"{task_name} cancelled")
+                active_conns[task_name] = conn
+            
+            with transaction(conn, task_name, on_success is not None):
+                elapsed_time = execute_query(cur, conn, query, task_name)
+                if on_success is not None:
+                    on_success(cur, conn)
+            return elapsed_time
+        finally:
+            with lock:
+                active_conns.pop(task_name, None)
+
+
+def _cancel_running_tasks(futures, active_conns, lock, cancelled):
+    """
+    Skip tasks that have not started and cancel the statements in flight.
+    """
+    cancelled.set()
+    for future in futures:
+        future.cancel()
+    with lock:
+        for conn in active_conns.values():
+            conn.cancel()
+
+
+def load_staging_tables_parallel(config, max_workers=None, queries=copy_table_queries, checkpoints=None):
+    """
+    Load data from S3 into staging tables, running the COPY statements concurrently.
+    
+    Each COPY statement gets its own connection and runs in a worker pool. If
+    one load fails, loads that have not started are skipped and the ones in
+    flight are cancelled.
+    
+    Args:
+        config: Configuration parser with cluster settings and S3 paths
+        max_workers: Maximum number of concurrent loads (defaults to one per COPY)
+        queries: COPY statements to run (defaults to copy_table_queries)
+        checkpoints: CheckpointStore recording each completed load (optional)
+        
+    Returns:
+        dict: Elapsed time in seconds for each staging table
+    """
+    print("\n" + "=" * 80)
+    print("STARTING PARALLEL DATA LOADING TO STAGING")
+    print("=" * 80)
+    
+    loads = [
+        (get_staging_table_name(query, f"staging query {i+1}"), query)
+        for i, query in enumerate(queries)
+    ]
+    max_workers = max_workers or len(loads)
+    print(f"Running {len(loads)} loads with {max_workers} workers...")
+    
+    active_conns = {}
+    lock = threading.Lock()
+    cancelled = threading.Event()
+    timings = {}
+    start_time = time.time()
+    
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {
+            executor.submit(
+                _run_on_own_connection, query, f"Loading {table_name}", config, active_conns, lock, cancelled,
+                partial(checkpoints.mark_done, step=f"staging {table_name}", query=query) if checkpoints else None
+            ): table_name
+            for table_name, query in loads
+        }
+        
+        try:
+            for future in as_completed(futures):
+                table_name = futures[future]
+                timings[table_name] = future.result()
+        except Exception as e:
+            print(f"Error loading {table_name}: {e}")
+            print("Cancelling remaining staging loads...")
+            _cancel_running_tasks(futures, active_conns, lock, cancelled)
+            raise
+    
+    wall_time = time.time() - start_time
+    
+    print("\nStaging load timings:")
+    for table_name, elapsed_time in sorted(timings.items(), key=lambda item: item[1], reverse=True):
+        print(f"  {table_name:<30} {elapsed_time:>10.2f} s")
+    print(f"  {'Sum of loads':<30} {sum(timings.values()):>10.2f} s")
+    print(f"  {'Wall-clock time':<30} {wall_time:>10.2f} s")
+    
+    print("\nParallel staging data loading completed successfully!")
+    
+    return timings
 
 
-def insert_tables(cur, conn):
+def insert_tables(cur, conn, queries=insert_table_queries, checkpoints=None):
     """
     Insert data from staging tables into analytics tables.
     
     Args:
         cur: Database cursor
         conn: Database connection
+        queries: INSERT statements to run in order (defaults to insert_table_queries)
+        checkpoints: CheckpointStore recording each completed insert (optional)
+        
+    Returns:
+        dict: Elapsed time in seconds for each table
     """
     print("\n" + "=" * 80)
     print("STARTING INSERTION INTO ANALYTICAL TABLES")
     print("=" * 80)
     
-    for i, query in enumerate(insert_table_queries):
+    timings = {}
+    for i, query in enumerate(queries):
         try:
             table_name = query.split("INSERT INTO ")[1].split(" ")[0] if "INSERT INTO " in query else f"table {i+1}"
             print(f"Populating {table_name}...")
             
-            execute_query(cur, conn, query, f"Populating table {table_name}")
+            timings[table_name] = run_checkpointed_step(
+                cur, conn, query, f"Populating table {table_name}", checkpoints, f"inserts {table_name}"
+            )
             
         except Exception as e:
             print(f"Error populating {table_name}: {e}")
@@ -72,11 +302,842 @@ def insert_tables(cur, conn):
             raise
     
     print("\nInsertion into analytical tables completed successfully!")
+    
+    return timings
+
+
+def get_critical_path(dag, timings):
+    """
+    Find the dependency chain with the largest total execution time.
+    
+    Args:
+        dag: Mapping of task name to {"query", "depends_on"}
+        timings: Mapping of task name to elapsed seconds
+        
+    Returns:
+        tuple: (list of task names along the path, total seconds)
+    """
+    longest = {}
+    
+    def visit(name):
+        if name not in longest:
+            best_path, best_time = [], 0.0
+            for dependency in dag[name]["depends_on"]:
+                path, elapsed_time = visit(dependency)
+                if elapsed_time > best_time:
+                    best_path, best_time = path, elapsed_time
+            longest[name] = (best_path + [name], best_time + timings.get(name, 0.0))
+        return longest[name]
+    
+    return max((visit(name) for name in dag), key=lambda item: item[1], default=([], 0.0))
+
+
+def validate_dag(dag):
+    """
+    Check that every dependency exists and that the graph has no cycles.
+    
+    Raises:
+        ValueError: If a dependency is unknown or a cycle is found
+    """
+    for name, task in dag.items():
+        for dependency in task["depends_on"]:
+            if dependency not in dag:
+                raise ValueError(f"Task '{name}' depends on unknown task '{dependency}'")
+    
+    visiting, done = set(), set()
+    
+    def visit(name):
+        if name in done:
+            return
+        if name in visiting:
+            raise ValueError(f"Dependency cycle detected at task '{name}'")
+        visiting.add(name)
+        for dependency in dag[name]["depends_on"]:
+            visit(dependency)
+        visiting.discard(name)
+        done.add(name)
+    
+    for name in dag:
+        visit(name)
+
+
+def _run_dag_task(query, task_name, config, active_conns, lock, cancelled, run_start, on_success=None):
+    """
+    Run a DAG task on its own connection and record when it started and finished.
+    
+    Returns:
+        tuple: (start offset, end offset) in seconds from the start of the run
+    """
+    started = time.time() - run_start
+    _run_on_own_connection(query, task_name, config, active_conns, lock, cancelled, on_success)
+    return started, time.time() - run_start
+
+
+def run_dag(dag, config, max_workers=None, checkpoints=None):
+    """
+    Run a dependency graph of statements, each on its own connection.
+    
+    A task is submitted as soon as all of its dependencies have finished, so
+    independent statements run at the same time up to max_workers. If a task
+    fails, pending tasks are skipped and running ones are cancelled.
+    
+    Args:
+        dag: Mapping of task name to {"query": str, "depends_on": [task names]}
+        config: Configuration parser with cluster settings
+        max_workers: Maximum number of concurrent statements (defaults to one per task)
+        checkpoints: CheckpointStore recording each completed task as "inserts <task>" (optional)
+        
+    Returns:
+        dict: (start offset, end offset) in seconds for each task
+    """
+    validate_dag(dag)
+    max_workers = max_workers or len(dag)
+    
+    active_conns = {}
+    lock = threading.Lock()
+    cancelled = threading.Event()
+    schedule = {}
+    run_start = time.time()
+    
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        running = {}
+        
+        def submit_ready_tasks():
+            for name, task in dag.items():
+                if name in schedule or name in running.values():
+                    continue
+                if all(dependency in schedule for dependency in task["depends_on"]):
+                    print(f"Populating {name}...")
+                    future = executor.submit(
+                        _run_dag_task, task["query"], f"Populating table {name}",
+                        config, active_conns, lock, cancelled, run_start,
+                        partial(checkpoints.mark_done, step=f"inserts {name}", query=task["query"]) if checkpoints else None
+                    )
+                    running[future] = name
+        
+        submit_ready_tasks()
+        
+        while running:
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                name = running.pop(future)
+                try:
+                    schedule[name] = future.result()
+                except Exception as e:
+                    print(f"Error populating {name}: {e}")
+                    print("Cancelling remaining inserts...")
+                    _cancel_running_tasks(running, active_conns, lock, cancelled)
+                    raise
+            submit_ready_tasks()
+    
+    return schedule
+
+
+def print_critical_path_report(dag, schedule):
+    """
+    Print the start/end of each task and the critical path of the run.
+    
+    Args:
+        dag: Mapping of task name to {"query", "depends_on"}
+        schedule: Mapping of task name to (start offset, end offset)
+    """
+    timings = {name: end - start for name, (start, end) in schedule.items()}
+    path, path_time = get_critical_path(dag, timings)
+    wall_time = max((end for _, end in schedule.values()), default=0.0)
+    
+    print("\nInsert timings:")
+    print(f"  {'Table':<15} {'Start':>10} {'End':>10} {'Elapsed':>10}")
+    for name, (start, end) in sorted(schedule.items(), key=lambda item: item[1][0]):
+        marker = " *" if name in path else ""
+        print(f"  {name:<15} {start:>10.2f} {end:>10.2f} {end - start:>10.2f}{marker}")
+    
+    print(f"\nCritical path (*): {' -> '.join(path)} ({path_time:.2f} s)")
+    print(f"Sum of inserts: {sum(timings.values()):.2f} s")
+    print(f"Wall-clock time: {wall_time:.2f} s")
+
+
+def insert_tables_parallel(config, max_workers=None, dag=insert_table_dag, checkpoints=None):
+    """
+    Insert data into analytics tables, running independent inserts concurrently.
+    
+    Args:
+        config: Configuration parser with cluster settings
+        max_workers: Maximum number of concurrent inserts
+        dag: Inserts and their dependencies (defaults to insert_table_dag)
+        checkpoints: CheckpointStore recording each completed insert (optional)
+        
+    Returns:
+        dict: (start offset, end offset) in seconds for each table
+    """
+    print("\n" + "=" * 80)
+    print("STARTING PARALLEL INSERTION INTO ANALYTICAL TABLES")
+    print("=" * 80)
+    
+    schedule = run_dag(dag, config, max_workers, checkpoints)
+    print_critical_path_report(dag, schedule)
+    
+    print("\nInsertion into analytical tables completed successfully!")
+    
+    return schedule
+
+
+def build_song_match_keys(cur, conn):
+    """
+    Assign surrogate keys to new songs and artists, then rebuild the keyed
+    copies of the staging tables used by the songplays join.
+    
+    Args:
+        cur: Database cursor
+        conn: Database connection
+    """
+    print("\nBuilding song match keys...")
+    for query in song_match_key_queries:
+        table_name = re.search(r"(?:TABLE|INTO)\s+(?:IF\s+EXISTS\s+)?(\w+)", query).group(1)
+        action = {"DROP": "Dropping", "INSERT": "Extending"}.get(query.split()[0].upper(), "Building")
+        execute_query(cur, conn, query, f"{action} {table_name}")
+
+
+def report_song_matching(cur, conn):
+    """
+    Compare the match rate and join time of the title/artist join with the match-key join.
+    
+    Both joins are recorded in the metrics with the number of matched events as rows.
+    
+    Args:
+        cur: Database cursor
+        conn: Database connection
+        
+    Returns:
+        dict: (events, matched events, seconds) for "title/artist" and "match key"
+    """
+    report = {}
+    for name, query in (("title/artist", song_match_report_legacy), ("match key", song_match_report_keyed)):
+        start_time = time.time()
+        cur.execute(query)
+        events, matched = cur.fetchone()
+        elapsed_time = time.time() - start_time
+        metrics.record_statement(None, f"Song match ({name})", elapsed_time, matched)
+        report[name] = (events, matched, elapsed_time)
+    
+    print("\n" + "=" * 80)
+    print("SONG MATCH REPORT")
+    print("=" * 80)
+    print(f"{'Join':<16} {'Events':>12} {'Matched':>12} {'Match rate':>12} {'Seconds':>10}")
+    for name, (events, matched, elapsed_time) in report.items():
+        rate = matched / events if events else 0.0
+        print(f"{name:<16} {events:>12} {matched:>12} {rate:>12.1%} {elapsed_time:>10.2f}")
+    
+    return report
+
+
+def is_batching_enabled(config):
+    """
+    Check whether stages run as single transactions ([ETL] BATCH_TRANSACTIONS).
+    """
+    return config.getboolean('ETL', 'BATCH_TRANSACTIONS', fallback=False)
 
 
-def run_etl():
+def skip_completed_steps(checkpoints, steps):
+    """
+    Drop the steps that a resumed run already completed.
+    
+    The steps are independent of each other. As soon as one of them has to
+    run, every later step runs too, since it may depend on its output.
+    
+    Args:
+        checkpoints: CheckpointStore, or None when checkpoints are disabled
+        steps: Mapping of step name to SQL
+        
+    Returns:
+        dict: The steps that still have to run
+    """
+    if checkpoints is None:
+        return steps
+    
+    pending = {step: query for step, query in steps.items() if not checkpoints.is_done(step, query)}
+    for step in steps:
+        if step not in pending:
+            print(f"Skipping {step} (completed by a previous run)")
+    
+    if pending:
+        checkpoints.stop_resuming()
+    
+    return pending
+
+
+def skip_completed_tasks(checkpoints, dag):
+    """
+    Drop the insert tasks that a resumed run already completed.
+    
+    A task is kept when it has no matching checkpoint or when one of its
+    dependencies is kept.
+    
+    Args:
+        checkpoints: CheckpointStore, or None when checkpoints are disabled
+        dag: Mapping of task name to {"query", "depends_on"}
+        
+    Returns:
+        dict: The tasks that still have to run, with their remaining dependencies
+    """
+    if checkpoints is None:
+        return dag
+    
+    validate_dag(dag)
+    kept = {}
+    
+    def visit(name):
+        if name not in kept:
+            task = dag[name]
+            kept[name] = (not checkpoints.is_done(f"inserts {name}", task["query"])
+                          or any([visit(dependency) for dependency in task["depends_on"]]))
+        return kept[name]
+    
+    for name in dag:
+        if not visit(name):
+            print(f"Skipping inserts {name} (completed by a previous run)")
+    
+    if any(kept.values()):
+        checkpoints.stop_resuming()
+    
+    return {
+        name: {"query": task["query"], "depends_on": [dependency for dependency in task["depends_on"] if kept[dependency]]}
+        for name, task in dag.items() if kept[name]
+    }
+
+
+def run_staging_stage(cur, conn, config, queries=copy_table_queries, checkpoints=None):
+    """
+    Load staging tables from S3 sequentially or in parallel, or from local
+    directories, depending on the [ETL] settings.
+    
+    With BATCH_TRANSACTIONS, the sequential and local loads commit once at
+    the end of the stage; parallel loads commit per table on their own
+    connections.
+    
+    Once the staging tables are loaded, their keyed copies are rebuilt and,
+    with [ETL] MATCH_REPORT, the song match report is printed.
+    
+    With checkpoints, each load and the keyed copies are checkpointed, and
+    the ones completed by a previous run are skipped when resuming.
+    """
+    metrics.set_stage("staging")
+    
+    local = config.get('ETL', 'SOURCE', fallback='s3').lower() == 'local'
+    if local:
+        loads = {"staging local files": f"{config.get('LOCAL', 'LOG_DATA')}\n{config.get('LOCAL', 'SONG_DATA')}"}
+    else:
+        loads = {f"staging {get_staging_table_name(query)}": query for query in queries}
+    loads = skip_completed_steps(checkpoints, loads)
+    
+    with transaction(conn, "staging", is_batching_enabled(config)):
+        if not loads:
+            print("\nStaging tables already loaded by a previous run.")
+        elif local:
+            with transaction(conn, "staging local files", checkpoints is not None):
+                for table, stats in load_staging_tables_local(cur, conn, config).items():
+                    metrics.record_statement(None, f"Loading {table}", stats["seconds"], stats["rows"])
+                if checkpoints is not None:
+                    checkpoints.mark_done(cur, conn, "staging local files", loads["staging local files"])
+        elif config.getboolean('ETL', 'PARALLEL_STAGING', fallback=False):
+            load_staging_tables_parallel(
+                config,
+                config.getint('ETL', 'STAGING_WORKERS', fallback=0) or None,
+                list(loads.values()),
+                checkpoints
+            )
+        else:
+            load_staging_tables(cur, conn, config, list(loads.values()), checkpoints)
+        
+        match_keys = skip_completed_steps(checkpoints, {"staging song match keys": "\n".join(song_match_key_queries)})
+        if match_keys:
+            with transaction(conn, "staging song match keys", checkpoints is not None):
+                build_song_match_keys(cur, conn)
+                if checkpoints is not None:
+                    checkpoints.mark_done(cur, conn, "staging song match keys", match_keys["staging song match keys"])
+        
+        if config.getboolean('ETL', 'MATCH_REPORT', fallback=False):
+            report_song_matching(cur, conn)
+
+
+def build_time_calendar_query(start, hours):
+    """
+    Build the statement inserting one time row per hour from start.
+    
+    The digit lists generate at most twice as many numbers as there are
+    hours: the most significant digit only goes up to the leading digit of
+    the last number.
+    
+    Args:
+        start: First timestamp of the range (datetime)
+        hours: Number of hours in the range
+        
+    Returns:
+        str: INSERT statement
+    """
+    last = str(max(hours - 1, 0))
+    digits = len(last)
+    number = " + ".join(f"d{i}.d * {10 ** i}" for i in range(digits))
+    digit_tables = [f"({time_calendar_digits}) d{i}" for i in range(digits - 1)]
+    digit_tables.append(f"(SELECT d FROM ({time_calendar_digits}) leading WHERE d <= {last[0]}) d{digits - 1}")
+    
+    return time_calendar_insert.format(
+        start=start.strftime('%Y-%m-%d %H:%M:%S'),
+        number=number,
+        digits=" CROSS JOIN ".join(digit_tables),
+        hours=hours
+    )
+
+
+def pregenerate_time_range(cur, conn, start, end):
+    """
+    Insert a time row for every hour in [start, end) that is not in the table yet.
+    
+    Args:
+        cur: Database cursor
+        conn: Database connection
+        start: First timestamp, on the hour (datetime)
+        end: End of the range, exclusive (datetime)
+    """
+    hours = int((end - start).total_seconds() // 3600)
+    if hours <= 0:
+        return
+    
+    execute_query(
+        cur, conn, build_time_calendar_query(start, hours),
+        f"Pre-generating time from {start:%Y-%m-%d %H:%M:%S} to {end:%Y-%m-%d %H:%M:%S}"
+    )
+
+
+def extend_time_calendar(cur, conn, days):
+    """
+    Pre-generate the hourly calendar of the time dimension past the staged events.
+    
+    The calendar is extended from the hour after the last timestamp already
+    in time (or the first staged day) to days after the last staged day, so
+    time has a row for every hour, including hours without plays. Rows of
+    individual seconds are only added by the time insert, for the
+    timestamps of new songplays, so time grows by 24 rows per day plus
+    the distinct timestamps played.
+    
+    Args:
+        cur: Database cursor
+        conn: Database connection
+        days: Number of days pre-generated past the last staged event
+    """
+    cur.execute(select_time_calendar_bounds)
+    covered_until, min_ts, max_ts = cur.fetchone()
+    conn.commit()
+    
+    if max_ts is None:
+        return
+    
+    epoch = datetime(1970, 1, 1)
+    first_day = epoch + timedelta(days=min_ts // 1000 // 86400)
+    end = epoch + timedelta(days=max_ts // 1000 // 86400 + 1 + days)
+    start = covered_until.replace(minute=0, second=0, microsecond=0) + timedelta(hours=1) if covered_until else first_day
+    
+    pregenerate_time_range(cur, conn, start, end)
+
+
+def run_insert_stage(cur, conn, config, dag=insert_table_dag, checkpoints=None):
+    """
+    Populate analytics tables sequentially or as a DAG, depending on the [ETL] settings.
+    
+    With BATCH_TRANSACTIONS, sequential inserts run as one transaction, so a
+    failure leaves the star schema as it was before the stage. DAG tasks run
+    on their own connections and commit individually, so inside a transaction
+    opened by the caller the inserts always run sequentially on its connection.
+    
+    With [ETL] TIME_CALENDAR_DAYS, the time dimension is pre-generated past
+    the staged events before the inserts run.
+    
+    With checkpoints, each insert is checkpointed, and the ones completed by
+    a previous run are skipped when resuming (unless a dependency runs again).
+    """
+    metrics.set_stage("inserts")
+    
+    dag = skip_completed_tasks(checkpoints, dag)
+    if not dag:
+        print("\nAnalytical tables already populated by a previous run.")
+        return
+    
+    calendar_days = config.getint('ETL', 'TIME_CALENDAR_DAYS', fallback=0)
+    if calendar_days > 0:
+        with transaction(conn, "time calendar", is_batching_enabled(config)):
+            extend_time_calendar(cur, conn, calendar_days)
+    
+    if config.getboolean('ETL', 'PARALLEL_INSERTS', fallback=False) and conn.transaction_batch is None:
+        insert_tables_parallel(
+            config,
+            config.getint('ETL', 'INSERT_WORKERS', fallback=0) or None,
+            dag,
+            checkpoints
+        )
+    else:
+        with transaction(conn, "inserts", is_batching_enabled(config)):
+            insert_tables(cur, conn, [task["query"] for task in dag.values()], checkpoints)
+
+
+def refresh_aggregate_tables(cur, conn, incremental=False):
+    """
+    Maintain the aggregate tables behind the built-in analytics.
+    
+    Incrementally, only the songplays past the songplay_id high-water mark of
+    the last refresh are folded into the aggregates, provided that refresh
+    covered every songplay up to its mark. Otherwise the aggregates are
+    rebuilt from the whole songplays table. Either way the rows folded in are
+    bounded by the highest songplay_id read up front, and recorded in
+    agg_refresh_state together with it.
+    
+    Args:
+        cur: Database cursor
+        conn: Database connection
+        incremental: Fold in only the songplays added since the last refresh
+    """
+    print("\n" + "=" * 80)
+    print("REFRESHING AGGREGATE TABLES")
+    print("=" * 80)
+    
+    metrics.set_stage("aggregates")
+    
+    for query in aggregate_table_queries:
+        execute_query(cur, conn, query, "Ensuring aggregate table")
+    
+    state = None
+    if incremental:
+        cur.execute(select_agg_refresh_state)
+        state = cur.fetchone()
+        if state is not None:
+            cur.execute(select_songplays_count_until.format(int(state[1])))
+            if cur.fetchone()[0] != state[0]:
+                state = None
+    
+    if state is not None:
+        print("Folding new songplays into the aggregates...")
+        rows, id_min = state
+    else:
+        print("Rebuilding the aggregates from all songplays...")
+        execute_query(cur, conn, agg_tables_clear, "Clearing aggregate tables")
+        rows, id_min = 0, -1
+    
+    cur.execute(select_songplays_id_max)
+    id_max = cur.fetchone()[0]
+    id_max = id_min if id_max is None else max(id_max, id_min)
+    row_filter = songplays_id_range_filter.format(int(id_min), int(id_max))
+    
+    for table_name, query in aggregate_refresh_queries.items():
+        execute_query(cur, conn, query.format(row_filter), f"Refreshing {table_name}")
+    
+    execute_query(
+        cur, conn,
+        agg_refresh_state_insert.format(rows=int(rows), id_max=int(id_max), row_filter=row_filter),
+        "Recording aggregate refresh"
+    )
+    
+    print("\nAggregate tables refreshed successfully!")
+
+
+def invalidate_cached_results(config):
+    """
+    Drop the cached analytics results before a load starts writing.
+    
+    Statements commit one by one unless batched, so a failed load can leave
+    partial data behind: the cache is invalidated once a load is certain to
+    write, not only when it succeeds. Loads that find nothing to do leave
+    the cache alone.
+    """
+    record_load_version(config, f"loading-{metrics.get_run_id()}")
+
+
+def build_incremental_insert_dag(watermark, has_new_events, has_new_songs):
+    """
+    Build the insert DAG for an incremental load.
+    
+    Args:
+        watermark: staging_events.ts high-water mark of the previous load
+        has_new_events: Whether new log files were copied into staging_events
+        has_new_songs: Whether new song files were copied into staging_songs
+        
+    Returns:
+        dict: Mapping of table name to {"query", "depends_on"}
+    """
+    dag = {}
+    
+    if has_new_events:
+        dag["songplays"] = {"query": songplay_table_incremental_insert.format(int(watermark)), "depends_on": []}
+        dag["users"] = {"query": user_table_upsert, "depends_on": []}
+    
+    if has_new_songs:
+        dag["songs"] = {"query": song_table_upsert, "depends_on": []}
+        dag["artists"] = {"query": artist_table_upsert, "depends_on": []}
+    
+    if has_new_events:
+        dag["time"] = {"query": time_table_incremental_insert.format(int(watermark)), "depends_on": ["songplays"]}
+    
+    return dag
+
+
+def run_incremental_load(cur, conn, config):
+    """
+    Load only the S3 files that were not processed by a previous run.
+    
+    New log files replace the contents of staging_events, new song files are
+    appended to staging_songs, and only events past the stored ts watermark
+    become songplays. The new watermark and the processed files are recorded
+    in etl_load_state / etl_processed_files in the same transaction as the
+    inserts and the aggregate refresh.
+    
+    Args:
+        cur: Database cursor
+        conn: Database connection
+        config: Configuration parser with S3 paths and the manifest prefix
+        
+    Returns:
+        str: Version of the recorded load, or None if there was nothing new
+    """
+    print("\n" + "=" * 80)
+    print("STARTING INCREMENTAL LOAD")
+    print("=" * 80)
+    
+    metrics.set_stage("incremental")
+    
+    for query in state_table_queries:
+        execute_query(cur, conn, query, "Ensuring ETL state table")
+    
+    watermark = get_events_watermark(cur)
+    print(f"Current staging_events.ts watermark: {watermark}")
+    
+    print("\nLooking for new files...")
+    s3 = create_s3_client()
+    new_files = {
+        "events": find_new_files(s3, cur, "events", config.get('S3', 'LOG_DATA')),
+        "songs": find_new_files(s3, cur, "songs", config.get('S3', 'SONG_DATA'))
+    }
+    
+    if not any(new_files.values()):
+        print("\nNo new files to load. Nothing to do.")
+        return None
+    
+    invalidate_cached_results(config)
+    metrics.set_stage("staging")
+    manifest_prefix = config.get('S3', 'MANIFEST_PREFIX').rstrip('/')
+    run_id = time.strftime('%Y%m%dT%H%M%S')
+    copy_queries = []
+    
+    if new_files["events"]:
+        execute_query(cur, conn, staging_events_truncate, "Truncating staging_events")
+        manifest_url = write_manifest(s3, new_files["events"], f"{manifest_prefix}/events-{run_id}.manifest")
+        copy_queries.append(staging_events_manifest_copy.format(manifest_url))
+    
+    if new_files["songs"]:
+        manifest_url = write_manifest(s3, new_files["songs"], f"{manifest_prefix}/songs-{run_id}.manifest")
+        copy_queries.append(staging_songs_manifest_copy.format(manifest_url))
+    
+    run_staging_stage(cur, conn, config, copy_queries)
+    
+    # The inserts, the aggregate refresh and the load record commit together:
+    # a run that fails before record_load leaves no songplays behind, so the
+    # rerun of the same files and watermark does not insert them twice
+    with transaction(conn, "incremental load"):
+        dag = build_incremental_insert_dag(watermark, bool(new_files["events"]), bool(new_files["songs"]))
+        run_insert_stage(cur, conn, config, dag)
+        
+        if new_files["events"] and config.getboolean('ETL', 'AGGREGATES', fallback=False):
+            refresh_aggregate_tables(cur, conn, incremental=True)
+        
+        metrics.set_stage("incremental")
+        cur.execute(select_staging_events_max_ts)
+        new_watermark = max(cur.fetchone()[0] or 0, watermark)
+        load_id = record_load(cur, conn, new_watermark, new_files)
+    
+    return f"incremental-{load_id}-{new_watermark}"
+
+
+def load_log_partitions(cur, conn, config, files):
+    """
+    Copy log_data partitions into staging_events with one manifest COPY.
+    
+    Redshift serializes concurrent COPY statements into the same table, so
+    the files of every partition are listed in a single manifest and loaded
+    in one COPY, which is spread over all slices. The partitions are marked
+    "copied" in etl_log_partitions in the same transaction as the COPY, or
+    "failed" if it fails.
+    
+    Args:
+        cur: Database cursor
+        conn: Database connection
+        config: Configuration parser with S3 paths
+        files: Mapping of partition key to (S3 prefix, list of s3:// URLs)
+        
+    Returns:
+        float: Elapsed time of the COPY in seconds
+    """
+    print("\n" + "=" * 80)
+    print("STARTING PARTITIONED DATA LOADING TO STAGING")
+    print("=" * 80)
+    print(f"Copying {len(files)} partitions in one COPY...")
+    
+    manifest_prefix = config.get('S3', 'MANIFEST_PREFIX').rstrip('/')
+    manifest_url = write_manifest(
+        create_s3_client(),
+        [url for key in sorted(files) for url in files[key][1]],
+        f"{manifest_prefix}/backfill-{time.strftime('%Y%m%dT%H%M%S')}.manifest"
+    )
+    
+    try:
+        with transaction(conn, "Loading partitions"):
+            elapsed_time = execute_query(cur, conn, staging_events_manifest_copy.format(manifest_url), "Loading partitions")
+            for key, (prefix, _) in files.items():
+                record_partition(cur, conn, key, prefix, "copied")
+    except Exception:
+        for key, (prefix, _) in files.items():
+            record_partition(cur, conn, key, prefix, "failed")
+        raise
+    
+    return elapsed_time
+
+
+def run_backfill(cur, conn, config, start, end, granularity="day", skip_loaded=False):
+    """
+    Reload the log_data of a date range, split into day or month partitions.
+    
+    staging_events is replaced by the partitions of the range, copied with a
+    single manifest COPY. The songplays of the partitions are then replaced,
+    missing users and time rows are added, and the partitions are marked as
+    loaded in etl_log_partitions. songs and artists are left alone:
+    staging_songs must already hold the song data.
+    
+    Args:
+        cur: Database cursor
+        conn: Database connection
+        config: Configuration parser with S3 paths
+        start: First date of the range
+        end: Last date of the range (inclusive)
+        granularity: "day" or "month"
+        skip_loaded: Skip the partitions a previous backfill already loaded
+        
+    Returns:
+        str: Version of the load, or None if there was nothing to load
+        
+    Raises:
+        Exception: If the COPY failed (the partitions are marked as failed)
+    """
+    print("\n" + "=" * 80)
+    print(f"STARTING BACKFILL OF LOG_DATA FROM {start} TO {end} BY {granularity.upper()}")
+    print("=" * 80)
+    
+    metrics.set_stage("staging")
+    
+    partitions = iter_partitions(start, end, granularity)
+    loaded = get_loaded_partitions(cur, conn)
+    if skip_loaded:
+        skipped = [key for key, _, _ in partitions if key in loaded]
+        partitions = [partition for partition in partitions if partition[0] not in loaded]
+        if skipped:
+            print(f"Skipping {len(skipped)} partitions already loaded: {', '.join(skipped)}")
+    
+    print("\nListing partitions...")
+    loads = {}
+    for key, (prefix, files) in find_partition_files(create_s3_client(), partitions, config.get('S3', 'LOG_DATA'), granularity).items():
+        print(f"  {key}: {len(files)} files")
+        if files:
+            loads[key] = (prefix, files)
+        else:
+            record_partition(cur, conn, key, prefix, "empty")
+    
+    if not loads:
+        print("\nNo log files in the range. Nothing to do.")
+        return None
+    
+    invalidate_cached_results(config)
+    execute_query(cur, conn, staging_events_truncate, "Truncating staging_events")
+    load_log_partitions(cur, conn, config, loads)
+    
+    with transaction(conn, "staging", is_batching_enabled(config)):
+        build_song_match_keys(cur, conn)
+    
+    # Songplays of the copied partitions are deleted and reinserted in one
+    # statement, and only their time range is scanned for missing time rows
+    ranges = [(first_day, next_day) for key, first_day, next_day in partitions if key in loads]
+    dag = {
+        "songplays": {
+            "query": songplays_range_delete.format(build_range_filter("start_time", ranges))
+                     + songplay_table_backfill_insert.format(build_range_filter("e.ts", ranges, epoch_millis=True)),
+            "depends_on": []
+        },
+        "users": {"query": user_table_backfill_insert, "depends_on": []},
+        "time": {"query": time_table_backfill_insert.format(build_range_filter("sp.start_time", ranges)), "depends_on": ["songplays"]}
+    }
+    run_insert_stage(cur, conn, config, dag)
+    
+    # Songplays changed inside the covered range, so the aggregates are rebuilt
+    if config.getboolean('ETL', 'AGGREGATES', fallback=False):
+        with transaction(conn, "aggregates", is_batching_enabled(config)):
+            refresh_aggregate_tables(cur, conn)
+    
+    for key, (prefix, _) in loads.items():
+        record_partition(cur, conn, key, prefix, "loaded")
+    
+    load_version = f"backfill-{start}-{end}-{time.strftime('%Y%m%dT%H%M%S')}"
+    
+    return load_version
+
+
+def run_full_load(cur, conn, config, resume=False):
+    """
+    Load every input file and rebuild the analytical tables.
+    
+    With [ETL] CHECKPOINTS (or when resuming), each completed step is
+    recorded in etl_checkpoints together with the fingerprint of the inputs.
+    
+    Args:
+        cur: Database cursor
+        conn: Database connection
+        config: Configuration parser
+        resume: Skip the steps completed by a previous run on the same inputs
+        
+    Returns:
+        str: Version of the load
+    """
+    invalidate_cached_results(config)
+    
+    checkpoints = None
+    if resume or config.getboolean('ETL', 'CHECKPOINTS', fallback=False):
+        print("\nFingerprinting the input files...")
+        checkpoints = CheckpointStore(get_input_fingerprint(config), resume)
+        checkpoints.load(cur, conn)
+    
+    # Load data into staging tables, from the chunks of prepare_inputs.py if enabled
+    if config.getboolean('ETL', 'PREPARED_INPUTS', fallback=False):
+        queries = get_prepared_copy_queries(config)
+    else:
+        queries = copy_table_queries
+    run_staging_stage(cur, conn, config, queries, checkpoints)
+    
+    # Insert data into analytical tables
+    run_insert_stage(cur, conn, config, checkpoints=checkpoints)
+    
+    # Rebuild the aggregate tables used by run_analytics
+    if config.getboolean('ETL', 'AGGREGATES', fallback=False):
+        steps = skip_completed_steps(checkpoints, {"aggregates": "\n".join(aggregate_refresh_queries.values())})
+        if steps:
+            with transaction(conn, "aggregates", is_batching_enabled(config) or checkpoints is not None):
+                refresh_aggregate_tables(cur, conn)
+                if checkpoints is not None:
+                    checkpoints.mark_done(cur, conn, "aggregates", steps["aggregates"])
+    
+    return f"full-{time.strftime('%Y%m%dT%H%M%S')}"
+
+
+def run_etl(resume=False, backfill_range=None, granularity="day", skip_loaded=False):
     """
     Main function to run the complete ETL process.
+    
+    Args:
+        resume: Continue a failed full load from its first incomplete step
+        backfill_range: (first date, last date) of log_data to reload instead of a regular load
+        granularity: Backfill partitions, "day" or "month"
+        skip_loaded: Skip the backfill partitions that were already loaded
     """
     print("\n" + "=" * 80)
     print("SPARKIFY ETL")
@@ -84,21 +1145,39 @@ def run_etl():
     
     start_time = time.time()
     
-    conn = None
-    cur = None
+    # Load configuration
+    config = get_config()
+    metrics.configure(config)
+    success = False
     
     try:
-        # Load configuration
-        config = get_config()
-        
-        # Connect to database
-        conn, cur = connect_to_redshift()
+        if (config.getboolean('ETL', 'INCREMENTAL', fallback=False)
+                and config.get('ETL', 'SOURCE', fallback='s3').lower() == 'local'):
+            raise ValueError("Incremental loads track S3 files and require SOURCE = s3")
+        if backfill_range and config.get('ETL', 'SOURCE', fallback='s3').lower() == 'local':
+            raise ValueError("Backfills copy S3 partitions and require SOURCE = s3")
         
-        # Load data into staging tables
-        load_staging_tables(cur, conn, config)
+        # Borrow a connection from the shared pool
+        with get_connection_pool(config).connection() as (conn, cur):
+            if backfill_range:
+                # Reload the log_data partitions of a date range
+                load_version = run_backfill(cur, conn, config, *backfill_range, granularity, skip_loaded)
+            elif config.getboolean('ETL', 'INCREMENTAL', fallback=False):
+                # Incremental loads pick up where they stopped through their own state
+                if resume:
+                    print("Incremental loads resume from their watermark; --resume is ignored")
+                
+                # Load only new S3 files and new events
+                load_version = run_incremental_load(cur, conn, config)
+            else:
+                load_version = run_full_load(cur, conn, config, resume)
+            
+            # Re-sort and re-analyze the tables the load pushed past their thresholds
+            if load_version is not None and config.getboolean('MAINTENANCE', 'ENABLED', fallback=False):
+                run_maintenance(cur, conn, config)
         
-        # Insert data into analytical tables
-        insert_tables(cur, conn)
+        # Drop the results cached while the load was running
+        record_load_version(config, load_version)
         
         # Display summary
         total_time = time.time() - start_time
@@ -108,18 +1187,36 @@ def run_etl():
         
         print(f"Total execution time: {total_time:.2f} seconds")
         print("\nETL process completed successfully!")
+        success = True
         
     except Exception as e:
         print(f"Error during ETL process: {e}")
         raise
     finally:
-        # Close connections
-        if cur:
-            cur.close()
-        if conn:
-            conn.close()
+        # Close pooled connections
+        close_connection_pool()
         print("Database connection closed.")
+        
+        # Export per-statement metrics, including those of a failed run
+        metrics.export(config)
+        save_run(config, "etl", start_time, success)
 
 
 if __name__ == "__main__":
-    run_etl()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Load the Sparkify data into the warehouse")
+    parser.add_argument("--resume", action="store_true",
+                        help="Skip the steps a failed full load already completed and continue from the first incomplete one")
+    parser.add_argument("--from-date", type=parse_date,
+                        help="Backfill log_data from this date (YYYY-MM-DD) instead of running a regular load")
+    parser.add_argument("--to-date", type=parse_date, help="Last date of the backfill, inclusive (defaults to --from-date)")
+    parser.add_argument("--partition", choices=["day", "month"], default="day", help="Backfill one COPY per day or per month")
+    parser.add_argument("--skip-loaded", action="store_true", help="Skip the backfill partitions that were already loaded")
+    args = parser.parse_args()
+    
+    if args.to_date and not args.from_date:
+        parser.error("--to-date requires --from-date")
+    if args.from_date and args.resume:
+        parser.error("--resume does not apply to backfills; use --skip-loaded")
+    
+    backfill_range = (args.from_date, args.to_date or args.from_date) if args.from_date else None
+    run_etl(args.resume, backfill_range, args.partition, args.skip_loaded)
\ No newline at end of file
@@ -0,0 +1,355 @@
+"""
+EXPLAIN capture and data-redistribution analysis for the Sparkify queries.
+
+Every statement of insert_table_queries and analytics_queries is run through
+EXPLAIN and its plan is parsed to report:
+
+- redistribution steps of joins (DS_BCAST_INNER, DS_DIST_BOTH, DS_DIST_INNER, ...)
+- nested loop joins
+- the estimated row count of the statement and of its largest step
+
+The parsed plans can be saved as a baseline. A check compares the current
+plans with it and fails when a statement gains one of the checked steps, by
+default a broadcast (DS_BCAST_INNER), a redistribution of both join inputs
+(DS_DIST_BOTH) or a nested loop, e.g. after a change to the distribution
+keys or the join conditions in sql_queries.py. The checked steps can be set
+with [EXPLAIN] CHECKED_STEPS.
+
+Statements of the multi-statement upserts that read the temp table created
+by an earlier statement are explained against an empty copy of that table,
+so their row estimates are not representative. Nothing is modified: the
+session is rolled back at the end.
+
+Usage:
+    python explain_plans.py                      # print the report
+    python explain_plans.py --update-baseline    # save the current plans as the baseline
+    python explain_plans.py --check              # exit 1 on a new checked step or an EXPLAIN error
+"""
+import argparse
+import json
+import re
+import sys
+from collections import Counter
+from sql_queries import analytics_queries, insert_table_queries
+from utils import get_config, get_connection_pool, close_connection_pool
+
+
+# Join distribution attributes that move data between slices
+REDISTRIBUTION_STEPS = (
+    "DS_BCAST_INNER", "DS_DIST_BOTH", "DS_DIST_INNER", "DS_DIST_OUTER",
+    "DS_DIST_ALL_INNER"
+)
+
+# Plan features that fail the check when a statement gains one (default of [EXPLAIN] CHECKED_STEPS)
+CHECKED_STEPS = ("DS_BCAST_INNER", "DS_DIST_BOTH", "Nested Loop")
+
+PLAN_NODE_PATTERN = re.compile(
+    r"^(?P<indent>\s*)(?:->\s*)?(?P<label>\S.*?)\s+"
+    r"\(cost=[\d.]+\.\.(?P<cost>[\d.]+)\s+rows=(?P<rows>\d+)\s+width=\d+\)"
+)
+DISTRIBUTION_PATTERN = re.compile(r"\bDS_[A-Z_]+\b")
+CREATE_TABLE_AS_PATTERN = re.compile(
+    r"^(?P<create>CREATE\s+(?:TEMP|TEMPORARY)\s+TABLE\s+\w+)\s+AS\s+(?P<select>.*)$",
+    re.IGNORECASE | re.DOTALL
+)
+EXPLAINABLE_PATTERN = re.compile(r"^\s*(?:SELECT|WITH|INSERT|UPDATE|DELETE|CREATE\s+\w*\s*TABLE\s+\w+\s+AS)\b", re.IGNORECASE)
+
+
+def get_explain_targets():
+    """
+    Return the queries to explain, keyed by a descriptive name.
+
+    Returns:
+        dict: Mapping of name to SQL (possibly several statements)
+    """
+    targets = {}
+    for i, query in enumerate(insert_table_queries):
+        table_name = query.split("INSERT INTO ")[1].split(" ")[0] if "INSERT INTO " in query else f"table {i+1}"
+        targets[f"insert {table_name}"] = query
+
+    for query_name, query in analytics_queries.items():
+        targets[query_name] = query
+
+    return targets
+
+
+def split_statements(query):
+    """
+    Split a multi-statement query on semicolons.
+    """
+    return [statement.strip() for statement in query.split(";") if statement.strip()]
+
+
+def parse_plan(lines):
+    """
+    Parse the text of an EXPLAIN plan into its steps.
+
+    Args:
+        lines: Lines of the EXPLAIN output
+
+    Returns:
+        list: One dict per plan node (node, depth, distribution, rows, cost), top node first
+    """
+    steps = []
+    for line in lines:
+        match = PLAN_NODE_PATTERN.match(line)
+        if not match:
+            continue
+
+        label = match.group("label")
+        distribution = DISTRIBUTION_PATTERN.search(label)
+        steps.append({
+            "node": label,
+            "depth": len(match.group("indent")),
+            "distribution": distribution.group(0) if distribution else None,
+            "rows": int(match.group("rows")),
+            "cost": float(match.group("cost"))
+        })
+
+    return steps
+
+
+def summarize_plan(steps):
+    """
+    Summarise the redistribution steps, nested loops and row estimates of a plan.
+
+    Args:
+        steps: Parsed plan steps
+
+    Returns:
+        dict: Counts of each feature and the estimated rows
+    """
+    features = Counter(step["distribution"] for step in steps if step["distribution"] in REDISTRIBUTION_STEPS)
+    features["Nested Loop"] = sum("Nested Loop" in step["node"] for step in steps)
+
+    return {
+        "features": {name: count for name, count in features.items() if count},
+        "estimated_rows": steps[0]["rows"] if steps else None,
+        "max_step_rows": max((step["rows"] for step in steps), default=None),
+        "total_cost": steps[0]["cost"] if steps else None
+    }
+
+
+def explain_query(cur, conn, query):
+    """
+    EXPLAIN every statement of a query.
+
+    DROP statements are executed and temp tables created with CREATE TABLE AS
+    are created empty, so later statements that reference them can be
+    explained. The caller rolls the session back.
+
+    Args:
+        cur: Database cursor
+        conn: Database connection
+        query: SQL (possibly several statements)
+
+    Returns:
+        list: One dict per explained statement (statement, plan, steps, summary)
+    """
+    plans = []
+    for statement in split_statements(query):
+        if not EXPLAINABLE_PATTERN.match(statement):
+            if statement.upper().startswith("DROP"):
+                cur.execute(statement)
+            continue
+
+        cur.execute(f"EXPLAIN {statement}")
+        plan = [row[0] for row in cur.fetchall()]
+        steps = parse_plan(plan)
+        plans.append({
+            "statement": " ".join(statement.split())[:80],
+            "plan": plan,
+            "steps": steps,
+            "summary": summarize_plan(steps)
+        })
+
+        create_table_as = CREATE_TABLE_AS_PATTERN.match(statement)
+        if create_table_as:
+            cur.execute(
+                f"{create_table_as.group('create')} AS "
+                f"SELECT * FROM ({create_table_as.group('select')}) AS explain_source LIMIT 0"
+            )
+
+    return plans
+
+
+def capture_plans(cur, conn, targets=None):
+    """
+    Capture and parse the plans of every target query.
+
+    A query that fails to explain is reported in the failures rather than
+    dropped, so the check and the baseline never silently skip it.
+
+    Args:
+        cur: Database cursor
+        conn: Database connection
+        targets: Mapping of name to SQL (defaults to get_explain_targets())
+
+    Returns:
+        tuple: (mapping of "<name> [<n>]" to the explained statement,
+            mapping of the name of each query that failed to its error)
+    """
+    targets = targets or get_explain_targets()
+    results = {}
+    failures = {}
+
+    for name, query in targets.items():
+        print(f"Explaining {name}...")
+        try:
+            plans = explain_query(cur, conn, query)
+        except Exception as e:
+            print(f"Error explaining {name}: {e}")
+            failures[name] = str(e)
+            continue
+        finally:
+            conn.rollback()
+
+        for i, plan in enumerate(plans):
+            key = name if len(plans) == 1 else f"{name} [{i + 1}]"
+            results[key] = plan
+
+    return results, failures
+
+
+def get_checked_steps(config):
+    """
+    Read the plan features checked against the baseline from [EXPLAIN] CHECKED_STEPS.
+
+    Args:
+        config: Configuration parser
+
+    Returns:
+        tuple: Comma-separated features of the setting, or CHECKED_STEPS
+    """
+    value = config.get('EXPLAIN', 'CHECKED_STEPS', fallback='').strip()
+    if not value:
+        return CHECKED_STEPS
+
+    steps = tuple(step.strip() for step in value.split(",") if step.strip())
+    unknown = [step for step in steps if step not in REDISTRIBUTION_STEPS + ("Nested Loop",)]
+    if unknown:
+        raise ValueError(f"Unknown checked step(s) {', '.join(unknown)}, expected any of "
+                         f"{', '.join(REDISTRIBUTION_STEPS)}, Nested Loop")
+    return steps
+
+
+def find_new_features(results, baseline, checked_steps=CHECKED_STEPS):
+    """
+    Find statements that gained a checked step compared with the baseline.
+
+    Statements missing from the baseline are compared with an empty plan.
+
+    Args:
+        results: Explained statements returned by capture_plans
+        baseline: Mapping of statement key to its saved summary
+        checked_steps: Plan features that fail the check
+
+    Returns:
+        list: (statement key, feature, baseline count, current count) tuples
+    """
+    regressions = []
+    for key, result in results.items():
+        current = result["summary"]["features"]
+        previous = baseline.get(key, {}).get("features", {})
+        for feature in checked_steps:
+            if current.get(feature, 0) > previous.get(feature, 0):
+                regressions.append((key, feature, previous.get(feature, 0), current[feature]))
+
+    return regressions
+
+
+def print_report(results):
+    """
+    Print the redistribution steps, nested loops and row estimates of each statement.
+    """
+    print("\n" + "=" * 80)
+    print("QUERY PLAN REPORT")
+    print("=" * 80)
+
+    for key, result in results.items():
+        summary = result["summary"]
+        features = ", ".join(f"{name} x{count}" for name, count in sorted(summary["features"].items())) or "none"
+        print(f"\n=== {key} ===")
+        print(f"Statement: {result['statement']}")
+        print(f"Estimated rows: {summary['estimated_rows']} (largest step: {summary['max_step_rows']})")
+        print(f"Redistribution / nested loops: {features}")
+
+        for step in result["steps"]:
+            if step["distribution"] in REDISTRIBUTION_STEPS or "Nested Loop" in step["node"]:
+                print(f"  {step['node']} (rows={step['rows']})")
+
+
+def load_baseline(path):
+    """
+    Read a baseline saved by save_baseline, or return an empty one.
+    """
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+
+def save_baseline(path, results):
+    """
+    Save the summary and plan text of each statement as the new baseline.
+    """
+    baseline = {
+        key: {"features": result["summary"]["features"], "plan": result["plan"]}
+        for key, result in results.items()
+    }
+    with open(path, "w") as f:
+        json.dump(baseline, f, indent=2, sort_keys=True)
+    print(f"\nBaseline of {len(baseline)} statements saved to {path}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Capture and check the EXPLAIN plans of the Sparkify queries")
+    parser.add_argument("--baseline", default="explain_baseline.json", help="Baseline file of known plans")
+    parser.add_argument("--update-baseline", action="store_true", help="Save the current plans as the baseline")
+    parser.add_argument("--check", action="store_true", help="Fail on a new checked step ([EXPLAIN] CHECKED_STEPS)")
+    args = parser.parse_args()
+
+    config = get_config()
+    checked_steps = get_checked_steps(config)
+
+    try:
+        with get_connection_pool(config).connection() as (conn, cur):
+            results, failures = capture_plans(cur, conn)
+    finally:
+        close_connection_pool()
+
+    print_report(results)
+
+    if failures:
+        print("\n" + "=" * 80)
+        print("EXPLAIN FAILURES")
+        print("=" * 80)
+        for name, error in failures.items():
+            print(f"{name}: {error}")
+
+    if args.update_baseline:
+        if failures:
+            print(f"\n{len(failures)} statement(s) could not be explained; baseline not saved")
+            sys.exit(1)
+        save_baseline(args.baseline, results)
+
+    if args.check:
+        regressions = find_new_features(results, load_baseline(args.baseline), checked_steps)
+        print("\n" + "=" * 80)
+        print("PLAN CHECK")
+        print("=" * 80)
+        for key, feature, previous, current in regressions:
+            print(f"{key}: {feature} {previous} -> {current}")
+
+        if regressions:
+            print(f"\n{len(regressions)} new {' / '.join(checked_steps)} step(s) compared with {args.baseline}")
+        if failures:
+            print(f"\n{len(failures)} statement(s) could not be explained")
+        if regressions or failures:
+            sys.exit(1)
+        print(f"\nNo new {' / '.join(checked_steps)} step compared with {args.baseline}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,338 @@
+"""
+Synthetic Sparkify data generator.
+
+Writes song_data and log_data JSON files with the same layout and fields as
+the Udacity S3 datasets, at a chosen scale factor, plus the log_json_path.json
+jsonpaths file that gives the field order of staging_events:
+
+- song popularity follows a Zipf distribution, so a few songs get most plays
+- users have skewed activity and occasionally upgrade from free to paid
+- sessions have a log-normal number of songs and start following a daily activity curve
+- a fraction of plays reference songs missing from the catalog, as in the real logs
+
+Usage:
+    python generate_data.py --scale 10 --output data/scale_10
+"""
+import argparse
+import bisect
+import itertools
+import json
+import math
+import os
+import random
+import string
+import time
+from datetime import datetime, timedelta, timezone
+from local_ingest import STAGING_EVENTS_FIELDS
+
+
+# Scale 1x is roughly the size of the Udacity sample
+BASE_EVENTS = 8000
+BASE_SONGS = 1500
+BASE_USERS = 100
+
+# Jsonpaths file written next to song_data/ and log_data/
+JSONPATH_FILE = "log_json_path.json"
+
+START_DATE = datetime(2018, 11, 1, tzinfo=timezone.utc)
+DAYS = 30
+
+# Relative activity per hour of the day (UTC), peaking in the evening
+HOURLY_ACTIVITY = [
+    2, 1, 1, 1, 1, 2, 3, 5, 6, 7, 7, 8,
+    8, 8, 9, 10, 12, 14, 15, 15, 13, 10, 6, 4
+]
+
+OTHER_PAGES = ["Home", "Thumbs Up", "Add to Playlist", "Thumbs Down", "Settings", "Help", "About"]
+
+USER_AGENTS = [
+    "\"Mozilla/5.0 (Windows NT 6.1; WOW64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/36.0.1985.143 Safari/537.36\"",
+    "\"Mozilla/5.0 (Macintosh; Intel Mac OS X 10_9_4) AppleWebKit/537.78.2 (KHTML, like Gecko) Version/7.0.6 Safari/537.78.2\"",
+    "Mozilla/5.0 (Windows NT 6.1; WOW64; rv:31.0) Gecko/20100101 Firefox/31.0",
+    "\"Mozilla/5.0 (iPhone; CPU iPhone OS 7_1_2 like Mac OS X) AppleWebKit/537.51.2 (KHTML, like Gecko) Version/7.0 Mobile/11D257 Safari/9537.53\""
+]
+
+LOCATIONS = [
+    ("San Francisco-Oakland-Hayward, CA", 37.77, -122.42),
+    ("Portland-South Portland, ME", 43.66, -70.26),
+    ("Lansing-East Lansing, MI", 42.73, -84.55),
+    ("Chicago-Naperville-Elgin, IL-IN-WI", 41.88, -87.63),
+    ("Atlanta-Sandy Springs-Roswell, GA", 33.75, -84.39),
+    ("New York-Newark-Jersey City, NY-NJ-PA", 40.71, -74.01),
+    ("Houston-The Woodlands-Sugar Land, TX", 29.76, -95.37),
+    ("Janesville-Beloit, WI", 42.68, -89.02),
+    ("Tampa-St. Petersburg-Clearwater, FL", 27.95, -82.46),
+    ("Seattle-Tacoma-Bellevue, WA", 47.61, -122.33)
+]
+
+FIRST_NAMES = ["Lily", "Jacob", "Kate", "Chloe", "Aleena", "Tegan", "Jayden", "Matthew", "Ryan", "Sara", "Layla", "Jordan"]
+LAST_NAMES = ["Koch", "Klein", "Harrell", "Cuevas", "Kirby", "Levine", "Fox", "Jones", "Smith", "Johnson", "Griffin", "Hicks"]
+WORDS = ["love", "night", "heart", "fire", "dream", "rain", "blue", "road", "light", "song", "home", "dance", "gold", "wild"]
+
+
+def random_id(rng, prefix, length=16):
+    """
+    Build an identifier in the style of the dataset (e.g. SOABCDEF12345678).
+    """
+    return prefix + "".join(rng.choices(string.ascii_uppercase + string.digits, k=length))
+
+
+def random_title(rng, words=3):
+    """
+    Build a title from a few random words.
+    """
+    return " ".join(rng.choice(WORDS).capitalize() for _ in range(rng.randint(1, words)))
+
+
+def zipf_cum_weights(n, exponent=1.1):
+    """
+    Cumulative Zipf weights for n ranked items, for bisect-based sampling.
+    """
+    return list(itertools.accumulate(1.0 / (rank ** exponent) for rank in range(1, n + 1)))
+
+
+def sample(rng, items, cum_weights):
+    """
+    Draw one item according to precomputed cumulative weights.
+    """
+    return items[bisect.bisect(cum_weights, rng.random() * cum_weights[-1])]
+
+
+def generate_songs(rng, n_songs):
+    """
+    Generate the song catalog, with roughly two songs per artist.
+
+    Returns:
+        list: Song records with the fields of the song_data files
+    """
+    n_artists = max(1, n_songs // 2)
+    artists = []
+    for _ in range(n_artists):
+        location, latitude, longitude = rng.choice(LOCATIONS)
+        has_location = rng.random() < 0.6
+        artists.append({
+            "artist_id": random_id(rng, "AR"),
+            "artist_name": f"{rng.choice(FIRST_NAMES)} {rng.choice(LAST_NAMES)} {random_title(rng, 1)}",
+            "artist_location": location if has_location else "",
+            "artist_latitude": latitude if has_location else None,
+            "artist_longitude": longitude if has_location else None
+        })
+
+    songs = []
+    for _ in range(n_songs):
+        artist = rng.choice(artists)
+        songs.append({
+            "num_songs": 1,
+            **artist,
+            "song_id": random_id(rng, "SO"),
+            "title": random_title(rng),
+            "duration": round(rng.lognormvariate(5.4, 0.3), 5),
+            "year": rng.choice([0] * 4 + list(range(1960, 2019)))
+        })
+
+    return songs
+
+
+def generate_users(rng, n_users):
+    """
+    Generate users with a level, a location and a user agent.
+
+    Returns:
+        list: User records
+    """
+    users = []
+    for user_id in range(1, n_users + 1):
+        location = rng.choice(LOCATIONS)[0]
+        users.append({
+            "userId": str(user_id),
+            "firstName": rng.choice(FIRST_NAMES),
+            "lastName": rng.choice(LAST_NAMES),
+            "gender": rng.choice("MF"),
+            "level": "paid" if rng.random() < 0.2 else "free",
+            "location": location,
+            "userAgent": rng.choice(USER_AGENTS),
+            "registration": float(int((START_DATE - timedelta(days=rng.randint(30, 900))).timestamp() * 1000))
+        })
+    return users
+
+
+def generate_day_events(rng, day, events_per_day, users, user_weights, songs, song_weights,
+                        session_ids, unknown_song_rate=0.1):
+    """
+    Generate the events of one day, ordered by timestamp.
+
+    Returns:
+        list: Event records with the fields of the log_data files
+    """
+    day_start = START_DATE + timedelta(days=day)
+    hours = list(range(24))
+    hour_weights = list(itertools.accumulate(HOURLY_ACTIVITY))
+    events = []
+
+    while len(events) < events_per_day:
+        user = sample(rng, users, user_weights)
+        if user["level"] == "free" and rng.random() < 0.03:
+            user["level"] = "paid"
+
+        session_id = next(session_ids)
+        hour = sample(rng, hours, hour_weights)
+        ts = int((day_start + timedelta(hours=hour, seconds=rng.randint(0, 3599))).timestamp() * 1000)
+        n_songs = max(1, int(rng.lognormvariate(2.0, 0.8)))
+
+        for item in range(n_songs + 1):
+            base = {
+                **{key: user[key] for key in ("firstName", "lastName", "gender", "level", "location", "userAgent", "registration", "userId")},
+                "auth": "Logged In",
+                "itemInSession": item,
+                "method": "PUT",
+                "sessionId": session_id,
+                "status": 200,
+                "ts": ts
+            }
+
+            if item < n_songs:
+                song = sample(rng, songs, song_weights)
+                title, artist = song["title"], song["artist_name"]
+                if rng.random() < unknown_song_rate:
+                    title, artist = random_title(rng, 4), f"{rng.choice(LAST_NAMES)} Band"
+                events.append({**base, "artist": artist, "song": title, "length": song["duration"], "page": "NextSong"})
+                ts += int(song["duration"] * 1000)
+            else:
+                page = rng.choice(OTHER_PAGES)
+                events.append({**base, "artist": None, "song": None, "length": None, "page": page,
+                               "method": "GET" if page in ("Home", "Help", "About", "Settings") else "PUT"})
+                ts += rng.randint(1000, 60000)
+
+        # Occasional logged-out traffic, with no user attached
+        if rng.random() < 0.05:
+            events.append({
+                "artist": None, "auth": "Logged Out", "firstName": None, "gender": None, "itemInSession": 0,
+                "lastName": None, "length": None, "level": "free", "location": None, "method": "GET",
+                "page": "Home", "registration": None, "sessionId": next(session_ids), "song": None,
+                "status": 200, "ts": ts, "userAgent": None, "userId": ""
+            })
+
+    events.sort(key=lambda event: event["ts"])
+    return events
+
+
+def write_song_files(songs, output_dir):
+    """
+    Write one JSON file per song under song_data/<A>/<B>/<C>/, like the Udacity dataset.
+
+    Returns:
+        int: Bytes written
+    """
+    bytes_written = 0
+    for song in songs:
+        track_id = "TR" + song["song_id"][2:]
+        directory = os.path.join(output_dir, "song_data", *track_id[2:5])
+        os.makedirs(directory, exist_ok=True)
+        data = json.dumps(song)
+        with open(os.path.join(directory, f"{track_id}.json"), "w") as f:
+            f.write(data)
+        bytes_written += len(data)
+    return bytes_written
+
+
+def write_log_file(events, day, output_dir):
+    """
+    Write the events of one day to log_data/<year>/<month>/<date>-events.json.
+
+    Returns:
+        int: Bytes written
+    """
+    date = START_DATE + timedelta(days=day)
+    directory = os.path.join(output_dir, "log_data", f"{date:%Y}", f"{date:%m}")
+    os.makedirs(directory, exist_ok=True)
+
+    bytes_written = 0
+    with open(os.path.join(directory, f"{date:%Y-%m-%d}-events.json"), "w") as f:
+        for event in events:
+            line = json.dumps(event) + "\n"
+            f.write(line)
+            bytes_written += len(line)
+    return bytes_written
+
+
+def write_jsonpaths(output_dir):
+    """
+    Write the jsonpaths file mapping the log events to the staging_events columns.
+
+    Returns:
+        str: Path of the file
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    path = os.path.join(output_dir, JSONPATH_FILE)
+    with open(path, "w") as f:
+        json.dump({"jsonpaths": [f"$['{field}']" for field in STAGING_EVENTS_FIELDS]}, f, indent=4)
+    return path
+
+
+def generate_dataset(output_dir, scale=1, seed=42, songs=None, users=None, unknown_song_rate=0.1):
+    """
+    Generate a full dataset (song_data, log_data and the jsonpaths file) at a scale factor.
+
+    Args:
+        output_dir: Directory receiving song_data/ and log_data/
+        scale: Multiplier of the 1x event count
+        seed: Random seed, so datasets are reproducible
+        songs: Catalog size (defaults to BASE_SONGS * sqrt(scale))
+        users: Number of users (defaults to BASE_USERS * sqrt(scale))
+        unknown_song_rate: Fraction of plays of songs missing from the catalog
+
+    Returns:
+        dict: Generation statistics
+    """
+    rng = random.Random(seed)
+    start_time = time.time()
+
+    n_events = int(BASE_EVENTS * scale)
+    n_songs = songs or int(BASE_SONGS * math.sqrt(scale))
+    n_users = users or int(BASE_USERS * math.sqrt(scale))
+
+    print(f"Generating {n_songs} songs, {n_users} users and ~{n_events} events in {output_dir}...")
+
+    catalog = generate_songs(rng, n_songs)
+    song_weights = zipf_cum_weights(len(catalog))
+    user_list = generate_users(rng, n_users)
+    user_weights = zipf_cum_weights(len(user_list), exponent=0.8)
+    session_ids = itertools.count(1)
+
+    stats = {"scale": scale, "songs": n_songs, "users": n_users, "events": 0, "bytes": 0}
+    stats["bytes"] += write_song_files(catalog, output_dir)
+    write_jsonpaths(output_dir)
+
+    events_per_day = max(1, n_events // DAYS)
+    for day in range(DAYS):
+        events = generate_day_events(
+            rng, day, events_per_day, user_list, user_weights,
+            catalog, song_weights, session_ids, unknown_song_rate
+        )
+        stats["events"] += len(events)
+        stats["bytes"] += write_log_file(events, day, output_dir)
+
+    stats["seconds"] = time.time() - start_time
+    print(f"Generated {stats['events']} events and {stats['songs']} songs "
+          f"({stats['bytes'] / 1024 / 1024:.1f} MB) in {stats['seconds']:.2f} seconds")
+
+    return stats
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Generate synthetic Sparkify song_data and log_data")
+    parser.add_argument("--scale", type=float, default=1, help="Event volume relative to the 1x sample")
+    parser.add_argument("--output", default=None, help="Output directory (default: data/scale_<scale>)")
+    parser.add_argument("--seed", type=int, default=42, help="Random seed")
+    parser.add_argument("--songs", type=int, default=None, help="Catalog size override")
+    parser.add_argument("--users", type=int, default=None, help="Number of users override")
+    parser.add_argument("--unknown-song-rate", type=float, default=0.1,
+                        help="Fraction of plays of songs missing from the catalog")
+    args = parser.parse_args()
+
+    output_dir = args.output or os.path.join("data", f"scale_{args.scale:g}")
+    generate_dataset(output_dir, args.scale, args.seed, args.songs, args.users, args.unknown_song_rate)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,194 @@
+"""
+Incremental load helpers for the Sparkify Data Warehouse.
+
+Tracks which S3 files were already copied into staging and the
+staging_events.ts high-water mark, and builds COPY manifests for the
+files that still have to be loaded.
+"""
+import json
+import os
+import boto3
+from dotenv import load_dotenv
+from psycopg2.extras import execute_values
+from sql_queries import (
+    select_events_watermark,
+    select_next_load_id,
+    select_processed_files,
+    insert_processed_files,
+    insert_load_state
+)
+
+
+def create_s3_client():
+    """
+    Create a boto3 S3 client using the credentials from the environment or .env file.
+
+    Returns:
+        botocore.client.S3: S3 client
+    """
+    load_dotenv()
+
+    kwargs = {
+        'region_name': os.getenv('AWS_REGION', 'us-west-2'),
+        'aws_access_key_id': os.getenv('AWS_ACCESS_KEY_ID'),
+        'aws_secret_access_key': os.getenv('AWS_SECRET_ACCESS_KEY')
+    }
+
+    if os.getenv('AWS_SESSION_TOKEN'):
+        kwargs['aws_session_token'] = os.getenv('AWS_SESSION_TOKEN')
+
+    return boto3.client('s3', **kwargs)
+
+
+def parse_s3_url(url):
+    """
+    Split an s3://bucket/prefix URL into bucket and prefix.
+
+    Args:
+        url: S3 URL
+
+    Returns:
+        tuple: (bucket, prefix)
+    """
+    if not url.startswith("s3://"):
+        raise ValueError(f"Not an S3 URL: {url}")
+
+    bucket, _, prefix = url[len("s3://"):].partition("/")
+    return bucket, prefix
+
+
+def list_s3_files(s3, url, suffix=".json"):
+    """
+    List every file under an S3 prefix.
+
+    Args:
+        s3: S3 client
+        url: s3://bucket/prefix to list
+        suffix: Only keys ending with this suffix are returned
+
+    Returns:
+        list: Sorted s3:// URLs of the files found
+    """
+    bucket, prefix = parse_s3_url(url)
+    paginator = s3.get_paginator('list_objects_v2')
+
+    files = []
+    for page in paginator.paginate(Bucket=bucket, Prefix=prefix):
+        for obj in page.get('Contents', []):
+            if obj['Key'].endswith(suffix):
+                files.append(f"s3://{bucket}/{obj['Key']}")
+
+    return sorted(files)
+
+
+def get_events_watermark(cur):
+    """
+    Return the highest staging_events.ts already turned into songplays.
+
+    Returns:
+        int: Watermark in epoch milliseconds (0 if nothing was loaded yet)
+    """
+    cur.execute(select_events_watermark)
+    return cur.fetchone()[0]
+
+
+def get_processed_files(cur, source):
+    """
+    Return the S3 files already loaded for a source.
+
+    Args:
+        cur: Database cursor
+        source: Source name ("events" or "songs")
+
+    Returns:
+        set: s3:// URLs already processed
+    """
+    cur.execute(select_processed_files, (source,))
+    return {row[0] for row in cur.fetchall()}
+
+
+def find_new_files(s3, cur, source, url):
+    """
+    List the files under an S3 prefix that have not been loaded yet.
+
+    Args:
+        s3: S3 client
+        cur: Database cursor
+        source: Source name used in etl_processed_files
+        url: s3:// prefix of the source
+
+    Returns:
+        list: Sorted s3:// URLs of the new files
+    """
+    processed = get_processed_files(cur, source)
+    available = list_s3_files(s3, url)
+    new_files = [f for f in available if f not in processed]
+
+    print(f"  {source}: {len(available)} files available, {len(processed)} already loaded, {len(new_files)} new")
+
+    return new_files
+
+
+def write_manifest(s3, files, manifest_url):
+    """
+    Upload a Redshift COPY manifest listing the given files.
+
+    Args:
+        s3: S3 client
+        files: s3:// URLs to include
+        manifest_url: s3:// URL where the manifest is written
+
+    Returns:
+        str: The manifest URL
+    """
+    manifest = {"entries": [{"url": f, "mandatory": True} for f in files]}
+    bucket, key = parse_s3_url(manifest_url)
+    s3.put_object(Bucket=bucket, Key=key, Body=json.dumps(manifest).encode("utf-8"))
+
+    print(f"  Manifest with {len(files)} files written to {manifest_url}")
+
+    return manifest_url
+
+
+def record_load(cur, conn, watermark, new_files):
+    """
+    Record a finished incremental load: the new watermark and the files it processed.
+
+    Inside a transaction (see utils.transaction), the record commits with the
+    inserts of the load instead of on its own.
+
+    Args:
+        cur: Database cursor
+        conn: Database connection
+        watermark: New staging_events.ts high-water mark
+        new_files: Mapping of source name to the s3:// URLs loaded
+
+    Returns:
+        int: Identifier of the recorded load
+    """
+    try:
+        cur.execute(select_next_load_id)
+        load_id = cur.fetchone()[0]
+
+        rows = [(f, source, load_id) for source, files in new_files.items() for f in files]
+        if rows:
+            execute_values(cur, insert_processed_files, rows, page_size=500)
+
+        cur.execute(insert_load_state, (
+            load_id,
+            watermark,
+            len(new_files.get("events", [])),
+            len(new_files.get("songs", []))
+        ))
+        if getattr(conn, 'transaction_batch', None) is None:
+            conn.commit()
+
+        print(f"Recorded load {load_id} with watermark {watermark} and {len(rows)} files")
+
+        return load_id
+
+    except Exception as e:
+        print(f"Error recording load state: {e}")
+        if getattr(conn, 'transaction_batch', None) is None:
+            conn.rollback()
+        raise
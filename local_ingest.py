@@ -0,0 +1,372 @@
+"""
+Local ingestion engine for the Sparkify Data Warehouse.
+
+Loads song_data and log_data JSON files from local directories into the
+staging tables without going through S3. Files are parsed in a process pool
+and the rows are streamed into the database with COPY FROM STDIN, keeping
+only a bounded number of parsed batches in memory.
+"""
+import json
+import os
+import re
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from itertools import islice
+
+
+# Field order of log_json_path.json, matching the staging_events columns after event_id
+STAGING_EVENTS_FIELDS = [
+    "artist", "auth", "firstName", "gender", "itemInSession", "lastName",
+    "length", "level", "location", "method", "page", "registration",
+    "sessionId", "song", "status", "ts", "userAgent", "userId"
+]
+
+# Columns of staging_songs, filled by name like COPY ... FORMAT AS JSON 'auto'
+STAGING_SONGS_FIELDS = [
+    "num_songs", "artist_id", "artist_latitude", "artist_longitude",
+    "artist_location", "artist_name", "song_id", "title", "duration", "year"
+]
+
+# Numeric columns of the staging tables; empty strings load as NULL
+NUMERIC_FIELDS = {
+    "itemInSession", "length", "registration", "sessionId", "status", "ts", "userId",
+    "num_songs", "artist_latitude", "artist_longitude", "duration", "year"
+}
+
+# Target columns of each staging table, used when an S3 COPY is run locally
+STAGING_TABLE_COLUMNS = {
+    "staging_events": STAGING_EVENTS_FIELDS,
+    "staging_songs": STAGING_SONGS_FIELDS
+}
+
+COPY_STATEMENT = "COPY {} ({}) FROM STDIN"
+
+S3_COPY_PARTS = re.compile(
+    r"COPY\s+(?P<table>\w+)\s+FROM\s+'(?P<source>s3://[^']+)'.*?FORMAT\s+AS\s+JSON\s+'(?P<jsonpaths>[^']+)'",
+    re.IGNORECASE | re.DOTALL
+)
+
+
+def load_jsonpaths(path):
+    """
+    Read the field order from a Redshift jsonpaths file such as log_json_path.json.
+
+    Args:
+        path: Local path of the jsonpaths file
+
+    Returns:
+        list: Field names in column order
+    """
+    with open(path) as f:
+        jsonpaths = json.load(f)["jsonpaths"]
+
+    fields = []
+    for jsonpath in jsonpaths:
+        match = re.fullmatch(r"\$\['([^']+)'\]|\$\.(\w+)", jsonpath)
+        if not match:
+            raise ValueError(f"Unsupported jsonpath expression: {jsonpath}")
+        fields.append(match.group(1) or match.group(2))
+
+    return fields
+
+
+def find_json_files(directory):
+    """
+    Walk a directory and return every JSON file in it.
+
+    Args:
+        directory: Root directory (e.g. data/song_data)
+
+    Returns:
+        list: Sorted file paths
+    """
+    files = []
+    for root, _, names in os.walk(directory):
+        files.extend(os.path.join(root, name) for name in names if name.endswith(".json"))
+    return sorted(files)
+
+
+def iter_json_objects(text):
+    """
+    Yield the JSON objects of a file holding one object or newline-delimited objects.
+    """
+    decoder = json.JSONDecoder()
+    position = 0
+    length = len(text)
+
+    while True:
+        while position < length and text[position].isspace():
+            position += 1
+        if position >= length:
+            return
+        obj, position = decoder.raw_decode(text, position)
+        yield obj
+
+
+def escape_copy_value(value, numeric=False):
+    """
+    Render a value for COPY text format (tab-separated, \\N for NULL).
+    """
+    if value is None or (numeric and value == ""):
+        return "\\N"
+    if isinstance(value, bool):
+        return "true" if value else "false"
+    if isinstance(value, (int, float)):
+        return repr(value)
+
+    return (
+        str(value)
+        .replace("\\", "\\\\")
+        .replace("\t", "\\t")
+        .replace("\n", "\\n")
+        .replace("\r", "\\r")
+    )
+
+
+def parse_files(paths, fields, numeric):
+    """
+    Parse a batch of JSON files into COPY text rows.
+
+    Runs in a worker process.
+
+    Args:
+        paths: Files to parse
+        fields: JSON field of each column, in column order
+        numeric: Whether each column is numeric, in column order
+
+    Returns:
+        tuple: (COPY text for the batch, number of rows, bytes read)
+    """
+    lines = []
+    bytes_read = 0
+
+    for path in paths:
+        with open(path, encoding="utf-8") as f:
+            text = f.read()
+        bytes_read += len(text.encode("utf-8"))
+
+        for obj in iter_json_objects(text):
+            lines.append("\t".join(
+                escape_copy_value(obj.get(field), is_numeric) for field, is_numeric in zip(fields, numeric)
+            ))
+
+    data = "\n".join(lines) + "\n" if lines else ""
+    return data, len(lines), bytes_read
+
+
+def iter_parsed_batches(files, fields, numeric, workers=None, files_per_task=64, max_in_flight=None):
+    """
+    Parse files in a process pool, yielding results in order.
+
+    At most max_in_flight batches are submitted or buffered at any time, so
+    memory stays bounded regardless of the number of files.
+
+    Yields:
+        tuple: (COPY text, number of rows, bytes read) for each batch
+    """
+    workers = workers or os.cpu_count() or 1
+    max_in_flight = max_in_flight or workers * 2
+    batches = (files[i:i + files_per_task] for i in range(0, len(files), files_per_task))
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        pending = deque(executor.submit(parse_files, batch, fields, numeric) for batch in islice(batches, max_in_flight))
+
+        while pending:
+            result = pending.popleft().result()
+
+            batch = next(batches, None)
+            if batch is not None:
+                pending.append(executor.submit(parse_files, batch, fields, numeric))
+
+            yield result
+
+
+class CopyStream:
+    """
+    Read-only file-like object over an iterator of text chunks, for copy_expert.
+    """
+
+    def __init__(self, chunks):
+        self._chunks = iter(chunks)
+        self._buffer = ""
+        self._offset = 0
+
+    def read(self, size=-1):
+        parts = []
+        remaining = size
+
+        while size < 0 or remaining > 0:
+            if self._offset >= len(self._buffer):
+                chunk = next(self._chunks, None)
+                if chunk is None:
+                    break
+                self._buffer, self._offset = chunk, 0
+                continue
+
+            end = len(self._buffer) if size < 0 else min(len(self._buffer), self._offset + remaining)
+            parts.append(self._buffer[self._offset:end])
+            remaining -= end - self._offset
+            self._offset = end
+
+        return "".join(parts)
+
+    def readline(self, size=-1):
+        return self.read(size)
+
+
+def copy_local_files(cur, conn, table, columns, files, fields, workers=None, files_per_task=64, max_in_flight=None):
+    """
+    Stream a set of local JSON files into a staging table with COPY FROM STDIN.
+
+    Args:
+        cur: Database cursor
+        conn: Database connection
+        table: Target staging table
+        columns: Target columns
+        files: JSON files to load
+        fields: JSON field of each column, in the order of columns
+        workers: Number of parser processes (defaults to the CPU count)
+        files_per_task: Files parsed per worker task
+        max_in_flight: Maximum number of parsed batches held in memory
+
+    Returns:
+        dict: Load statistics (files, rows, bytes, seconds)
+    """
+    if len(fields) != len(columns):
+        raise ValueError(f"{len(fields)} JSON fields for {len(columns)} columns of {table}")
+
+    numeric = [column in NUMERIC_FIELDS for column in columns]
+    stats = {"files": len(files), "rows": 0, "bytes": 0, "seconds": 0.0}
+    print(f"Loading {len(files)} files into {table}...")
+
+    def chunks():
+        for data, rows, bytes_read in iter_parsed_batches(files, fields, numeric, workers, files_per_task, max_in_flight):
+            stats["rows"] += rows
+            stats["bytes"] += bytes_read
+            yield data
+
+    start_time = time.time()
+
+    # Inside a batched transaction the commit and the rollback are left to the stage
+    batched = getattr(conn, 'transaction_batch', None) is not None
+    try:
+        cur.copy_expert(COPY_STATEMENT.format(table, ", ".join(columns)), CopyStream(chunks()))
+        if not batched:
+            conn.commit()
+    except Exception as e:
+        print(f"Error loading {table}: {e}")
+        if not batched:
+            conn.rollback()
+        raise
+
+    stats["seconds"] = time.time() - start_time
+    rate = stats["rows"] / stats["seconds"] if stats["seconds"] else 0.0
+    print(f"{table}: {stats['rows']} rows, {stats['bytes'] / 1024 / 1024:.1f} MB "
+          f"in {stats['seconds']:.2f} seconds ({rate:,.0f} rows/sec)")
+
+    return stats
+
+
+def load_staging_tables_local(cur, conn, config):
+    """
+    Load staging_events and staging_songs from the local directories in [LOCAL].
+
+    Args:
+        cur: Database cursor
+        conn: Database connection
+        config: Configuration parser with the [LOCAL] settings
+
+    Returns:
+        dict: Load statistics per staging table
+    """
+    print("\n" + "=" * 80)
+    print("STARTING LOCAL DATA LOADING TO STAGING")
+    print("=" * 80)
+
+    workers = config.getint('LOCAL', 'WORKERS', fallback=0) or None
+    files_per_task = config.getint('LOCAL', 'FILES_PER_TASK', fallback=64)
+    max_in_flight = config.getint('LOCAL', 'MAX_IN_FLIGHT', fallback=0) or None
+
+    jsonpath = config.get('LOCAL', 'LOG_JSONPATH', fallback='').strip()
+    event_fields = load_jsonpaths(jsonpath) if jsonpath else STAGING_EVENTS_FIELDS
+
+    stats = {
+        "staging_events": copy_local_files(
+            cur, conn, "staging_events", STAGING_EVENTS_FIELDS,
+            find_json_files(config.get('LOCAL', 'LOG_DATA')), event_fields,
+            workers, files_per_task, max_in_flight
+        ),
+        "staging_songs": copy_local_files(
+            cur, conn, "staging_songs", STAGING_SONGS_FIELDS,
+            find_json_files(config.get('LOCAL', 'SONG_DATA')), STAGING_SONGS_FIELDS,
+            workers, files_per_task, max_in_flight
+        )
+    }
+
+    print("\nLocal staging data loading completed successfully!")
+
+    return stats
+
+
+def resolve_local_path(s3_url, config):
+    """
+    Map an S3 URL used by the Redshift COPY statements to a local path.
+
+    The S3 paths in [S3] map to their [LOCAL] counterparts; any other URL is
+    looked up under [LOCAL] S3_MIRROR as <mirror>/<bucket>/<key>.
+
+    Args:
+        s3_url: s3:// URL
+        config: Configuration parser
+
+    Returns:
+        str: Local file or directory
+    """
+    for key in ('LOG_DATA', 'SONG_DATA', 'LOG_JSONPATH'):
+        if s3_url.rstrip('/') == config.get('S3', key, fallback='').rstrip('/'):
+            local_path = config.get('LOCAL', key, fallback='').strip()
+            if local_path:
+                return local_path
+
+    mirror = config.get('LOCAL', 'S3_MIRROR', fallback='').strip()
+    if not mirror:
+        raise ValueError(f"No local path configured for {s3_url} (set [LOCAL] S3_MIRROR)")
+
+    return os.path.join(mirror, s3_url[len("s3://"):])
+
+
+def copy_s3_query_locally(cur, conn, query, config):
+    """
+    Run a Redshift COPY ... FROM 's3://...' FORMAT AS JSON statement as a local load.
+
+    Args:
+        cur: Database cursor
+        conn: Database connection
+        query: Redshift COPY statement
+        config: Configuration parser with the [S3] and [LOCAL] settings
+
+    Returns:
+        dict: Load statistics (files, rows, bytes, seconds)
+    """
+    match = S3_COPY_PARTS.search(query)
+    if not match:
+        raise ValueError("Only COPY ... FROM 's3://...' FORMAT AS JSON statements can be run locally")
+    if re.search(r"\bMANIFEST\b", query, re.IGNORECASE):
+        raise ValueError("COPY with MANIFEST cannot be run locally")
+
+    table = match.group("table").lower()
+    if table not in STAGING_TABLE_COLUMNS:
+        raise ValueError(f"No local column mapping for table {table}")
+
+    columns = STAGING_TABLE_COLUMNS[table]
+    jsonpaths = match.group("jsonpaths")
+    fields = columns if jsonpaths.lower() == "auto" else load_jsonpaths(resolve_local_path(jsonpaths, config))
+
+    return copy_local_files(
+        cur, conn, table, columns,
+        find_json_files(resolve_local_path(match.group("source"), config)), fields,
+        config.getint('LOCAL', 'WORKERS', fallback=0) or None,
+        config.getint('LOCAL', 'FILES_PER_TASK', fallback=64),
+        config.getint('LOCAL', 'MAX_IN_FLIGHT', fallback=0) or None
+    )
@@ -0,0 +1,247 @@
+"""
+Threshold-driven VACUUM / ANALYZE maintenance for the Sparkify Data Warehouse.
+
+Inserts append to the star-schema tables, so their unsorted region grows and
+their planner statistics go stale. This stage reads the state of each table
+and only maintains the ones past the [MAINTENANCE] thresholds:
+
+    deleted_pct   share of rows marked for deletion   -> VACUUM DELETE ONLY
+    unsorted_pct  share of unsorted rows               -> VACUUM SORT ONLY
+    stats_off_pct staleness of the table statistics    -> ANALYZE
+
+On Redshift the state comes from SVV_TABLE_INFO. On PostgreSQL it comes from
+pg_stat_user_tables, where dead tuples are vacuumed and there is no sort
+order to maintain.
+
+The tables furthest past their thresholds go first. No new command starts
+once the time budget is spent, but a command that is running is not
+interrupted. VACUUM cannot run inside a transaction block, so the commands
+run in autocommit mode.
+
+Usage:
+    python maintenance.py               # maintain the tables past their thresholds
+    python maintenance.py --dry-run     # only print the plan
+    python maintenance.py --budget 300
+"""
+import argparse
+import time
+import metrics
+from dialects import POSTGRES, REDSHIFT, get_dialect
+from utils import get_config, get_connection_pool, close_connection_pool, execute_query
+
+
+MAINTAINED_TABLES = ("songplays", "users", "songs", "artists", "time")
+
+# Rows, visible rows, unsorted % and stats_off % of each table, per dialect
+TABLE_INFO_QUERIES = {
+    REDSHIFT: """
+        SELECT "table", tbl_rows, COALESCE(estimated_visible_rows, tbl_rows), unsorted, stats_off
+        FROM svv_table_info
+        WHERE "table" IN %s
+    """,
+    POSTGRES: """
+        SELECT relname, n_live_tup + n_dead_tup, n_live_tup, NULL,
+               CASE WHEN n_live_tup > 0 THEN LEAST(100.0 * n_mod_since_analyze / n_live_tup, 100) ELSE 0 END
+        FROM pg_stat_user_tables
+        WHERE relname IN %s
+    """
+}
+
+# Command run for each action, per dialect, in the order actions are applied to a table
+MAINTENANCE_COMMANDS = {
+    REDSHIFT: {
+        "delete": "VACUUM DELETE ONLY {}",
+        "sort": "VACUUM SORT ONLY {}",
+        "analyze": "ANALYZE {}"
+    },
+    POSTGRES: {
+        "delete": "VACUUM {}",
+        "analyze": "ANALYZE {}"
+    }
+}
+
+# Threshold setting and table-info field behind each action
+ACTION_THRESHOLDS = {
+    "delete": ("DELETED_PCT", "deleted"),
+    "sort": ("UNSORTED_PCT", "unsorted"),
+    "analyze": ("STATS_OFF_PCT", "stats_off")
+}
+
+
+def get_thresholds(config):
+    """
+    Read the threshold of each action from [MAINTENANCE], in percent.
+    """
+    return {
+        action: config.getfloat('MAINTENANCE', setting, fallback=10.0)
+        for action, (setting, _) in ACTION_THRESHOLDS.items()
+    }
+
+
+def get_table_info(cur, dialect):
+    """
+    Read the rows, deleted, unsorted and stats_off percentages of the maintained tables.
+
+    Args:
+        cur: Database cursor
+        dialect: SQL dialect of the connection
+
+    Returns:
+        dict: Mapping of table name to {"rows", "deleted", "unsorted", "stats_off"}
+    """
+    cur.execute(TABLE_INFO_QUERIES[dialect], (MAINTAINED_TABLES,))
+
+    info = {}
+    for table, rows, visible_rows, unsorted, stats_off in cur.fetchall():
+        rows = int(rows or 0)
+        info[table] = {
+            "rows": rows,
+            "deleted": 100.0 * (rows - int(visible_rows or 0)) / rows if rows else 0.0,
+            "unsorted": float(unsorted) if unsorted is not None else None,
+            "stats_off": float(stats_off or 0)
+        }
+    return info
+
+
+def plan_maintenance(info, thresholds, dialect):
+    """
+    Choose the commands to run, the tables furthest past their thresholds first.
+
+    Args:
+        info: Output of get_table_info
+        thresholds: Threshold of each action, in percent
+        dialect: SQL dialect of the connection
+
+    Returns:
+        list: (table, action, command) tuples in execution order
+    """
+    commands = MAINTENANCE_COMMANDS[dialect]
+    tables = []
+
+    for table, state in info.items():
+        actions = []
+        excess = 0.0
+        for action in commands:
+            value = state[ACTION_THRESHOLDS[action][1]]
+            if value is not None and value > thresholds[action]:
+                actions.append(action)
+                excess = max(excess, value - thresholds[action])
+        if actions:
+            tables.append((excess, table, actions))
+
+    return [
+        (table, action, commands[action].format(table))
+        for _, table, actions in sorted(tables, key=lambda item: item[0], reverse=True)
+        for action in actions
+    ]
+
+
+def format_percent(value):
+    """
+    Format a percentage, or "-" when it does not apply.
+    """
+    return f"{value:.1f}%" if value is not None else "-"
+
+
+def print_report(before, after, done, skipped):
+    """
+    Print the state of each table before and after maintenance.
+    """
+    print("\n" + "=" * 80)
+    print("TABLE MAINTENANCE REPORT")
+    print("=" * 80)
+    print(f"{'Table':<10} {'Rows':>12} {'Deleted':>15} {'Unsorted':>15} {'Stats off':>15}  Actions")
+
+    for table in MAINTAINED_TABLES:
+        if table not in before:
+            continue
+        cells = []
+        for field in ("deleted", "unsorted", "stats_off"):
+            cells.append(f"{format_percent(before[table][field])} -> {format_percent(after.get(table, {}).get(field))}")
+        actions = ", ".join(
+            [f"{action} ({seconds:.1f} s)" for name, action, seconds in done if name == table]
+            + [f"{action} (skipped)" for name, action, _ in skipped if name == table]
+        ) or "none"
+        print(f"{table:<10} {before[table]['rows']:>12,} {cells[0]:>15} {cells[1]:>15} {cells[2]:>15}  {actions}")
+
+    if skipped:
+        print(f"\n{len(skipped)} command(s) skipped: time budget exhausted")
+
+
+def run_maintenance(cur, conn, config, budget=None, dry_run=False):
+    """
+    VACUUM and ANALYZE the star-schema tables that are past their thresholds.
+
+    Args:
+        cur: Database cursor
+        conn: Database connection (no transaction may be open)
+        config: Configuration parser with the [MAINTENANCE] settings
+        budget: Time budget in seconds (defaults to [MAINTENANCE] TIME_BUDGET, 0 = unlimited)
+        dry_run: Only print the plan
+
+    Returns:
+        list: (table, action, seconds) of the commands that ran
+    """
+    print("\n" + "=" * 80)
+    print("TABLE MAINTENANCE")
+    print("=" * 80)
+
+    metrics.set_stage("maintenance")
+
+    dialect = get_dialect(config)
+    budget = config.getfloat('MAINTENANCE', 'TIME_BUDGET', fallback=600) if budget is None else budget
+    start_time = time.time()
+
+    before = get_table_info(cur, dialect)
+    conn.commit()
+    plan = plan_maintenance(before, get_thresholds(config), dialect)
+
+    if not plan:
+        print("Every table is within its thresholds. Nothing to do.")
+        print_report(before, before, [], [])
+        return []
+
+    print(f"{len(plan)} command(s) planned" + (f" within a {budget:.0f} s budget:" if budget else ":"))
+    for _, _, command in plan:
+        print(f"  {command}")
+
+    if dry_run:
+        return []
+
+    done, skipped = [], []
+    conn.autocommit = True
+    try:
+        for table, action, command in plan:
+            if budget and time.time() - start_time >= budget:
+                skipped.append((table, action, None))
+                continue
+            done.append((table, action, execute_query(cur, conn, command, f"{action.upper()} {table}")))
+
+        after = get_table_info(cur, dialect)
+    finally:
+        conn.autocommit = False
+
+    print_report(before, after, done, skipped)
+
+    return done
+
+
+def main():
+    parser = argparse.ArgumentParser(description="VACUUM and ANALYZE the Sparkify tables past their thresholds")
+    parser.add_argument("--budget", type=float, help="Time budget in seconds (0 = unlimited)")
+    parser.add_argument("--dry-run", action="store_true", help="Only print the planned commands")
+    args = parser.parse_args()
+
+    config = get_config()
+    metrics.configure(config)
+
+    try:
+        with get_connection_pool(config).connection() as (conn, cur):
+            run_maintenance(cur, conn, config, args.budget, args.dry_run)
+    finally:
+        close_connection_pool()
+        metrics.export(config)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,262 @@
+"""
+Per-statement metrics for the Sparkify Data Warehouse.
+
+utils.execute_query records one entry per statement: stage, statement name,
+wall time and rows affected, plus the query id and the rows/bytes scanned
+on Redshift. Entries can be exported as JSON lines and as a Prometheus
+textfile (for the node_exporter textfile collector).
+"""
+import json
+import os
+import threading
+import time
+import uuid
+
+
+SCAN_STATS_QUERY = """
+    SELECT COALESCE(SUM(rows), 0), COALESCE(SUM(bytes), 0)
+    FROM svl_query_summary
+    WHERE query = %s
+    AND label LIKE 'scan%%'
+"""
+
+LOAD_STATS_QUERY = """
+    SELECT COALESCE(SUM(lines_scanned), 0), COUNT(DISTINCT filename)
+    FROM stl_load_commits
+    WHERE query = %s
+"""
+
+PROMETHEUS_METRICS = [
+    ("seconds", "sparkify_statement_duration_seconds", "Wall time of the statement in seconds"),
+    ("rows", "sparkify_statement_rows", "Rows affected by the statement"),
+    ("rows_scanned", "sparkify_statement_scanned_rows", "Rows scanned by the statement on Redshift"),
+    ("bytes_scanned", "sparkify_statement_scanned_bytes", "Bytes scanned by the statement on Redshift"),
+    ("success", "sparkify_statement_success", "1 if the statement succeeded, 0 otherwise")
+]
+
+_lock = threading.Lock()
+_records = []
+_stage = None
+_stage_started = time.time()
+_run_id = uuid.uuid4().hex[:12]
+_redshift_details = False
+
+
+def configure(config):
+    """
+    Read the [METRICS] settings.
+
+    Args:
+        config: Configuration parser
+    """
+    global _redshift_details
+    _redshift_details = config.getboolean('METRICS', 'REDSHIFT_DETAILS', fallback=False)
+
+
+def set_stage(stage):
+    """
+    Set the pipeline stage attached to the statements recorded from now on.
+
+    Args:
+        stage: Stage name (e.g. "staging", "inserts")
+    """
+    global _stage, _stage_started
+    _stage = stage
+    _stage_started = time.time()
+
+
+def get_stage():
+    """
+    Return the current pipeline stage.
+    """
+    return _stage
+
+
+def get_stage_elapsed():
+    """
+    Return the seconds since the current stage was set.
+    """
+    return time.time() - _stage_started
+
+
+def get_run_id():
+    """
+    Return the identifier shared by every record of this process.
+    """
+    return _run_id
+
+
+def fetch_redshift_stats(cursor, is_copy=False):
+    """
+    Look up the query id and scan statistics of the last statement run on a Redshift cursor.
+
+    Args:
+        cursor: Cursor that ran the statement
+        is_copy: Whether the statement was a COPY (stats come from STL_LOAD_COMMITS)
+
+    Returns:
+        dict: query_id, rows_scanned, bytes_scanned and, for COPY, files_loaded
+    """
+    cursor.execute("SELECT PG_LAST_COPY_ID()" if is_copy else "SELECT PG_LAST_QUERY_ID()")
+    query_id = cursor.fetchone()[0]
+    stats = {"query_id": query_id}
+
+    if is_copy:
+        cursor.execute(LOAD_STATS_QUERY, (query_id,))
+        stats["rows_scanned"], stats["files_loaded"] = cursor.fetchone()
+    else:
+        cursor.execute(SCAN_STATS_QUERY, (query_id,))
+        stats["rows_scanned"], stats["bytes_scanned"] = cursor.fetchone()
+
+    cursor.connection.commit()
+    return stats
+
+
+def record_statement(cursor, statement, seconds, rows=None, success=True, query=None):
+    """
+    Record the metrics of one statement.
+
+    On Redshift connections, the query id and scan statistics are added when
+    [METRICS] REDSHIFT_DETAILS is enabled, except inside a batched transaction
+    (see utils.transaction): Redshift has no savepoints, so a failed lookup
+    would abort the transaction and fail the next statement of the stage.
+
+    Args:
+        cursor: Cursor that ran the statement (may be None)
+        statement: Statement name
+        seconds: Wall time in seconds
+        rows: Rows affected (cursor.rowcount), if known
+        success: Whether the statement succeeded
+        query: SQL text, used to recognise COPY statements
+
+    Returns:
+        dict: The recorded entry
+    """
+    record = {
+        "run_id": _run_id,
+        "timestamp": time.time(),
+        "stage": _stage,
+        "statement": statement,
+        "seconds": round(seconds, 4),
+        "rows": rows if rows is not None and rows >= 0 else None,
+        "success": success
+    }
+
+    if success and _redshift_details and cursor is not None \
+            and getattr(cursor.connection, 'dialect', 'redshift') == 'redshift' \
+            and getattr(cursor.connection, 'transaction_batch', None) is None:
+        try:
+            is_copy = bool(query) and query.lstrip().upper().startswith("COPY")
+            record.update(fetch_redshift_stats(cursor, is_copy))
+        except Exception as e:
+            print(f"Could not read Redshift statistics for {statement}: {e}")
+            cursor.connection.rollback()
+
+    with _lock:
+        _records.append(record)
+
+    return record
+
+
+def get_records():
+    """
+    Return a copy of the recorded entries.
+    """
+    with _lock:
+        return list(_records)
+
+
+def clear():
+    """
+    Forget every recorded entry.
+    """
+    with _lock:
+        _records.clear()
+
+
+def write_jsonl(path, records=None):
+    """
+    Append records to a JSON lines file.
+
+    Args:
+        path: Output file
+        records: Entries to write (defaults to everything recorded)
+    """
+    records = get_records() if records is None else records
+    with open(path, "a") as f:
+        for record in records:
+            f.write(json.dumps(record, default=str) + "\n")
+
+
+def _escape_label(value):
+    """
+    Escape a Prometheus label value.
+    """
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def format_prometheus(records):
+    """
+    Render records in the Prometheus text exposition format.
+
+    When a statement ran several times, its last run wins.
+
+    Args:
+        records: Recorded entries
+
+    Returns:
+        str: Textfile contents
+    """
+    latest = {}
+    for record in records:
+        latest[(record["stage"], record["statement"])] = record
+
+    lines = []
+    for field, name, help_text in PROMETHEUS_METRICS:
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} gauge")
+        for (stage, statement), record in latest.items():
+            value = record.get(field)
+            if value is None:
+                continue
+            labels = f'stage="{_escape_label(stage or "")}",statement="{_escape_label(statement)}"'
+            lines.append(f"{name}{{{labels}}} {float(value)!r}")
+
+    return "\n".join(lines) + "\n"
+
+
+def write_prometheus_textfile(path, records=None):
+    """
+    Write records as a Prometheus textfile, replacing the file atomically.
+
+    Args:
+        path: Output file (should end in .prom for the textfile collector)
+        records: Entries to write (defaults to everything recorded)
+    """
+    records = get_records() if records is None else records
+    temp_path = f"{path}.{os.getpid()}.tmp"
+    with open(temp_path, "w") as f:
+        f.write(format_prometheus(records))
+    os.replace(temp_path, path)
+
+
+def export(config):
+    """
+    Write the recorded entries to the outputs configured in [METRICS].
+
+    Args:
+        config: Configuration parser
+    """
+    records = get_records()
+    if not records:
+        return
+
+    jsonl_path = config.get('METRICS', 'JSONL_PATH', fallback='').strip()
+    if jsonl_path:
+        write_jsonl(jsonl_path, records)
+        print(f"Metrics appended to {jsonl_path}")
+
+    prometheus_path = config.get('METRICS', 'PROMETHEUS_PATH', fallback='').strip()
+    if prometheus_path:
+        write_prometheus_textfile(prometheus_path, records)
+        print(f"Prometheus metrics written to {prometheus_path}")
@@ -0,0 +1,312 @@
+"""
+Slice-aware input preparation for the Sparkify Data Warehouse.
+
+Redshift COPY loads files in parallel, one per slice at a time, so thousands
+of tiny JSON files leave most slices idle between files. This stage rewrites
+the raw song_data and log_data JSON files (read from the [LOCAL] directories,
+e.g. synced with `aws s3 sync`) as a multiple of the cluster's slice count of
+evenly sized, compressed newline-delimited JSON chunks. The chunks are
+uploaded under [PREPARE] PREFIX together with one COPY manifest per staging
+table, and etl.py loads them with COMPUPDATE OFF STATUPDATE OFF when
+[ETL] PREPARED_INPUTS is enabled.
+
+The number of slices is read from STV_SLICES, or derived from the node
+settings used by manage_cluster.py (REDSHIFT_NODE_TYPE, REDSHIFT_NUM_NODES)
+when the cluster cannot be queried.
+
+Usage:
+    python prepare_inputs.py                    # split, compress and upload
+    python prepare_inputs.py --no-upload        # only write the chunks locally
+    python prepare_inputs.py --chunks 16 --compression bzip2
+"""
+import argparse
+import bz2
+import gzip
+import heapq
+import json
+import os
+import time
+import metrics
+from incremental import create_s3_client, parse_s3_url, write_manifest
+from local_ingest import find_json_files, iter_json_objects
+from sql_queries import staging_events_prepared_copy, staging_songs_prepared_copy
+from utils import get_config, get_connection_pool, close_connection_pool
+
+
+# COPY keyword, file suffix and opener of each supported compression
+COMPRESSIONS = {
+    "gzip": ("GZIP", ".gz", gzip.open),
+    "bzip2": ("BZIP2", ".bz2", bz2.open)
+}
+
+# Slices per node of each Redshift node type
+SLICES_PER_NODE = {
+    "dc2.large": 2,
+    "dc2.8xlarge": 16,
+    "ds2.xlarge": 2,
+    "ds2.8xlarge": 16,
+    "ra3.xlplus": 2,
+    "ra3.4xlarge": 4,
+    "ra3.16xlarge": 16
+}
+
+# Prepared inputs of each staging table: (local directory setting, chunk name)
+PREPARED_TABLES = {
+    "staging_events": ("LOG_DATA", "events"),
+    "staging_songs": ("SONG_DATA", "songs")
+}
+
+SELECT_SLICE_COUNT = "SELECT COUNT(*) FROM stv_slices"
+
+
+def get_node_slice_count(node_type=None, num_nodes=None, cluster_type=None):
+    """
+    Derive the slice count from the node settings of manage_cluster.py.
+
+    Missing values are read from the same environment variables and defaults
+    as manage_cluster.setup_redshift_cluster.
+
+    Args:
+        node_type: Redshift node type (e.g. dc2.large)
+        num_nodes: Number of compute nodes
+        cluster_type: single-node or multi-node
+
+    Returns:
+        int: Number of slices
+    """
+    node_type = node_type or os.getenv('REDSHIFT_NODE_TYPE') or 'dc2.large'
+    cluster_type = cluster_type or os.getenv('REDSHIFT_CLUSTER_TYPE') or 'multi-node'
+    num_nodes = 1 if cluster_type == 'single-node' else int(num_nodes or os.getenv('REDSHIFT_NUM_NODES') or 4)
+
+    if node_type not in SLICES_PER_NODE:
+        raise ValueError(f"Unknown node type '{node_type}', expected one of {', '.join(SLICES_PER_NODE)}")
+
+    return SLICES_PER_NODE[node_type] * num_nodes
+
+
+def get_slice_count(config):
+    """
+    Return the slice count of the cluster.
+
+    [PREPARE] SLICES wins when set. Otherwise STV_SLICES is queried, falling
+    back to the node settings when the cluster is unreachable or is not
+    Redshift.
+
+    Args:
+        config: Configuration parser
+
+    Returns:
+        int: Number of slices
+    """
+    slices = config.getint('PREPARE', 'SLICES', fallback=0)
+    if slices > 0:
+        return slices
+
+    try:
+        with get_connection_pool(config).connection() as (conn, cur):
+            cur.execute(SELECT_SLICE_COUNT)
+            slices = cur.fetchone()[0]
+            conn.commit()
+        print(f"Cluster has {slices} slices (STV_SLICES)")
+        return slices
+    except Exception as e:
+        slices = get_node_slice_count()
+        print(f"Could not query STV_SLICES ({e}); using {slices} slices from the node settings")
+        return slices
+    finally:
+        close_connection_pool()
+
+
+def split_json_files(files, output_dir, name, chunks, compression="gzip"):
+    """
+    Rewrite JSON files as evenly sized, compressed newline-delimited JSON chunks.
+
+    Every object goes to the chunk with the fewest bytes written so far, so
+    the chunks differ by at most one object in uncompressed size.
+
+    Args:
+        files: Input JSON files (one object or newline-delimited objects each)
+        output_dir: Directory receiving the chunks
+        name: Chunk name prefix (e.g. "events")
+        chunks: Number of chunks to write
+        compression: "gzip" or "bzip2"
+
+    Returns:
+        dict: paths of the chunks, files_in, bytes_in, records, files_out and bytes_out
+    """
+    if compression not in COMPRESSIONS:
+        raise ValueError(f"Unknown compression '{compression}', expected one of {', '.join(COMPRESSIONS)}")
+    if chunks < 1:
+        raise ValueError("At least one chunk is required")
+
+    _, suffix, opener = COMPRESSIONS[compression]
+    os.makedirs(output_dir, exist_ok=True)
+    paths = [os.path.join(output_dir, f"{name}-{i:04d}.json{suffix}") for i in range(chunks)]
+
+    bytes_in = 0
+    records = 0
+    sizes = [(0, i) for i in range(chunks)]
+    outputs = [opener(path, "wb") for path in paths]
+
+    try:
+        for path in files:
+            with open(path, "rb") as f:
+                data = f.read()
+            bytes_in += len(data)
+
+            for obj in iter_json_objects(data.decode("utf-8")):
+                line = (json.dumps(obj, separators=(",", ":")) + "\n").encode("utf-8")
+                size, i = heapq.heappop(sizes)
+                outputs[i].write(line)
+                heapq.heappush(sizes, (size + len(line), i))
+                records += 1
+    finally:
+        for output in outputs:
+            output.close()
+
+    return {
+        "paths": paths,
+        "files_in": len(files),
+        "bytes_in": bytes_in,
+        "records": records,
+        "files_out": len(paths),
+        "bytes_out": sum(os.path.getsize(path) for path in paths)
+    }
+
+
+def upload_chunks(s3, paths, prefix, name):
+    """
+    Upload the chunks of a table and write the COPY manifest listing them.
+
+    Args:
+        s3: S3 client
+        paths: Local chunk files
+        prefix: s3:// prefix receiving the chunks
+        name: Chunk name prefix (e.g. "events")
+
+    Returns:
+        str: s3:// URL of the manifest
+    """
+    bucket, key_prefix = parse_s3_url(prefix.rstrip('/'))
+    urls = []
+    for path in paths:
+        key = f"{key_prefix}/{name}/{os.path.basename(path)}"
+        s3.upload_file(path, bucket, key)
+        urls.append(f"s3://{bucket}/{key}")
+
+    return write_manifest(s3, urls, get_manifest_url(prefix, name))
+
+
+def get_manifest_url(prefix, name):
+    """
+    Return the URL of the manifest of a table's prepared chunks.
+    """
+    return f"{prefix.rstrip('/')}/{name}.manifest"
+
+
+def get_prepared_copy_queries(config):
+    """
+    Build the COPY statements that load the prepared chunks into staging.
+
+    Args:
+        config: Configuration parser with the [PREPARE] settings
+
+    Returns:
+        list: COPY statements for staging_events and staging_songs
+    """
+    prefix = config.get('PREPARE', 'PREFIX')
+    keyword = COMPRESSIONS[config.get('PREPARE', 'COMPRESSION', fallback='gzip')][0]
+
+    return [
+        staging_events_prepared_copy.format(get_manifest_url(prefix, "events"), keyword),
+        staging_songs_prepared_copy.format(get_manifest_url(prefix, "songs"), keyword)
+    ]
+
+
+def format_bytes(size):
+    """
+    Format a byte count in MB.
+    """
+    return f"{size / 1048576:,.1f} MB"
+
+
+def print_statistics(stats):
+    """
+    Print the bytes and files read and written for each table.
+    """
+    print("\n" + "=" * 80)
+    print("INPUT PREPARATION SUMMARY")
+    print("=" * 80)
+    print(f"{'Table':<16} {'Files in':>10} {'Bytes in':>14} {'Records':>12} {'Files out':>10} {'Bytes out':>14} {'Ratio':>7}")
+
+    for table, item in stats.items():
+        ratio = f"{item['bytes_in'] / item['bytes_out']:.1f}x" if item["bytes_out"] else "-"
+        print(f"{table:<16} {item['files_in']:>10,} {format_bytes(item['bytes_in']):>14} {item['records']:>12,} "
+              f"{item['files_out']:>10,} {format_bytes(item['bytes_out']):>14} {ratio:>7}")
+
+
+def prepare_inputs(config, chunks=None, compression=None, output_dir=None, upload=True):
+    """
+    Split, compress and upload the song and log files for COPY.
+
+    Args:
+        config: Configuration parser
+        chunks: Number of chunks per table (defaults to the slice count times [PREPARE] CHUNKS_PER_SLICE)
+        compression: "gzip" or "bzip2" (defaults to [PREPARE] COMPRESSION)
+        output_dir: Local directory of the chunks (defaults to [PREPARE] OUTPUT_DIR)
+        upload: Upload the chunks and manifests under [PREPARE] PREFIX
+
+    Returns:
+        dict: Statistics per staging table
+    """
+    print("\n" + "=" * 80)
+    print("PREPARING INPUTS FOR COPY")
+    print("=" * 80)
+
+    metrics.set_stage("prepare")
+
+    compression = compression or config.get('PREPARE', 'COMPRESSION', fallback='gzip')
+    output_dir = output_dir or config.get('PREPARE', 'OUTPUT_DIR', fallback='prepared')
+    if not chunks:
+        chunks = get_slice_count(config) * config.getint('PREPARE', 'CHUNKS_PER_SLICE', fallback=1)
+    print(f"Writing {chunks} {compression} chunks per table to {output_dir}")
+
+    s3 = create_s3_client() if upload else None
+    stats = {}
+
+    for table, (setting, name) in PREPARED_TABLES.items():
+        start_time = time.time()
+        files = find_json_files(config.get('LOCAL', setting))
+        print(f"\nSplitting {len(files)} files into {name} chunks...")
+        stats[table] = split_json_files(files, os.path.join(output_dir, name), name, chunks, compression)
+        metrics.record_statement(None, f"Splitting {table}", time.time() - start_time, stats[table]["records"])
+
+        if upload:
+            start_time = time.time()
+            upload_chunks(s3, stats[table]["paths"], config.get('PREPARE', 'PREFIX'), name)
+            metrics.record_statement(None, f"Uploading {table}", time.time() - start_time, stats[table]["files_out"])
+
+    print_statistics(stats)
+
+    return stats
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Split, compress and upload the Sparkify inputs for COPY")
+    parser.add_argument("--chunks", type=int, help="Chunks per table (defaults to a multiple of the slice count)")
+    parser.add_argument("--compression", choices=sorted(COMPRESSIONS), help="Chunk compression")
+    parser.add_argument("--output-dir", help="Local directory of the chunks")
+    parser.add_argument("--no-upload", action="store_true", help="Only write the chunks locally")
+    args = parser.parse_args()
+
+    config = get_config()
+    metrics.configure(config)
+
+    try:
+        prepare_inputs(config, args.chunks, args.compression, args.output_dir, not args.no_upload)
+    finally:
+        metrics.export(config)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,39 +1,314 @@
-import pandas as pd
-from sql_queries import analytics_queries
+import sys
+import threading
+import time
+import uuid
+import psycopg2
+import metrics
+from concurrent.futures import ThreadPoolExecutor
+from analytics_cache import get_result_cache
+from run_history import save_run
+from sql_queries import analytics_queries, aggregate_analytics_queries, select_aggregates_fresh
 from utils import (
-    connect_to_redshift,
-    format_query_results
+    get_config,
+    get_connection_pool,
+    close_connection_pool,
+    format_result_table,
+    format_row,
+    get_statement_timeout,
+    retry_transient,
+    statement_watchdog
 )
 
 
-def execute_analytics_queries(conn, cur):
+def fetch_analytics_result(conn, cur, query_name, query):
     """
-    Executes predefined analytical queries.
+    Executes a single analytical query and returns its raw result.
+    
+    With a [TIMEOUTS] section, the query is cancelled past its timeout (keyed
+    by query_name) and retried on transient errors.
+    
+    Args:
+        conn: Database connection
+        cur: Database cursor
+        query_name: Descriptive name used in progress messages
+        query: SQL query to run
+        
+    Returns:
+        tuple: (list of column names, list of rows)
+    """
+    def fetch():
+        print(f"Executing query: {query_name}...")
+        start_time = time.time()
+        try:
+            timeout = get_statement_timeout(getattr(conn, 'config', None), query, query_name)
+            with statement_watchdog(conn, timeout, query_name):
+                cur.execute(query)
+                rows = cur.fetchall()
+                columns = [column[0] for column in cur.description]
+                conn.commit()
+        except Exception:
+            conn.rollback()
+            metrics.record_statement(None, query_name, time.time() - start_time, success=False)
+            raise
+        metrics.record_statement(cur, query_name, time.time() - start_time, len(rows), query=query)
+        
+        return columns, rows
+    
+    return retry_transient(conn, query_name, fetch)
+
+
+def aggregates_are_fresh(conn, cur):
+    """
+    Checks whether the aggregate tables reflect every row currently in songplays.
     
     Args:
         conn: Database connection
         cur: Database cursor
         
     Returns:
-        list: List of formatted results
+        bool: True if the aggregate tables can replace the raw queries
+    """
+    try:
+        cur.execute(select_aggregates_fresh)
+        fresh = bool(cur.fetchone()[0])
+        conn.commit()
+        return fresh
+    except psycopg2.Error:
+        # Aggregate tables have not been created yet
+        conn.rollback()
+        return False
+
+
+def make_aggregate_router():
+    """
+    Builds a function that routes queries to the aggregate tables when they are fresh.
+    
+    Freshness is checked once, on the first query that has an aggregate
+    replacement, and reused for the rest of the run.
+    
+    Returns:
+        callable: route(conn, cur, query_name, query) -> query to execute
+    """
+    lock = threading.Lock()
+    freshness = {}
+    
+    def route(conn, cur, query_name, query):
+        if query_name not in aggregate_analytics_queries:
+            return query
+        
+        with lock:
+            if "fresh" not in freshness:
+                freshness["fresh"] = aggregates_are_fresh(conn, cur)
+                if not freshness["fresh"]:
+                    print("Aggregate tables are stale, using the raw queries")
+        
+        if freshness["fresh"]:
+            print(f"Using aggregate table for: {query_name}")
+            return aggregate_analytics_queries[query_name]
+        return query
+    
+    return route
+
+
+def _run_pooled_analytics_query(pool, query_name, query, cache=None, route=None):
+    """
+    Runs an analytical query on a connection borrowed from the pool.
+    
+    When a route is given, it may replace the query by an equivalent one
+    (e.g. on the aggregate tables) before it runs. When a cache is given, a
+    valid cached result of the query actually run is returned, and fresh
+    results are stored under it, so results of the aggregate tables are
+    never served to a run that reads the raw tables. A connection is only
+    borrowed to check the aggregate tables or to run the query.
+    
+    Returns:
+        tuple: (formatted result, latency in seconds)
+    """
+    start_time = time.time()
+    
+    if route is not None and query_name in aggregate_analytics_queries:
+        with pool.connection() as (conn, cur):
+            query = route(conn, cur, query_name, query)
+    
+    cached = cache.get(query) if cache is not None else None
+    if cached is not None:
+        print(f"Using cached result: {query_name}")
+        columns, rows = cached
+        return format_result_table(columns, rows, query_name), time.time() - start_time
+    
+    with pool.connection() as (conn, cur):
+        try:
+            columns, rows = fetch_analytics_result(conn, cur, query_name, query)
+        except Exception as e:
+            print(f"Error executing query '{query_name}': {e}")
+            conn.rollback()
+            return f"\n=== {query_name} ===\nERROR: {e}", time.time() - start_time
+    
+    if cache is not None:
+        cache.put(query, (columns, rows), query_name=query_name)
+    
+    return format_result_table(columns, rows, query_name), time.time() - start_time
+
+
+def execute_analytics_queries_concurrent(pool, max_workers=None, cache=None, route=None):
+    """
+    Executes predefined analytical queries concurrently on pooled connections.
+    
+    The queries are read-only and independent, so the suite takes about as
+    long as its slowest query. Results keep the order of analytics_queries.
+    
+    Args:
+        pool: Connection pool (see utils.get_connection_pool)
+        max_workers: Maximum number of queries running at the same time
+        cache: Optional QueryResultCache consulted before reaching the cluster
+        route: Optional function choosing the query to execute (see make_aggregate_router)
+        
+    Returns:
+        tuple: (list of formatted results, dict of latency in seconds per query)
     """
+    max_workers = max_workers or len(analytics_queries)
+    print(f"Running {len(analytics_queries)} queries with {max_workers} workers...")
+    
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {
+            query_name: executor.submit(_run_pooled_analytics_query, pool, query_name, query, cache, route)
+            for query_name, query in analytics_queries.items()
+        }
+    
     results = []
+    latencies = {}
+    for query_name, future in futures.items():
+        result, latencies[query_name] = future.result()
+        results.append(result)
+    
+    return results, latencies
+
+
+def print_latency_report(latencies, wall_time):
+    """
+    Prints the latency of each query, their sum and the wall-clock time.
+    
+    Args:
+        latencies: Mapping of query name to latency in seconds
+        wall_time: Elapsed time of the whole suite in seconds
+    """
+    print("\nQuery latencies:")
+    for query_name, latency in latencies.items():
+        print(f"  {query_name:<40} {latency:>10.2f} s")
+    print(f"  {'Sum of queries':<40} {sum(latencies.values()):>10.2f} s")
+    print(f"  {'Wall-clock time':<40} {wall_time:>10.2f} s")
+
+
+def stream_query_batches(conn, query, itersize=10000):
+    """
+    Runs a query on a server-side (named) cursor and yields its rows in batches.
+    
+    Only one batch is held in client memory at a time, however large the
+    result is.
+    
+    Args:
+        conn: Database connection
+        query: SQL query to run
+        itersize: Number of rows fetched from the server per round trip
+        
+    Yields:
+        tuple: (list of column names, list of rows)
+    """
+    cursor_name = f"analytics_{uuid.uuid4().hex}"
+    
+    try:
+        with conn.cursor(name=cursor_name) as cur:
+            cur.itersize = itersize
+            cur.execute(query)
+            
+            while True:
+                rows = cur.fetchmany(itersize)
+                if not rows:
+                    break
+                yield [column[0] for column in cur.description], rows
+        
+        # Close the transaction that holds the server-side cursor
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+
+
+def write_streamed_result(conn, query_name, query, out, itersize=10000):
+    """
+    Streams the result of a query to a text stream as it is fetched.
+    
+    Like fetch_analytics_result, the query is recorded in the metrics, cancelled
+    past its [TIMEOUTS] timeout and retried on transient errors. A query that
+    fails after rows were written is not retried, so no row is written twice.
+    
+    Args:
+        conn: Database connection
+        query_name: Descriptive name used as the section title
+        query: SQL query to run
+        out: Writable text stream
+        itersize: Number of rows fetched from the server per round trip
+        
+    Returns:
+        int: Number of rows written
+    """
+    def stream():
+        start_time = time.time()
+        row_count = 0
+        try:
+            timeout = get_statement_timeout(getattr(conn, 'config', None), query, query_name)
+            with statement_watchdog(conn, timeout, query_name):
+                for columns, rows in stream_query_batches(conn, query, itersize):
+                    if row_count == 0:
+                        out.write(f"\n=== {query_name} ===\n")
+                        out.write(format_row(columns) + "\n")
+                    out.writelines(format_row(row) + "\n" for row in rows)
+                    out.flush()
+                    row_count += len(rows)
+        except Exception as e:
+            metrics.record_statement(None, query_name, time.time() - start_time, row_count, success=False)
+            if row_count:
+                raise RuntimeError(f"{query_name} failed after {row_count} rows were written: {e}") from e
+            raise
+        metrics.record_statement(None, query_name, time.time() - start_time, row_count, query=query)
+        
+        return row_count
+    
+    row_count = retry_transient(conn, query_name, stream)
+    if row_count == 0:
+        out.write(f"\n=== {query_name} ===\n")
+    out.write(f"({row_count} rows)\n")
+    return row_count
+
+
+def execute_analytics_queries_streaming(conn, cur, out=sys.stdout, itersize=10000, route=None):
+    """
+    Executes predefined analytical queries, writing each result as it streams in.
+    
+    Args:
+        conn: Database connection
+        cur: Database cursor, used by the route to check the aggregate tables
+        out: Writable text stream for the formatted results
+        itersize: Number of rows fetched from the server per round trip
+        route: Optional function choosing the query to execute (see make_aggregate_router)
+        
+    Returns:
+        dict: Number of rows written per query (None when the query failed)
+    """
+    row_counts = {}
     
     for query_name, query in analytics_queries.items():
         try:
             print(f"Executing query: {query_name}...")
-            cur.execute(query)
-            rows = cur.fetchall()
-            
-            # Format results using utility function
-            formatted_result = format_query_results(cur, rows, query_name)
-            results.append(formatted_result)
+            query_to_run = route(conn, cur, query_name, query) if route is not None else query
+            row_counts[query_name] = write_streamed_result(conn, query_name, query_to_run, out, itersize)
             
         except Exception as e:
             print(f"Error executing query '{query_name}': {e}")
-            results.append(f"\n=== {query_name} ===\nERROR: {e}")
+            out.write(f"\n=== {query_name} ===\nERROR: {e}\n")
+            row_counts[query_name] = None
     
-    return results
+    return row_counts
 
 
 def run_analytics():
@@ -44,34 +319,65 @@ def run_analytics():
     print("SPARKIFY ANALYTICS")
     print("=" * 80)
     
-    conn = None
-    cur = None
+    config = get_config()
+    metrics.configure(config)
+    metrics.set_stage("analytics")
+    run_start = time.time()
+    success = False
     
     try:
-        # Connect to database
-        conn, cur = connect_to_redshift()
-        
-        # Execute analytical queries
-        results = execute_analytics_queries(conn, cur)
+        route = make_aggregate_router() if config.getboolean('ANALYTICS', 'USE_AGGREGATES', fallback=False) else None
         
-        # Display all results
-        for result in results:
-            print(result)
+        if config.getboolean('ANALYTICS', 'STREAMING', fallback=False):
+            # Streamed results are never held in memory, so they cannot be cached or run concurrently
+            if config.getboolean('CACHE', 'ENABLED', fallback=False):
+                raise ValueError("[ANALYTICS] STREAMING cannot be combined with [CACHE] ENABLED")
+            if config.getint('ANALYTICS', 'CONCURRENCY', fallback=1) > 1:
+                raise ValueError("[ANALYTICS] STREAMING runs the queries one at a time; set CONCURRENCY = 1")
+            
+            itersize = config.getint('ANALYTICS', 'ITERSIZE', fallback=10000)
+            output_path = config.get('ANALYTICS', 'OUTPUT', fallback='').strip()
+            
+            # Stream results to the output file (or stdout) as they are fetched
+            with get_connection_pool(config).connection() as (conn, cur):
+                if output_path:
+                    with open(output_path, 'w') as out:
+                        execute_analytics_queries_streaming(conn, cur, out, itersize, route)
+                    print(f"Results written to {output_path}")
+                else:
+                    execute_analytics_queries_streaming(conn, cur, sys.stdout, itersize, route)
+        else:
+            # Run the queries on pooled connections, serving repeats from the cache
+            start_time = time.time()
+            results, latencies = execute_analytics_queries_concurrent(
+                get_connection_pool(config),
+                config.getint('ANALYTICS', 'CONCURRENCY', fallback=1),
+                get_result_cache(config),
+                route
+            )
+            wall_time = time.time() - start_time
+            
+            # Display all results
+            for result in results:
+                print(result)
+            print_latency_report(latencies, wall_time)
             
         print("\n" + "=" * 80)
         print("ANALYTICS COMPLETED")
         print("=" * 80)
+        success = True
         
     except Exception as e:
         print(f"Error executing analytics: {e}")
         raise
     finally:
-        # Close connections directly
-        if cur:
-            cur.close()
-        if conn:
-            conn.close()
+        # Close pooled connections
+        close_connection_pool()
         print("Database connection closed.")
+        
+        # Export per-query metrics and save the run to the history
+        metrics.export(config)
+        save_run(config, "analytics", run_start, success)
 
 
 if __name__ == "__main__":
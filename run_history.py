@@ -0,0 +1,447 @@
+"""
+Run history for the Sparkify Data Warehouse.
+
+At the end of every etl.py and run_analytics.py run, the per-statement
+metrics (see metrics.py) are saved to a local SQLite database together with
+the run's outcome, duration and git commit. The history can then be compared
+against a rolling baseline to catch performance regressions:
+
+    compare      flag stages (or statements) of the latest run whose time per row
+                 is worse than the median of the previous runs by more than a threshold
+    trend        print the time of each stage (or statement) across the last runs
+    percentiles  print the p50/p90/p95/p99 duration of each stage (or statement)
+                 and of whole runs, e.g. to size scheduler windows and timeouts
+
+Usage:
+    python run_history.py compare --kind etl --baseline-runs 7 --threshold 0.2
+    python run_history.py trend --kind analytics --level statement --runs 10
+    python run_history.py percentiles --kind etl --runs 30 --output etl_percentiles.json
+"""
+import argparse
+import json
+import math
+import sqlite3
+import statistics
+import sys
+import time
+from contextlib import closing
+import metrics
+from utils import get_config, get_git_commit
+
+
+CREATE_RUNS_TABLE = """
+    CREATE TABLE IF NOT EXISTS runs (
+        run_id TEXT PRIMARY KEY,
+        kind TEXT NOT NULL,
+        started_at REAL NOT NULL,
+        seconds REAL NOT NULL,
+        success INTEGER NOT NULL,
+        git_commit TEXT
+    )
+"""
+
+CREATE_STATEMENTS_TABLE = """
+    CREATE TABLE IF NOT EXISTS run_statements (
+        run_id TEXT NOT NULL REFERENCES runs (run_id),
+        stage TEXT,
+        statement TEXT NOT NULL,
+        seconds REAL NOT NULL,
+        rows INTEGER,
+        success INTEGER NOT NULL
+    )
+"""
+
+CREATE_STATEMENTS_INDEX = """
+    CREATE INDEX IF NOT EXISTS run_statements_run_id_idx ON run_statements (run_id)
+"""
+
+LEVELS = ("stage", "statement")
+
+PERCENTILES = (50, 90, 95, 99)
+
+
+class RunHistory:
+    """
+    SQLite-backed history of pipeline runs and their per-statement timings.
+    """
+
+    def __init__(self, path):
+        """
+        Args:
+            path: SQLite file used to store the history
+        """
+        self.path = path
+
+        with closing(self._connect()) as db, db:
+            db.execute(CREATE_RUNS_TABLE)
+            db.execute(CREATE_STATEMENTS_TABLE)
+            db.execute(CREATE_STATEMENTS_INDEX)
+
+    def _connect(self):
+        """
+        Open a connection to the history file.
+        """
+        return sqlite3.connect(self.path, timeout=30)
+
+    def record_run(self, run_id, kind, started_at, seconds, success, records, git_commit=None):
+        """
+        Save a run and the metrics of its statements.
+
+        Args:
+            run_id: Identifier of the run
+            kind: Type of run ("etl" or "analytics")
+            started_at: Start time of the run (epoch seconds)
+            seconds: Total duration of the run
+            success: Whether the run completed
+            records: Statement records from metrics.get_records()
+            git_commit: Commit the run was made from
+        """
+        with closing(self._connect()) as db, db:
+            db.execute(
+                "INSERT OR REPLACE INTO runs (run_id, kind, started_at, seconds, success, git_commit) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                (run_id, kind, started_at, seconds, int(success), git_commit)
+            )
+            db.execute("DELETE FROM run_statements WHERE run_id = ?", (run_id,))
+            db.executemany(
+                "INSERT INTO run_statements (run_id, stage, statement, seconds, rows, success) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                [
+                    (run_id, record["stage"], record["statement"], record["seconds"],
+                     record["rows"], int(record["success"]))
+                    for record in records
+                ]
+            )
+
+    def get_runs(self, kind, limit, successful_only=True):
+        """
+        Return the most recent runs of a kind, oldest first.
+
+        Args:
+            kind: Type of run
+            limit: Maximum number of runs
+            successful_only: Skip failed runs
+
+        Returns:
+            list: (run_id, started_at, seconds, git_commit) tuples
+        """
+        with closing(self._connect()) as db:
+            rows = db.execute(
+                f"""
+                SELECT run_id, started_at, seconds, git_commit
+                FROM runs
+                WHERE kind = ?
+                {"AND success = 1" if successful_only else ""}
+                ORDER BY started_at DESC
+                LIMIT ?
+                """,
+                (kind, limit)
+            ).fetchall()
+        return rows[::-1]
+
+    def get_totals(self, run_ids, level="stage"):
+        """
+        Sum the time and rows of each stage or statement of a set of runs.
+
+        Args:
+            run_ids: Runs to summarise
+            level: "stage" or "statement"
+
+        Returns:
+            dict: Mapping of run_id to {unit: (seconds, rows)}
+        """
+        if level not in LEVELS:
+            raise ValueError(f"Unknown level '{level}', expected one of {', '.join(LEVELS)}")
+
+        unit = "COALESCE(stage, '')" if level == "stage" else "COALESCE(stage, '') || ': ' || statement"
+        totals = {run_id: {} for run_id in run_ids}
+        if not run_ids:
+            return totals
+
+        with closing(self._connect()) as db:
+            rows = db.execute(
+                f"""
+                SELECT run_id, {unit}, SUM(seconds), SUM(rows)
+                FROM run_statements
+                WHERE run_id IN ({", ".join("?" * len(run_ids))})
+                GROUP BY 1, 2
+                """,
+                list(run_ids)
+            ).fetchall()
+
+        for run_id, name, seconds, rows_count in rows:
+            totals[run_id][name] = (seconds, rows_count)
+        return totals
+
+
+def get_time_per_row(seconds, rows):
+    """
+    Return seconds per row, or the plain seconds when the row count is unknown.
+    """
+    return seconds / rows if rows else seconds
+
+
+def compare_latest_run(history, kind="etl", baseline_runs=7, threshold=0.2, min_seconds=1.0, level="stage"):
+    """
+    Compare the latest successful run with the median of the runs before it.
+
+    A unit regresses when its time per row exceeds the baseline by more than
+    threshold (0.2 = 20%). Units that took less than min_seconds in the latest
+    run are ignored to avoid flagging noise.
+
+    Args:
+        history: RunHistory
+        kind: Type of run
+        baseline_runs: Number of previous runs forming the baseline
+        threshold: Allowed relative slowdown
+        min_seconds: Minimum duration of a unit to be considered
+        level: "stage" or "statement"
+
+    Returns:
+        tuple: (latest run, list of comparison dicts), or (None, []) without history
+    """
+    runs = history.get_runs(kind, baseline_runs + 1)
+    if not runs:
+        return None, []
+
+    latest, baseline = runs[-1], runs[:-1]
+    totals = history.get_totals([run[0] for run in runs], level)
+
+    comparisons = []
+    for name, (seconds, rows) in sorted(totals[latest[0]].items()):
+        previous = [
+            get_time_per_row(*totals[run[0]][name]) for run in baseline if name in totals[run[0]]
+        ]
+        current = get_time_per_row(seconds, rows)
+        baseline_value = statistics.median(previous) if previous else None
+        change = current / baseline_value - 1 if baseline_value else None
+
+        comparisons.append({
+            "name": name,
+            "seconds": seconds,
+            "rows": rows,
+            "per_row": bool(rows),
+            "current": current,
+            "baseline": baseline_value,
+            "baseline_runs": len(previous),
+            "change": change,
+            "regressed": change is not None and change > threshold and seconds >= min_seconds
+        })
+
+    return latest, comparisons
+
+
+def format_time_per_row(value, per_row):
+    """
+    Format a time per row as microseconds per row, or seconds when there is no row count.
+    """
+    if value is None:
+        return "-"
+    return f"{value * 1e6:,.1f} us/row" if per_row else f"{value:.2f} s"
+
+
+def print_comparison(latest, comparisons, threshold):
+    """
+    Print the comparison of the latest run with its baseline.
+    """
+    print("\n" + "=" * 80)
+    print(f"RUN {latest[0]} ({time.strftime('%Y-%m-%d %H:%M', time.localtime(latest[1]))}, "
+          f"commit {latest[3] or 'unknown'}) VS BASELINE")
+    print("=" * 80)
+    print(f"{'Name':<40} {'Latest':>16} {'Baseline':>16} {'Change':>8}  Runs")
+
+    for item in comparisons:
+        change = f"{item['change']:+.0%}" if item["change"] is not None else "new"
+        flag = "  REGRESSION" if item["regressed"] else ""
+        print(f"{item['name'][:40]:<40} {format_time_per_row(item['current'], item['per_row']):>16} "
+              f"{format_time_per_row(item['baseline'], item['per_row']):>16} {change:>8}  "
+              f"{item['baseline_runs']:>4}{flag}")
+
+    regressions = [item["name"] for item in comparisons if item["regressed"]]
+    if regressions:
+        print(f"\n{len(regressions)} regression(s) beyond {threshold:.0%}: {', '.join(regressions)}")
+    else:
+        print(f"\nNo regression beyond {threshold:.0%}")
+
+
+def print_trend(history, kind="etl", runs=10, level="stage"):
+    """
+    Print the time of each stage or statement across the last runs.
+
+    Args:
+        history: RunHistory
+        kind: Type of run
+        runs: Number of runs shown
+        level: "stage" or "statement"
+    """
+    recent = history.get_runs(kind, runs)
+    if not recent:
+        print(f"No {kind} runs recorded yet")
+        return
+
+    totals = history.get_totals([run[0] for run in recent], level)
+    names = sorted({name for run_totals in totals.values() for name in run_totals})
+
+    print("\n" + "=" * 80)
+    print(f"{kind.upper()} {level.upper()} TREND (seconds, last {len(recent)} runs)")
+    print("=" * 80)
+    print(f"{'Name':<40}" + "".join(f"{time.strftime('%m-%d %H:%M', time.localtime(run[1])):>13}" for run in recent))
+
+    for name in names:
+        cells = []
+        for run in recent:
+            value = totals[run[0]].get(name)
+            cells.append(f"{value[0]:>13.2f}" if value else f"{'-':>13}")
+        print(f"{name[:40]:<40}" + "".join(cells))
+
+    print(f"{'Total':<40}" + "".join(f"{run[2]:>13.2f}" for run in recent))
+    print(f"{'Commit':<40}" + "".join(f"{run[3] or '-':>13}" for run in recent))
+
+
+def percentile(values, pct):
+    """
+    Return the nearest-rank percentile of a list of values.
+    """
+    ordered = sorted(values)
+    return ordered[max(1, math.ceil(pct / 100 * len(ordered))) - 1]
+
+
+def get_latency_percentiles(history, kind="etl", runs=30, level="stage"):
+    """
+    Compute the duration percentiles of each stage or statement over the last successful runs.
+
+    Args:
+        history: RunHistory
+        kind: Type of run
+        runs: Number of runs sampled
+        level: "stage" or "statement"
+
+    Returns:
+        dict: Mapping of unit ("Total" for whole runs) to its sample count, p50..p99 and max in seconds
+    """
+    recent = history.get_runs(kind, runs)
+    totals = history.get_totals([run[0] for run in recent], level)
+
+    samples = {}
+    for run in recent:
+        for name, (seconds, _) in totals[run[0]].items():
+            samples.setdefault(name, []).append(seconds)
+    if recent:
+        samples["Total"] = [run[2] for run in recent]
+
+    return {
+        name: {
+            "runs": len(values),
+            **{f"p{pct}": percentile(values, pct) for pct in PERCENTILES},
+            "max": max(values)
+        }
+        for name, values in sorted(samples.items())
+    }
+
+
+def print_percentiles(percentiles, kind="etl", level="stage"):
+    """
+    Print the duration percentiles computed by get_latency_percentiles.
+    """
+    if not percentiles:
+        print(f"No {kind} runs recorded yet")
+        return
+
+    columns = [f"p{pct}" for pct in PERCENTILES] + ["max"]
+
+    print("\n" + "=" * 80)
+    print(f"{kind.upper()} {level.upper()} LATENCY PERCENTILES (seconds, {percentiles['Total']['runs']} runs)")
+    print("=" * 80)
+    print(f"{'Name':<40} {'Runs':>5}" + "".join(f"{column:>9}" for column in columns))
+
+    for name, item in percentiles.items():
+        print(f"{name[:40]:<40} {item['runs']:>5}" + "".join(f"{item[column]:>9.2f}" for column in columns))
+
+
+def get_run_history(config):
+    """
+    Create the run history from the [HISTORY] section of dwh.cfg.
+
+    Args:
+        config: Configuration parser
+
+    Returns:
+        RunHistory: The history, or None when it is disabled
+    """
+    if not config.getboolean('HISTORY', 'ENABLED', fallback=False):
+        return None
+
+    return RunHistory(config.get('HISTORY', 'PATH', fallback='.run_history.sqlite'))
+
+
+def save_run(config, kind, started_at, success):
+    """
+    Save the current run and its recorded statements to the run history, if enabled.
+
+    Args:
+        config: Configuration parser
+        kind: Type of run ("etl" or "analytics")
+        started_at: Start time of the run (epoch seconds)
+        success: Whether the run completed
+    """
+    history = get_run_history(config)
+    if history is None:
+        return
+
+    history.record_run(
+        metrics.get_run_id(), kind, started_at, time.time() - started_at, success,
+        metrics.get_records(), get_git_commit()
+    )
+    print(f"Run {metrics.get_run_id()} saved to {history.path}")
+
+
+def main():
+    config = get_config()
+
+    parser = argparse.ArgumentParser(description="Inspect the history of Sparkify ETL and analytics runs")
+    parser.add_argument("command", choices=["compare", "trend", "percentiles"], help="Report to print")
+    parser.add_argument("--kind", choices=["etl", "analytics"], default="etl", help="Type of run")
+    parser.add_argument("--level", choices=LEVELS, default="stage", help="Compare stages or individual statements")
+    parser.add_argument("--path", default=config.get('HISTORY', 'PATH', fallback='.run_history.sqlite'),
+                        help="SQLite history file")
+    parser.add_argument("--baseline-runs", type=int, default=config.getint('HISTORY', 'BASELINE_RUNS', fallback=7),
+                        help="Previous runs forming the baseline")
+    parser.add_argument("--threshold", type=float, default=config.getfloat('HISTORY', 'THRESHOLD', fallback=0.2),
+                        help="Allowed relative slowdown of the time per row (0.2 = 20%%)")
+    parser.add_argument("--min-seconds", type=float, default=config.getfloat('HISTORY', 'MIN_SECONDS', fallback=1.0),
+                        help="Ignore units faster than this in the latest run")
+    parser.add_argument("--runs", type=int, default=10, help="Runs shown by the trend report or sampled for percentiles")
+    parser.add_argument("--output", help="JSON file receiving the percentiles")
+    args = parser.parse_args()
+
+    history = RunHistory(args.path)
+
+    if args.command == "trend":
+        print_trend(history, args.kind, args.runs, args.level)
+        return
+
+    if args.command == "percentiles":
+        percentiles = get_latency_percentiles(history, args.kind, args.runs, args.level)
+        print_percentiles(percentiles, args.kind, args.level)
+        if args.output:
+            with open(args.output, "w") as f:
+                json.dump(percentiles, f, indent=2)
+            print(f"\nPercentiles written to {args.output}")
+        return
+
+    latest, comparisons = compare_latest_run(
+        history, args.kind, args.baseline_runs, args.threshold, args.min_seconds, args.level
+    )
+    if latest is None:
+        print(f"No {args.kind} runs recorded yet")
+        return
+
+    print_comparison(latest, comparisons, args.threshold)
+
+    # A non-zero exit code lets a scheduler alert on regressions
+    if any(item["regressed"] for item in comparisons):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -21,6 +21,19 @@ user_table_drop = "DROP TABLE IF EXISTS users"
 song_table_drop = "DROP TABLE IF EXISTS songs"
 artist_table_drop = "DROP TABLE IF EXISTS artists"
 time_table_drop = "DROP TABLE IF EXISTS time"
+song_key_map_table_drop = "DROP TABLE IF EXISTS song_key_map"
+artist_key_map_table_drop = "DROP TABLE IF EXISTS artist_key_map"
+load_state_table_drop = "DROP TABLE IF EXISTS etl_load_state"
+processed_files_table_drop = "DROP TABLE IF EXISTS etl_processed_files"
+agg_plays_by_hour_table_drop = "DROP TABLE IF EXISTS agg_plays_by_hour"
+agg_plays_by_weekday_table_drop = "DROP TABLE IF EXISTS agg_plays_by_weekday"
+agg_level_users_table_drop = "DROP TABLE IF EXISTS agg_level_users"
+agg_location_users_table_drop = "DROP TABLE IF EXISTS agg_location_users"
+agg_refresh_state_table_drop = "DROP TABLE IF EXISTS agg_refresh_state"
+staging_events_keyed_table_drop = "DROP TABLE IF EXISTS staging_events_keyed"
+staging_songs_keyed_table_drop = "DROP TABLE IF EXISTS staging_songs_keyed"
+checkpoints_table_drop = "DROP TABLE IF EXISTS etl_checkpoints"
+log_partitions_table_drop = "DROP TABLE IF EXISTS etl_log_partitions"
 
 # ----------------------
 # CREATE TABLES
@@ -71,8 +84,8 @@ songplay_table_create = ("""
         start_time TIMESTAMP NOT NULL SORTKEY DISTKEY,
         user_id INTEGER NOT NULL,
         level VARCHAR,
-        song_id VARCHAR,
-        artist_id VARCHAR,
+        song_sk BIGINT,
+        artist_sk BIGINT,
         session_id INTEGER,
         location VARCHAR,
         user_agent VARCHAR
@@ -91,9 +104,10 @@ user_table_create = ("""
 
 song_table_create = ("""
     CREATE TABLE IF NOT EXISTS songs (
-        song_id VARCHAR PRIMARY KEY SORTKEY,
+        song_sk BIGINT PRIMARY KEY SORTKEY DISTKEY,
+        song_id VARCHAR NOT NULL,
         title VARCHAR NOT NULL,
-        artist_id VARCHAR NOT NULL,
+        artist_sk BIGINT NOT NULL,
         year INTEGER,
         duration FLOAT NOT NULL
     )
@@ -101,7 +115,8 @@ song_table_create = ("""
 
 artist_table_create = ("""
     CREATE TABLE IF NOT EXISTS artists (
-        artist_id VARCHAR PRIMARY KEY SORTKEY,
+        artist_sk BIGINT PRIMARY KEY SORTKEY DISTKEY,
+        artist_id VARCHAR NOT NULL,
         name VARCHAR NOT NULL,
         location VARCHAR,
         latitude FLOAT,
@@ -121,6 +136,114 @@ time_table_create = ("""
     )
 """)
 
+# Persistent mapping of the natural song and artist IDs to the BIGINT surrogate
+# keys used by songs, artists and songplays. Keys are assigned once and never
+# reused; the maps are small and looked up by natural ID, so they are copied to
+# every node and sorted on it.
+song_key_map_table_create = ("""
+    CREATE TABLE IF NOT EXISTS song_key_map (
+        song_sk BIGINT IDENTITY(1,1),
+        song_id VARCHAR NOT NULL SORTKEY
+    )
+    DISTSTYLE ALL
+""")
+
+artist_key_map_table_create = ("""
+    CREATE TABLE IF NOT EXISTS artist_key_map (
+        artist_sk BIGINT IDENTITY(1,1),
+        artist_id VARCHAR NOT NULL SORTKEY
+    )
+    DISTSTYLE ALL
+""")
+
+# ETL state for incremental loads: one row per load with the staging_events.ts
+# high-water mark, and one row per S3 file already copied into staging
+load_state_table_create = ("""
+    CREATE TABLE IF NOT EXISTS etl_load_state (
+        load_id INTEGER NOT NULL SORTKEY,
+        events_watermark BIGINT NOT NULL,
+        events_files INTEGER NOT NULL,
+        songs_files INTEGER NOT NULL,
+        loaded_at TIMESTAMP DEFAULT GETDATE()
+    )
+""")
+
+# Steps of a full load that completed, with the fingerprint of the inputs and
+# SQL they ran on, so that a failed run can be resumed (etl.py --resume)
+checkpoints_table_create = ("""
+    CREATE TABLE IF NOT EXISTS etl_checkpoints (
+        step VARCHAR(256) NOT NULL SORTKEY,
+        fingerprint CHAR(64) NOT NULL,
+        completed_at TIMESTAMP DEFAULT GETDATE()
+    )
+""")
+
+# Outcome of each log_data partition copied by a backfill (see backfill.py)
+log_partitions_table_create = ("""
+    CREATE TABLE IF NOT EXISTS etl_log_partitions (
+        partition_key VARCHAR(16) NOT NULL SORTKEY,
+        s3_prefix VARCHAR(1024) NOT NULL,
+        status VARCHAR(16) NOT NULL,
+        updated_at TIMESTAMP DEFAULT GETDATE()
+    )
+""")
+
+processed_files_table_create = ("""
+    CREATE TABLE IF NOT EXISTS etl_processed_files (
+        s3_key VARCHAR(1024) NOT NULL,
+        source VARCHAR(32) NOT NULL,
+        load_id INTEGER NOT NULL,
+        processed_at TIMESTAMP DEFAULT GETDATE()
+    )
+    SORTKEY (source, s3_key)
+""")
+
+# Aggregate tables behind the built-in analytics. Play counts are additive;
+# distinct-user counts keep the (level, user) and (location, user) pairs so
+# they can also be maintained from new songplays only.
+agg_plays_by_hour_table_create = ("""
+    CREATE TABLE IF NOT EXISTS agg_plays_by_hour (
+        hour INTEGER NOT NULL SORTKEY,
+        play_count BIGINT NOT NULL
+    )
+    DISTSTYLE ALL
+""")
+
+agg_plays_by_weekday_table_create = ("""
+    CREATE TABLE IF NOT EXISTS agg_plays_by_weekday (
+        weekday INTEGER NOT NULL SORTKEY,
+        play_count BIGINT NOT NULL
+    )
+    DISTSTYLE ALL
+""")
+
+agg_level_users_table_create = ("""
+    CREATE TABLE IF NOT EXISTS agg_level_users (
+        level VARCHAR,
+        user_id INTEGER NOT NULL
+    )
+    SORTKEY (level, user_id)
+""")
+
+agg_location_users_table_create = ("""
+    CREATE TABLE IF NOT EXISTS agg_location_users (
+        location VARCHAR,
+        user_id INTEGER NOT NULL
+    )
+    SORTKEY (location, user_id)
+""")
+
+# One row per refresh: the number of songplays folded into the aggregates and
+# the highest songplay_id among them. The aggregates are fresh while songplays
+# still has songplays_rows rows
+agg_refresh_state_table_create = ("""
+    CREATE TABLE IF NOT EXISTS agg_refresh_state (
+        refreshed_at TIMESTAMP NOT NULL SORTKEY,
+        songplays_rows BIGINT NOT NULL,
+        songplay_id_max BIGINT NOT NULL
+    )
+""")
+
 # ----------------------
 # STAGING TABLES - COPY
 # ----------------------
@@ -131,7 +254,7 @@ staging_events_copy = ("""
     IAM_ROLE '{}'
     FORMAT AS JSON '{}'
     REGION 'us-west-2';
-""").format(config.get('S3', 'LOG_DATA'), config.get('IAM_ROLE', 'ARN'), config.get('S3', 'LOG_JSONPATH'))
+""").format(config.get('S3', 'LOG_DATA', fallback=''), config.get('IAM_ROLE', 'ARN', fallback=''), config.get('S3', 'LOG_JSONPATH', fallback=''))
 
 staging_songs_copy = ("""
     COPY staging_songs 
@@ -139,77 +262,587 @@ staging_songs_copy = ("""
     IAM_ROLE '{}'
     FORMAT AS JSON 'auto'
     REGION 'us-west-2';
-""").format(config.get('S3', 'SONG_DATA'), config.get('IAM_ROLE', 'ARN'))
+""").format(config.get('S3', 'SONG_DATA', fallback=''), config.get('IAM_ROLE', 'ARN', fallback=''))
+
+# Manifest-based COPY used by incremental loads; the manifest URL is filled in at run time
+staging_events_manifest_copy = ("""
+    COPY staging_events 
+    FROM '{{}}' 
+    IAM_ROLE '{}'
+    FORMAT AS JSON '{}'
+    REGION 'us-west-2'
+    MANIFEST;
+""").format(config.get('IAM_ROLE', 'ARN', fallback=''), config.get('S3', 'LOG_JSONPATH', fallback=''))
+
+staging_songs_manifest_copy = ("""
+    COPY staging_songs 
+    FROM '{{}}' 
+    IAM_ROLE '{}'
+    FORMAT AS JSON 'auto'
+    REGION 'us-west-2'
+    MANIFEST;
+""").format(config.get('IAM_ROLE', 'ARN', fallback=''))
+
+# COPY of the compressed chunks written by prepare_inputs.py; the manifest URL and
+# compression keyword are filled in at run time. The chunks are split to match the
+# slice count, and compression analysis and statistics are left to the inserts.
+staging_events_prepared_copy = ("""
+    COPY staging_events 
+    FROM '{{}}' 
+    IAM_ROLE '{}'
+    FORMAT AS JSON '{}'
+    {{}}
+    REGION 'us-west-2'
+    MANIFEST
+    COMPUPDATE OFF
+    STATUPDATE OFF;
+""").format(config.get('IAM_ROLE', 'ARN', fallback=''), config.get('S3', 'LOG_JSONPATH', fallback=''))
+
+staging_songs_prepared_copy = ("""
+    COPY staging_songs 
+    FROM '{{}}' 
+    IAM_ROLE '{}'
+    FORMAT AS JSON 'auto'
+    {{}}
+    REGION 'us-west-2'
+    MANIFEST
+    COMPUPDATE OFF
+    STATUPDATE OFF;
+""").format(config.get('IAM_ROLE', 'ARN', fallback=''))
+
+staging_events_truncate = "TRUNCATE staging_events"
+
+# ----------------------
+# SURROGATE KEYS
+# ----------------------
+
+# Natural IDs seen in staging_songs for the first time get the next surrogate key
+song_key_map_insert = ("""
+    INSERT INTO song_key_map (song_id)
+    SELECT DISTINCT s.song_id
+    FROM staging_songs s
+    LEFT JOIN song_key_map m ON m.song_id = s.song_id
+    WHERE s.song_id IS NOT NULL
+    AND m.song_id IS NULL;
+""")
+
+artist_key_map_insert = ("""
+    INSERT INTO artist_key_map (artist_id)
+    SELECT DISTINCT s.artist_id
+    FROM staging_songs s
+    LEFT JOIN artist_key_map m ON m.artist_id = s.artist_id
+    WHERE s.artist_id IS NOT NULL
+    AND m.artist_id IS NULL;
+""")
+
+# ----------------------
+# SONG MATCH KEYS
+# ----------------------
+
+# Normalized song match key: MD5 of the trimmed, lower-cased title and artist
+# name, optionally followed by the duration rounded to the second
+song_match_key = "MD5(LOWER(TRIM({title})) || '|' || LOWER(TRIM({artist})){duration})"
+song_match_duration = " || '|' || CAST(ROUND({}) AS INTEGER)" if config.getboolean('ETL', 'MATCH_KEY_DURATION', fallback=False) else ""
+
+# Keyed copies of the staging tables, both distributed and sorted on the
+# match key so the songplays join is collocated and compares CHAR(32) values.
+# Songs carry their surrogate keys, so songplays never joins the key maps.
+# The normalized key can match several songs; only the one with the lowest
+# song_id is kept, so each event still becomes a single songplay.
+staging_events_keyed_create = ("""
+    CREATE TABLE staging_events_keyed
+    DISTKEY (song_key)
+    SORTKEY (song_key)
+    AS
+    SELECT 
+        CAST({} AS CHAR(32)) AS song_key,
+        event_id,
+        ts,
+        userId,
+        level,
+        sessionId,
+        location,
+        userAgent
+    FROM staging_events
+    WHERE page = 'NextSong';
+""").format(song_match_key.format(title="song", artist="artist", duration=song_match_duration.format("length")))
+
+staging_songs_keyed_create = ("""
+    CREATE TABLE staging_songs_keyed
+    DISTKEY (song_key)
+    SORTKEY (song_key)
+    AS
+    SELECT song_key, song_sk, artist_sk
+    FROM (
+        SELECT 
+            CAST({key} AS CHAR(32)) AS song_key,
+            sm.song_sk,
+            am.artist_sk,
+            ROW_NUMBER() OVER (PARTITION BY {key} ORDER BY s.song_id) AS row_num
+        FROM staging_songs s
+        LEFT JOIN song_key_map sm ON sm.song_id = s.song_id
+        LEFT JOIN artist_key_map am ON am.artist_id = s.artist_id
+    ) keyed
+    WHERE row_num = 1;
+""").format(key=song_match_key.format(title="s.title", artist="s.artist_name", duration=song_match_duration.format("s.duration")))
+
+# Events matched to a song with the original title/artist join and with the match key
+song_match_report_legacy = ("""
+    SELECT COUNT(DISTINCT e.event_id), COUNT(DISTINCT CASE WHEN s.song_id IS NOT NULL THEN e.event_id END)
+    FROM staging_events e
+    LEFT JOIN staging_songs s ON e.song = s.title AND e.artist = s.artist_name
+    WHERE e.page = 'NextSong';
+""")
+
+song_match_report_keyed = ("""
+    SELECT COUNT(DISTINCT e.event_id), COUNT(DISTINCT CASE WHEN s.song_sk IS NOT NULL THEN e.event_id END)
+    FROM staging_events_keyed e
+    LEFT JOIN staging_songs_keyed s ON e.song_key = s.song_key;
+""")
 
 # ----------------------
 # INSERT INTO TABLES
 # ----------------------
 
 songplay_table_insert = ("""
-    INSERT INTO songplays (start_time, user_id, level, song_id, artist_id, session_id, location, user_agent)
+    INSERT INTO songplays (start_time, user_id, level, song_sk, artist_sk, session_id, location, user_agent)
     SELECT 
         TIMESTAMP 'epoch' + e.ts/1000 * INTERVAL '1 second' AS start_time,
         e.userId AS user_id,
         e.level,
-        s.song_id,
-        s.artist_id,
+        s.song_sk,
+        s.artist_sk,
         e.sessionId AS session_id,
         e.location,
         e.userAgent AS user_agent
-    FROM staging_events e
-    LEFT JOIN staging_songs s ON e.song = s.title AND e.artist = s.artist_name
-    WHERE e.page = 'NextSong';
+    FROM staging_events_keyed e
+    LEFT JOIN staging_songs_keyed s ON e.song_key = s.song_key;
 """)
 
-user_table_insert = ("""
+# Only songplays in the time range of the current staging load are scanned,
+# and timestamps already in time are skipped
+time_table_insert = ("""
+    INSERT INTO time (start_time, hour, day, week, month, year, weekday)
+    SELECT DISTINCT
+        sp.start_time,
+        EXTRACT(hour FROM sp.start_time) AS hour,
+        EXTRACT(day FROM sp.start_time) AS day,
+        EXTRACT(week FROM sp.start_time) AS week,
+        EXTRACT(month FROM sp.start_time) AS month,
+        EXTRACT(year FROM sp.start_time) AS year,
+        EXTRACT(weekday FROM sp.start_time) AS weekday
+    FROM songplays sp
+    LEFT JOIN time t ON t.start_time = sp.start_time
+    WHERE sp.start_time >= (SELECT TIMESTAMP 'epoch' + MIN(ts)/1000 * INTERVAL '1 second' FROM staging_events_keyed)
+    AND t.start_time IS NULL;
+""")
+
+# ----------------------
+# UPSERT DIMENSIONS
+# ----------------------
+
+# Dimensions are maintained with delete-and-insert through a temp table holding
+# one row per key. Rows identical to the current dimension row are dropped from
+# the temp table first, so only new or changed keys are rewritten.
+
+# Latest level wins: the most recent event (by ts) of each user is kept
+user_table_upsert = ("""
+    DROP TABLE IF EXISTS users_changes;
+
+    CREATE TEMP TABLE users_changes AS
+    SELECT user_id, first_name, last_name, gender, level
+    FROM (
+        SELECT 
+            userId AS user_id,
+            firstName AS first_name,
+            lastName AS last_name,
+            gender,
+            level,
+            ROW_NUMBER() OVER (PARTITION BY userId ORDER BY ts DESC) AS row_num
+        FROM staging_events
+        WHERE userId IS NOT NULL 
+        AND page = 'NextSong'
+    ) latest
+    WHERE row_num = 1;
+
+    DELETE FROM users_changes
+    USING users
+    WHERE users_changes.user_id = users.user_id
+    AND users_changes.first_name = users.first_name
+    AND users_changes.last_name = users.last_name
+    AND COALESCE(users_changes.gender, '') = COALESCE(users.gender, '')
+    AND users_changes.level = users.level;
+
+    DELETE FROM users
+    USING users_changes
+    WHERE users.user_id = users_changes.user_id;
+
     INSERT INTO users (user_id, first_name, last_name, gender, level)
-    SELECT DISTINCT 
-        userId AS user_id,
-        firstName AS first_name,
-        lastName AS last_name,
-        gender,
-        level
-    FROM staging_events
-    WHERE userId IS NOT NULL 
-    AND page = 'NextSong';
-""")
-
-song_table_insert = ("""
-    INSERT INTO songs (song_id, title, artist_id, year, duration)
-    SELECT DISTINCT 
-        song_id,
-        title,
-        artist_id,
-        year,
-        duration
-    FROM staging_songs
-    WHERE song_id IS NOT NULL;
-""")
-
-artist_table_insert = ("""
-    INSERT INTO artists (artist_id, name, location, latitude, longitude)
-    SELECT DISTINCT 
-        artist_id,
-        artist_name AS name,
-        artist_location AS location,
-        artist_latitude AS latitude,
-        artist_longitude AS longitude
-    FROM staging_songs
-    WHERE artist_id IS NOT NULL;
+    SELECT user_id, first_name, last_name, gender, level
+    FROM users_changes;
+
+    DROP TABLE users_changes;
 """)
 
-time_table_insert = ("""
+song_table_upsert = ("""
+    DROP TABLE IF EXISTS songs_changes;
+
+    CREATE TEMP TABLE songs_changes AS
+    SELECT sm.song_sk, latest.song_id, latest.title, am.artist_sk, latest.year, latest.duration
+    FROM (
+        SELECT 
+            song_id,
+            title,
+            artist_id,
+            year,
+            duration,
+            ROW_NUMBER() OVER (PARTITION BY song_id ORDER BY year DESC, title) AS row_num
+        FROM staging_songs
+        WHERE song_id IS NOT NULL
+    ) latest
+    JOIN song_key_map sm ON sm.song_id = latest.song_id
+    LEFT JOIN artist_key_map am ON am.artist_id = latest.artist_id
+    WHERE latest.row_num = 1;
+
+    DELETE FROM songs_changes
+    USING songs
+    WHERE songs_changes.song_sk = songs.song_sk
+    AND songs_changes.title = songs.title
+    AND songs_changes.artist_sk = songs.artist_sk
+    AND COALESCE(songs_changes.year, 0) = COALESCE(songs.year, 0)
+    AND songs_changes.duration = songs.duration;
+
+    DELETE FROM songs
+    USING songs_changes
+    WHERE songs.song_sk = songs_changes.song_sk;
+
+    INSERT INTO songs (song_sk, song_id, title, artist_sk, year, duration)
+    SELECT song_sk, song_id, title, artist_sk, year, duration
+    FROM songs_changes;
+
+    DROP TABLE songs_changes;
+""")
+
+# Rows with a known location are preferred when an artist appears several times
+artist_table_upsert = ("""
+    DROP TABLE IF EXISTS artists_changes;
+
+    CREATE TEMP TABLE artists_changes AS
+    SELECT am.artist_sk, latest.artist_id, latest.name, latest.location, latest.latitude, latest.longitude
+    FROM (
+        SELECT 
+            artist_id,
+            artist_name AS name,
+            artist_location AS location,
+            artist_latitude AS latitude,
+            artist_longitude AS longitude,
+            ROW_NUMBER() OVER (
+                PARTITION BY artist_id
+                ORDER BY CASE WHEN COALESCE(artist_location, '') = '' THEN 1 ELSE 0 END, artist_name
+            ) AS row_num
+        FROM staging_songs
+        WHERE artist_id IS NOT NULL
+    ) latest
+    JOIN artist_key_map am ON am.artist_id = latest.artist_id
+    WHERE latest.row_num = 1;
+
+    DELETE FROM artists_changes
+    USING artists
+    WHERE artists_changes.artist_sk = artists.artist_sk
+    AND artists_changes.name = artists.name
+    AND COALESCE(artists_changes.location, '') = COALESCE(artists.location, '')
+    AND COALESCE(artists_changes.latitude, 0) = COALESCE(artists.latitude, 0)
+    AND COALESCE(artists_changes.longitude, 0) = COALESCE(artists.longitude, 0);
+
+    DELETE FROM artists
+    USING artists_changes
+    WHERE artists.artist_sk = artists_changes.artist_sk;
+
+    INSERT INTO artists (artist_sk, artist_id, name, location, latitude, longitude)
+    SELECT artist_sk, artist_id, name, location, latitude, longitude
+    FROM artists_changes;
+
+    DROP TABLE artists_changes;
+""")
+
+# ----------------------
+# INCREMENTAL INSERTS
+# ----------------------
+
+# Only events newer than the stored staging_events.ts watermark are turned into songplays
+songplay_table_incremental_insert = ("""
+    INSERT INTO songplays (start_time, user_id, level, song_sk, artist_sk, session_id, location, user_agent)
+    SELECT 
+        TIMESTAMP 'epoch' + e.ts/1000 * INTERVAL '1 second' AS start_time,
+        e.userId AS user_id,
+        e.level,
+        s.song_sk,
+        s.artist_sk,
+        e.sessionId AS session_id,
+        e.location,
+        e.userAgent AS user_agent
+    FROM staging_events_keyed e
+    LEFT JOIN staging_songs_keyed s ON e.song_key = s.song_key
+    WHERE e.ts > {};
+""")
+
+time_table_incremental_insert = ("""
+    INSERT INTO time (start_time, hour, day, week, month, year, weekday)
+    SELECT DISTINCT
+        sp.start_time,
+        EXTRACT(hour FROM sp.start_time) AS hour,
+        EXTRACT(day FROM sp.start_time) AS day,
+        EXTRACT(week FROM sp.start_time) AS week,
+        EXTRACT(month FROM sp.start_time) AS month,
+        EXTRACT(year FROM sp.start_time) AS year,
+        EXTRACT(weekday FROM sp.start_time) AS weekday
+    FROM songplays sp
+    LEFT JOIN time t ON t.start_time = sp.start_time
+    WHERE sp.start_time > TIMESTAMP 'epoch' + {}/1000 * INTERVAL '1 second'
+    AND t.start_time IS NULL;
+""")
+
+# ----------------------
+# BACKFILL INSERTS
+# ----------------------
+
+# Songplays of the backfilled date ranges are replaced; the filters are built
+# from the partitions that were copied (see etl.run_backfill)
+songplays_range_delete = "DELETE FROM songplays WHERE {};"
+
+songplay_table_backfill_insert = ("""
+    INSERT INTO songplays (start_time, user_id, level, song_sk, artist_sk, session_id, location, user_agent)
+    SELECT 
+        TIMESTAMP 'epoch' + e.ts/1000 * INTERVAL '1 second' AS start_time,
+        e.userId AS user_id,
+        e.level,
+        s.song_sk,
+        s.artist_sk,
+        e.sessionId AS session_id,
+        e.location,
+        e.userAgent AS user_agent
+    FROM staging_events_keyed e
+    LEFT JOIN staging_songs_keyed s ON e.song_key = s.song_key
+    WHERE {};
+""")
+
+# Only the songplays of the backfilled date ranges are scanned for missing time rows
+time_table_backfill_insert = ("""
     INSERT INTO time (start_time, hour, day, week, month, year, weekday)
     SELECT DISTINCT
-        start_time,
-        EXTRACT(hour FROM start_time) AS hour,
-        EXTRACT(day FROM start_time) AS day,
-        EXTRACT(week FROM start_time) AS week,
-        EXTRACT(month FROM start_time) AS month,
-        EXTRACT(year FROM start_time) AS year,
-        EXTRACT(weekday FROM start_time) AS weekday
-    FROM songplays;
+        sp.start_time,
+        EXTRACT(hour FROM sp.start_time) AS hour,
+        EXTRACT(day FROM sp.start_time) AS day,
+        EXTRACT(week FROM sp.start_time) AS week,
+        EXTRACT(month FROM sp.start_time) AS month,
+        EXTRACT(year FROM sp.start_time) AS year,
+        EXTRACT(weekday FROM sp.start_time) AS weekday
+    FROM songplays sp
+    LEFT JOIN time t ON t.start_time = sp.start_time
+    WHERE {}
+    AND t.start_time IS NULL;
+""")
+
+# Backfilled events are older than the ones users was built from, so only
+# users missing from the table are added and current levels are kept
+user_table_backfill_insert = ("""
+    INSERT INTO users (user_id, first_name, last_name, gender, level)
+    SELECT latest.user_id, latest.first_name, latest.last_name, latest.gender, latest.level
+    FROM (
+        SELECT 
+            userId AS user_id,
+            firstName AS first_name,
+            lastName AS last_name,
+            gender,
+            level,
+            ROW_NUMBER() OVER (PARTITION BY userId ORDER BY ts DESC) AS row_num
+        FROM staging_events
+        WHERE userId IS NOT NULL 
+        AND page = 'NextSong'
+    ) latest
+    LEFT JOIN users u ON u.user_id = latest.user_id
+    WHERE latest.row_num = 1
+    AND u.user_id IS NULL;
+""")
+
+# ----------------------
+# TIME CALENDAR
+# ----------------------
+
+# Bulk pre-generation of one time row per hour of a range, so time holds a
+# calendar of every hour while per-second rows are only added for the
+# timestamps songplays actually contains. The numbers 0..n come from
+# cross-joined digit lists (generate_series only runs on the Redshift leader
+# node), the leading digit bounded so the cross join stays close to the size
+# of the range; hours already in time are skipped.
+time_calendar_digits = "SELECT 0 AS d UNION ALL SELECT 1 UNION ALL SELECT 2 UNION ALL SELECT 3 UNION ALL SELECT 4 UNION ALL SELECT 5 UNION ALL SELECT 6 UNION ALL SELECT 7 UNION ALL SELECT 8 UNION ALL SELECT 9"
+
+time_calendar_insert = ("""
+    INSERT INTO time (start_time, hour, day, week, month, year, weekday)
+    SELECT
+        c.start_time,
+        EXTRACT(hour FROM c.start_time) AS hour,
+        EXTRACT(day FROM c.start_time) AS day,
+        EXTRACT(week FROM c.start_time) AS week,
+        EXTRACT(month FROM c.start_time) AS month,
+        EXTRACT(year FROM c.start_time) AS year,
+        EXTRACT(weekday FROM c.start_time) AS weekday
+    FROM (
+        SELECT TIMESTAMP '{start}' + n * INTERVAL '1 hour' AS start_time
+        FROM (
+            SELECT {number} AS n
+            FROM {digits}
+        ) numbers
+        WHERE n < {hours}
+    ) c
+    LEFT JOIN time t ON t.start_time = c.start_time
+    WHERE t.start_time IS NULL;
+""")
+
+# Last timestamp in time, and the ts range of the staged events
+select_time_calendar_bounds = ("""
+    SELECT (SELECT MAX(start_time) FROM time), MIN(ts), MAX(ts)
+    FROM staging_events_keyed;
+""")
+
+# ----------------------
+# AGGREGATE REFRESH
+# ----------------------
+
+# Each refresh statement takes a filter on songplays selecting the rows to fold
+# in: the songplay_id range past the high-water mark of the last refresh, or
+# every songplay when the aggregates are rebuilt
+
+songplays_id_range_filter = "songplay_id > {} AND songplay_id <= {}"
+
+agg_plays_by_hour_refresh = ("""
+    DROP TABLE IF EXISTS agg_plays_by_hour_delta;
+
+    CREATE TEMP TABLE agg_plays_by_hour_delta AS
+    SELECT EXTRACT(hour FROM start_time) AS hour, COUNT(*) AS play_count
+    FROM songplays
+    WHERE {0}
+    GROUP BY 1;
+
+    UPDATE agg_plays_by_hour
+    SET play_count = agg_plays_by_hour.play_count + d.play_count
+    FROM agg_plays_by_hour_delta d
+    WHERE agg_plays_by_hour.hour = d.hour;
+
+    INSERT INTO agg_plays_by_hour (hour, play_count)
+    SELECT d.hour, d.play_count
+    FROM agg_plays_by_hour_delta d
+    WHERE NOT EXISTS (SELECT 1 FROM agg_plays_by_hour a WHERE a.hour = d.hour);
+
+    DROP TABLE agg_plays_by_hour_delta;
+""")
+
+agg_plays_by_weekday_refresh = ("""
+    DROP TABLE IF EXISTS agg_plays_by_weekday_delta;
+
+    CREATE TEMP TABLE agg_plays_by_weekday_delta AS
+    SELECT EXTRACT(weekday FROM start_time) AS weekday, COUNT(*) AS play_count
+    FROM songplays
+    WHERE {0}
+    GROUP BY 1;
+
+    UPDATE agg_plays_by_weekday
+    SET play_count = agg_plays_by_weekday.play_count + d.play_count
+    FROM agg_plays_by_weekday_delta d
+    WHERE agg_plays_by_weekday.weekday = d.weekday;
+
+    INSERT INTO agg_plays_by_weekday (weekday, play_count)
+    SELECT d.weekday, d.play_count
+    FROM agg_plays_by_weekday_delta d
+    WHERE NOT EXISTS (SELECT 1 FROM agg_plays_by_weekday a WHERE a.weekday = d.weekday);
+
+    DROP TABLE agg_plays_by_weekday_delta;
+""")
+
+agg_level_users_refresh = ("""
+    INSERT INTO agg_level_users (level, user_id)
+    SELECT DISTINCT sp.level, sp.user_id
+    FROM songplays sp
+    WHERE {0}
+    AND NOT EXISTS (
+        SELECT 1 FROM agg_level_users a
+        WHERE a.user_id = sp.user_id
+        AND (a.level = sp.level OR (a.level IS NULL AND sp.level IS NULL))
+    );
+""")
+
+agg_location_users_refresh = ("""
+    INSERT INTO agg_location_users (location, user_id)
+    SELECT DISTINCT sp.location, sp.user_id
+    FROM songplays sp
+    WHERE {0}
+    AND NOT EXISTS (
+        SELECT 1 FROM agg_location_users a
+        WHERE a.user_id = sp.user_id
+        AND (a.location = sp.location OR (a.location IS NULL AND sp.location IS NULL))
+    );
+""")
+
+agg_tables_clear = ("""
+    DELETE FROM agg_plays_by_hour;
+    DELETE FROM agg_plays_by_weekday;
+    DELETE FROM agg_level_users;
+    DELETE FROM agg_location_users;
+""")
+
+# Records the rows actually folded in by a refresh (added to those of the
+# previous refresh when incremental), so a songplay the refresh missed leaves
+# songplays_rows below COUNT(*) and the aggregates read as stale
+agg_refresh_state_insert = ("""
+    INSERT INTO agg_refresh_state (refreshed_at, songplays_rows, songplay_id_max)
+    SELECT GETDATE(), {rows} + COUNT(*), {id_max}
+    FROM songplays
+    WHERE {row_filter};
+""")
+
+select_agg_refresh_state = ("""
+    SELECT songplays_rows, songplay_id_max
+    FROM agg_refresh_state
+    ORDER BY refreshed_at DESC
+    LIMIT 1
+""")
+
+select_songplays_id_max = "SELECT MAX(songplay_id) FROM songplays"
+
+# True when the last refresh folded in exactly the songplays that exist now
+select_aggregates_fresh = ("""
+    SELECT (
+        SELECT songplays_rows FROM agg_refresh_state ORDER BY refreshed_at DESC LIMIT 1
+    ) = (
+        SELECT COUNT(*) FROM songplays
+    )
+""")
+
+# Songplays up to the high-water mark of the last refresh; when this differs
+# from its songplays_rows, rows were added below the mark (IDENTITY values are
+# unique but not guaranteed to follow insertion order) or deleted since
+select_songplays_count_until = "SELECT COUNT(*) FROM songplays WHERE songplay_id <= {}"
+
+# ----------------------
+# ETL STATE
+# ----------------------
+
+select_events_watermark = "SELECT COALESCE(MAX(events_watermark), 0) FROM etl_load_state"
+select_next_load_id = "SELECT COALESCE(MAX(load_id), 0) + 1 FROM etl_load_state"
+select_processed_files = "SELECT s3_key FROM etl_processed_files WHERE source = %s"
+select_staging_events_max_ts = "SELECT MAX(ts) FROM staging_events WHERE page = 'NextSong'"
+insert_processed_files = "INSERT INTO etl_processed_files (s3_key, source, load_id) VALUES %s"
+insert_load_state = ("""
+    INSERT INTO etl_load_state (load_id, events_watermark, events_files, songs_files)
+    VALUES (%s, %s, %s, %s)
 """)
+select_loaded_partitions = "SELECT partition_key FROM etl_log_partitions WHERE status = 'loaded'"
+delete_log_partition = "DELETE FROM etl_log_partitions WHERE partition_key = %s"
+insert_log_partition = "INSERT INTO etl_log_partitions (partition_key, s3_prefix, status) VALUES (%s, %s, %s)"
+select_checkpoints = "SELECT step, fingerprint FROM etl_checkpoints"
+delete_checkpoint = "DELETE FROM etl_checkpoints WHERE step = %s"
+insert_checkpoint = "INSERT INTO etl_checkpoints (step, fingerprint) VALUES (%s, %s)"
+checkpoints_clear = "DELETE FROM etl_checkpoints"
 
 # ----------------------
 # ANALYTICAL QUERIES
@@ -219,7 +852,7 @@ time_table_insert = ("""
 popular_songs_query = """
 SELECT s.title, COUNT(*) as play_count
 FROM songplays sp
-JOIN songs s ON sp.song_id = s.song_id
+JOIN songs s ON sp.song_sk = s.song_sk
 GROUP BY s.title
 ORDER BY play_count DESC
 LIMIT 10;
@@ -279,15 +912,75 @@ GROUP BY t.weekday
 ORDER BY t.weekday;
 """
 
+# ----------------------
+# AGGREGATE ANALYTICAL QUERIES
+# ----------------------
+
+# Same columns as the raw queries above, read from the aggregate tables
+
+hourly_activity_agg_query = """
+SELECT hour, play_count as activity_count
+FROM agg_plays_by_hour
+ORDER BY hour;
+"""
+
+user_distribution_agg_query = """
+SELECT level, COUNT(*) as user_count
+FROM agg_level_users
+GROUP BY level;
+"""
+
+top_locations_agg_query = """
+SELECT location, COUNT(*) as user_count
+FROM agg_location_users
+GROUP BY location
+ORDER BY user_count DESC
+LIMIT 5;
+"""
+
+weekday_plays_agg_query = """
+SELECT 
+    CASE weekday
+        WHEN 0 THEN 'Sunday'
+        WHEN 1 THEN 'Monday'
+        WHEN 2 THEN 'Tuesday'
+        WHEN 3 THEN 'Wednesday'
+        WHEN 4 THEN 'Thursday'
+        WHEN 5 THEN 'Friday'
+        WHEN 6 THEN 'Saturday'
+    END as day_of_week,
+    play_count
+FROM agg_plays_by_weekday
+ORDER BY weekday;
+"""
+
 # ----------------------
 # QUERY LISTS
 # ----------------------
 
 # Lists for table operations
-create_table_queries = [staging_events_table_create, staging_songs_table_create, songplay_table_create, user_table_create, song_table_create, artist_table_create, time_table_create]
-drop_table_queries = [staging_events_table_drop, staging_songs_table_drop, songplay_table_drop, user_table_drop, song_table_drop, artist_table_drop, time_table_drop]
+create_table_queries = [staging_events_table_create, staging_songs_table_create, songplay_table_create, user_table_create, song_table_create, artist_table_create, time_table_create, song_key_map_table_create, artist_key_map_table_create, load_state_table_create, processed_files_table_create, checkpoints_table_create, log_partitions_table_create, agg_plays_by_hour_table_create, agg_plays_by_weekday_table_create, agg_level_users_table_create, agg_location_users_table_create, agg_refresh_state_table_create]
+drop_table_queries = [staging_events_table_drop, staging_songs_table_drop, songplay_table_drop, user_table_drop, song_table_drop, artist_table_drop, time_table_drop, song_key_map_table_drop, artist_key_map_table_drop, load_state_table_drop, processed_files_table_drop, checkpoints_table_drop, log_partitions_table_drop, agg_plays_by_hour_table_drop, agg_plays_by_weekday_table_drop, agg_level_users_table_drop, agg_location_users_table_drop, agg_refresh_state_table_drop, staging_events_keyed_table_drop, staging_songs_keyed_table_drop]
+state_table_queries = [load_state_table_create, processed_files_table_create]
+aggregate_table_queries = [agg_plays_by_hour_table_create, agg_plays_by_weekday_table_create, agg_level_users_table_create, agg_location_users_table_create, agg_refresh_state_table_create]
+aggregate_refresh_queries = {
+    "agg_plays_by_hour": agg_plays_by_hour_refresh,
+    "agg_plays_by_weekday": agg_plays_by_weekday_refresh,
+    "agg_level_users": agg_level_users_refresh,
+    "agg_location_users": agg_location_users_refresh
+}
 copy_table_queries = [staging_events_copy, staging_songs_copy]
-insert_table_queries = [songplay_table_insert, user_table_insert, song_table_insert, artist_table_insert, time_table_insert]
+song_match_key_queries = [song_key_map_insert, artist_key_map_insert, staging_events_keyed_table_drop, staging_events_keyed_create, staging_songs_keyed_table_drop, staging_songs_keyed_create]
+insert_table_queries = [songplay_table_insert, user_table_upsert, song_table_upsert, artist_table_upsert, time_table_insert]
+
+# Insert statements keyed by target table, with the tables each one must wait for
+insert_table_dag = {
+    "songplays": {"query": songplay_table_insert, "depends_on": []},
+    "users": {"query": user_table_upsert, "depends_on": []},
+    "songs": {"query": song_table_upsert, "depends_on": []},
+    "artists": {"query": artist_table_upsert, "depends_on": []},
+    "time": {"query": time_table_insert, "depends_on": ["songplays"]}
+}
 
 # Dictionary of analytical queries with descriptive names as keys
 analytics_queries = {
@@ -297,4 +990,12 @@ analytics_queries = {
     "Top 5 Locations by User Count": top_locations_query,
     "Most Active Users": active_users_query,
     "Music Plays by Day of Week": weekday_plays_query
-}
\ No newline at end of file
+}
+
+# Aggregate-table replacements used by run_analytics when the aggregates are fresh
+aggregate_analytics_queries = {
+    "User Activity by Hour of Day": hourly_activity_agg_query,
+    "Free vs. Paid User Distribution": user_distribution_agg_query,
+    "Top 5 Locations by User Count": top_locations_agg_query,
+    "Music Plays by Day of Week": weekday_plays_agg_query
+}
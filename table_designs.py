@@ -0,0 +1,158 @@
+"""
+Table-design profiles for the Sparkify Data Warehouse.
+
+A profile overrides the physical design of some tables created by
+create_tables.py: distribution style and key, sort key and column
+compression (ENCODE). Tables a profile does not mention keep the design
+written in sql_queries.py. The active profile is chosen with [DESIGN] PROFILE
+in dwh.cfg, and compare_designs.py benchmarks two profiles against each other.
+
+Each table entry accepts:
+
+- diststyle: AUTO, EVEN, KEY or ALL
+- distkey: distribution column (implies DISTSTYLE KEY)
+- sortkey: list of sort key columns
+- sortstyle: COMPOUND (default) or INTERLEAVED
+- encode: mapping of column to encoding (e.g. {"title": "zstd"}); AZ64 only
+  applies to integer, decimal, date and timestamp columns
+"""
+import re
+from dialects import CREATE_TABLE_PATTERN
+
+
+TABLE_DESIGN_PROFILES = {
+    # The DDL as written in sql_queries.py
+    "baseline": {},
+
+    # Small dimensions copied to every node, so joins with songplays never redistribute
+    "dimensions_all": {
+        "users": {"diststyle": "ALL", "sortkey": ["user_id"]},
+        "songs": {"diststyle": "ALL", "sortkey": ["song_sk"]},
+        "artists": {"diststyle": "ALL", "sortkey": ["artist_sk"]}
+    },
+
+    # dimensions_all plus a compound sort key on songplays and explicit column encodings
+    "compound_encoded": {
+        "songplays": {
+            "distkey": "start_time",
+            "sortkey": ["start_time", "user_id"],
+            "encode": {
+                "start_time": "raw",
+                "user_id": "az64",
+                "level": "bytedict",
+                "song_sk": "az64",
+                "artist_sk": "az64",
+                "session_id": "az64",
+                "location": "zstd",
+                "user_agent": "zstd"
+            }
+        },
+        "users": {
+            "diststyle": "ALL",
+            "sortkey": ["user_id"],
+            "encode": {"first_name": "zstd", "last_name": "zstd", "gender": "bytedict", "level": "bytedict"}
+        },
+        "songs": {
+            "diststyle": "ALL",
+            "sortkey": ["song_sk"],
+            "encode": {"song_id": "zstd", "title": "zstd", "artist_sk": "az64", "year": "az64", "duration": "zstd"}
+        },
+        "artists": {
+            "diststyle": "ALL",
+            "sortkey": ["artist_sk"],
+            "encode": {"artist_id": "zstd", "name": "zstd", "location": "zstd", "latitude": "zstd", "longitude": "zstd"}
+        },
+        "time": {
+            "distkey": "start_time",
+            "sortkey": ["start_time"],
+            "encode": {
+                "hour": "az64", "day": "az64", "week": "az64",
+                "month": "az64", "year": "az64", "weekday": "az64"
+            }
+        }
+    }
+}
+
+DEFAULT_PROFILE = "baseline"
+
+# Distribution and sort attributes removed before a profile's design is applied
+DESIGN_ATTRIBUTES = [
+    re.compile(r"\s*\b(?:COMPOUND\s+|INTERLEAVED\s+)?SORTKEY\s*\([^)]*\)", re.IGNORECASE),
+    re.compile(r"\s*\bDISTKEY\s*\([^)]*\)", re.IGNORECASE),
+    re.compile(r"\s*\bDISTSTYLE\s+\w+", re.IGNORECASE),
+    re.compile(r"\s+\b(?:SORTKEY|DISTKEY)\b", re.IGNORECASE)
+]
+
+
+def get_table_design(config):
+    """
+    Return the name and table designs of the profile selected in [DESIGN] PROFILE.
+
+    Args:
+        config: Configuration parser
+
+    Returns:
+        tuple: (profile name, mapping of table name to design)
+    """
+    name = config.get('DESIGN', 'PROFILE', fallback=DEFAULT_PROFILE).strip()
+    return name, get_profile(name)
+
+
+def get_profile(name):
+    """
+    Look up a table-design profile by name.
+    """
+    if name not in TABLE_DESIGN_PROFILES:
+        raise ValueError(f"Unknown table-design profile '{name}', expected one of {', '.join(TABLE_DESIGN_PROFILES)}")
+    return TABLE_DESIGN_PROFILES[name]
+
+
+def encode_column(query, column, encoding):
+    """
+    Add an ENCODE clause after the data type of a column definition.
+    """
+    pattern = re.compile(
+        rf"^(\s*{column}\s+\w+(?:\s*\([^)]*\))?(?:\s+IDENTITY\s*\([^)]*\))?(?:\s+DEFAULT\s+\S+)?)(?:\s+ENCODE\s+\w+)?",
+        re.IGNORECASE | re.MULTILINE
+    )
+    query, count = pattern.subn(rf"\1 ENCODE {encoding}", query, count=1)
+    if not count:
+        raise ValueError(f"Column {column} not found in the table definition")
+    return query
+
+
+def apply_table_design(query, profile):
+    """
+    Rewrite a CREATE TABLE statement with the design its profile gives to that table.
+
+    Args:
+        query: CREATE TABLE statement from sql_queries.py
+        profile: Mapping of table name to design
+
+    Returns:
+        str: The statement with the profile's distribution, sort key and encodings
+    """
+    create_table = CREATE_TABLE_PATTERN.match(query.strip())
+    if not create_table or create_table.group(1) not in profile:
+        return query
+
+    design = profile[create_table.group(1)]
+
+    for pattern in DESIGN_ATTRIBUTES:
+        query = pattern.sub("", query)
+
+    for column, encoding in design.get("encode", {}).items():
+        query = encode_column(query, column, encoding)
+
+    attributes = []
+    if design.get("distkey"):
+        attributes.append(f"DISTSTYLE KEY DISTKEY ({design['distkey']})")
+    elif design.get("diststyle"):
+        attributes.append(f"DISTSTYLE {design['diststyle'].upper()}")
+    if design.get("sortkey"):
+        attributes.append(f"{design.get('sortstyle', 'COMPOUND').upper()} SORTKEY ({', '.join(design['sortkey'])})")
+
+    if attributes:
+        query = query.rstrip() + "\n    " + "\n    ".join(attributes) + "\n"
+
+    return query
@@ -0,0 +1,194 @@
+"""
+Integration tests of batched transactions and checkpointed resumes against PostgreSQL.
+
+They drop and recreate every table, so they only run when SPARKIFY_TEST_DSN
+points at a disposable database, e.g.
+
+    SPARKIFY_TEST_DSN="host=localhost dbname=sparkify_test user=postgres password=postgres" python -m pytest -q
+"""
+import configparser
+import os
+
+import pytest
+
+DSN = os.getenv("SPARKIFY_TEST_DSN")
+
+pytestmark = pytest.mark.skipif(not DSN, reason="SPARKIFY_TEST_DSN is not set")
+
+psycopg2 = pytest.importorskip("psycopg2")
+
+import etl
+import incremental
+from create_tables import create_tables, drop_tables
+from generate_data import generate_dataset
+from local_ingest import find_json_files
+from sql_queries import insert_table_dag, select_aggregates_fresh
+from utils import close_connection_pool, connect_to_redshift
+
+
+STAR_TABLES = ["songplays", "users", "songs", "artists", "time"]
+
+
+@pytest.fixture(scope="module")
+def dataset(tmp_path_factory):
+    output_dir = tmp_path_factory.mktemp("dataset")
+    generate_dataset(str(output_dir), scale=0.05)
+    return output_dir
+
+
+@pytest.fixture
+def config(dataset):
+    dsn = psycopg2.extensions.parse_dsn(DSN)
+    config = configparser.ConfigParser()
+    config.read_dict({
+        "CLUSTER": {
+            "host": dsn.get("host", "localhost"),
+            "db_name": dsn["dbname"],
+            "db_user": dsn.get("user", ""),
+            "db_password": dsn.get("password", ""),
+            "db_port": dsn.get("port", "5432"),
+            "dialect": "postgres"
+        },
+        "ETL": {"source": "local", "batch_transactions": "false", "checkpoints": "false"},
+        "S3": {
+            "log_data": "s3://sparkify-test/log_data",
+            "song_data": "s3://sparkify-test/song_data",
+            "manifest_prefix": "s3://sparkify-test/manifests"
+        },
+        "LOCAL": {
+            "log_data": str(dataset / "log_data"),
+            "song_data": str(dataset / "song_data"),
+            "workers": "1"
+        }
+    })
+    return config
+
+
+@pytest.fixture
+def db(config):
+    conn, cur = connect_to_redshift(config)
+    drop_tables(cur, conn)
+    create_tables(cur, conn)
+    yield conn, cur
+    conn.close()
+    close_connection_pool()
+
+
+def count_rows(cur, conn, table):
+    cur.execute(f"SELECT COUNT(*) FROM {table}")
+    count = cur.fetchone()[0]
+    conn.commit()
+    return count
+
+
+def test_failed_batched_stage_leaves_no_partial_rows(config, db):
+    conn, cur = db
+    config.set("ETL", "batch_transactions", "true")
+    etl.run_staging_stage(cur, conn, config)
+
+    # The last insert fails after the others ran in the same transaction
+    dag = dict(insert_table_dag)
+    dag["broken"] = {"query": "INSERT INTO songplays SELECT * FROM missing_table", "depends_on": list(insert_table_dag)}
+    with pytest.raises(psycopg2.Error):
+        etl.run_insert_stage(cur, conn, config, dag)
+
+    assert count_rows(cur, conn, "staging_events") > 0
+    for table in STAR_TABLES:
+        assert count_rows(cur, conn, table) == 0, table
+
+
+def test_resume_skips_completed_steps_without_duplicating_songplays(config, db, monkeypatch):
+    conn, cur = db
+    # Each step commits with its own checkpoint
+    config.set("ETL", "checkpoints", "true")
+    execute_query = etl.execute_query
+
+    def fail_time_insert(cursor, connection, query, query_name=None):
+        if query_name == "Populating table time":
+            raise RuntimeError("time insert failed")
+        return execute_query(cursor, connection, query, query_name)
+
+    monkeypatch.setattr(etl, "execute_query", fail_time_insert)
+    with pytest.raises(RuntimeError):
+        etl.run_full_load(cur, conn, config)
+    monkeypatch.setattr(etl, "execute_query", execute_query)
+
+    songplays = count_rows(cur, conn, "songplays")
+    assert songplays > 0
+    assert count_rows(cur, conn, "time") == 0
+
+    # The completed staging load and inserts must not run again
+    def already_loaded(*args, **kwargs):
+        raise AssertionError("staging was loaded again")
+
+    monkeypatch.setattr(etl, "load_staging_tables_local", already_loaded)
+    etl.run_full_load(cur, conn, config, resume=True)
+
+    assert count_rows(cur, conn, "songplays") == songplays
+    assert count_rows(cur, conn, "time") > 0
+    cur.execute("SELECT COUNT(*) FROM songplays sp LEFT JOIN time t ON t.start_time = sp.start_time WHERE t.start_time IS NULL")
+    assert cur.fetchone()[0] == 0
+    conn.rollback()
+
+
+def test_failed_incremental_load_can_be_rerun_without_duplicating_songplays(config, db, monkeypatch):
+    conn, cur = db
+    config.set("ETL", "aggregates", "true")
+
+    # S3 lists the local files; the new files are staged from the local directories
+    def list_local_files(s3, url):
+        directory = config.get("LOCAL", "LOG_DATA" if url == config.get("S3", "LOG_DATA") else "SONG_DATA")
+        return [f"{url}/{os.path.relpath(path, directory)}" for path in find_json_files(directory)]
+
+    monkeypatch.setattr(etl, "create_s3_client", lambda: None)
+    monkeypatch.setattr(etl, "write_manifest", lambda s3, files, url: url)
+    monkeypatch.setattr(incremental, "list_s3_files", list_local_files)
+
+    execute_query = etl.execute_query
+
+    def fail_time_insert(cursor, connection, query, query_name=None):
+        if query_name == "Populating table time":
+            raise RuntimeError("time insert failed")
+        return execute_query(cursor, connection, query, query_name)
+
+    monkeypatch.setattr(etl, "execute_query", fail_time_insert)
+    with pytest.raises(RuntimeError):
+        etl.run_incremental_load(cur, conn, config)
+    monkeypatch.setattr(etl, "execute_query", execute_query)
+
+    assert count_rows(cur, conn, "songplays") == 0
+    assert count_rows(cur, conn, "etl_load_state") == 0
+
+    assert etl.run_incremental_load(cur, conn, config) is not None
+
+    cur.execute("SELECT COUNT(*) FROM staging_events WHERE page = 'NextSong'")
+    events = cur.fetchone()[0]
+    conn.commit()
+    assert count_rows(cur, conn, "songplays") == events
+    assert count_rows(cur, conn, "etl_load_state") == 1
+    assert etl.run_incremental_load(cur, conn, config) is None
+
+
+def test_incremental_aggregate_refresh_folds_in_every_new_songplay(config, db):
+    conn, cur = db
+    insert_songplay = "INSERT INTO songplays (start_time, user_id, level) VALUES (TIMESTAMP '2018-11-01 10:00:00', %s, 'free')"
+
+    cur.execute(insert_songplay, (1,))
+    conn.commit()
+    etl.refresh_aggregate_tables(cur, conn)
+
+    # Same second as the songplay already folded in
+    cur.execute(insert_songplay, (2,))
+    conn.commit()
+    etl.refresh_aggregate_tables(cur, conn, incremental=True)
+
+    cur.execute("SELECT play_count FROM agg_plays_by_hour WHERE hour = 10")
+    assert cur.fetchone()[0] == 2
+    cur.execute(select_aggregates_fresh)
+    assert cur.fetchone()[0] is True
+
+    # A songplay the refresh did not fold in makes the aggregates stale
+    cur.execute(insert_songplay, (3,))
+    cur.execute(select_aggregates_fresh)
+    assert cur.fetchone()[0] is False
+    conn.rollback()
@@ -0,0 +1,198 @@
+"""
+Tests of the slice-aware input preparation (prepare_inputs.py).
+"""
+import bz2
+import configparser
+import gzip
+import json
+import os
+from collections import Counter
+from contextlib import contextmanager
+
+import pytest
+
+import prepare_inputs
+
+
+def write_inputs(directory, count=200):
+    """
+    Write song-like JSON inputs: one object per file and newline-delimited files.
+    """
+    records = [
+        {"song_id": f"SO{i:05d}", "title": "x" * (i % 37), "duration": i * 1.5, "year": 2000 + i % 20}
+        for i in range(count)
+    ]
+    files = []
+    for i, record in enumerate(records[:count // 2]):
+        path = os.path.join(directory, f"single-{i:04d}.json")
+        with open(path, "w") as f:
+            json.dump(record, f)
+        files.append(path)
+
+    rest = records[count // 2:]
+    for i in range(0, len(rest), 25):
+        path = os.path.join(directory, f"lines-{i:04d}.json")
+        with open(path, "w") as f:
+            f.write("\n".join(json.dumps(record) for record in rest[i:i + 25]) + "\n")
+        files.append(path)
+
+    return files, records
+
+
+def read_chunk(path, compression):
+    opener = prepare_inputs.COMPRESSIONS[compression][2]
+    with opener(path, "rb") as f:
+        return f.read().decode("utf-8").splitlines()
+
+
+def make_config(**prepare):
+    config = configparser.ConfigParser()
+    config.read_dict({"PREPARE": prepare})
+    return config
+
+
+@pytest.mark.parametrize("compression", ["gzip", "bzip2"])
+def test_split_writes_every_record_exactly_once(tmp_path, compression):
+    input_dir = tmp_path / "input"
+    input_dir.mkdir()
+    files, records = write_inputs(str(input_dir))
+
+    stats = prepare_inputs.split_json_files(files, str(tmp_path / "out"), "songs", 8, compression)
+
+    written = [json.loads(line) for path in stats["paths"] for line in read_chunk(path, compression)]
+    assert Counter(json.dumps(r, sort_keys=True) for r in written) == Counter(json.dumps(r, sort_keys=True) for r in records)
+    assert stats["records"] == len(records)
+    assert stats["files_in"] == len(files)
+    assert stats["files_out"] == 8
+    assert stats["bytes_out"] == sum(os.path.getsize(path) for path in stats["paths"])
+
+
+def test_split_chunks_are_near_equal(tmp_path):
+    input_dir = tmp_path / "input"
+    input_dir.mkdir()
+    files, _ = write_inputs(str(input_dir), count=1000)
+
+    stats = prepare_inputs.split_json_files(files, str(tmp_path / "out"), "songs", 6, "gzip")
+
+    chunks = [read_chunk(path, "gzip") for path in stats["paths"]]
+    sizes = [sum(len(line) + 1 for line in lines) for lines in chunks]
+    longest_line = max(len(line) + 1 for lines in chunks for line in lines)
+    assert all(chunks)
+    assert max(sizes) - min(sizes) <= longest_line
+
+
+def test_split_suffixes_match_compression(tmp_path):
+    stats_gzip = prepare_inputs.split_json_files([], str(tmp_path / "gz"), "events", 2, "gzip")
+    stats_bzip2 = prepare_inputs.split_json_files([], str(tmp_path / "bz2"), "events", 2, "bzip2")
+
+    assert [os.path.basename(p) for p in stats_gzip["paths"]] == ["events-0000.json.gz", "events-0001.json.gz"]
+    assert [os.path.basename(p) for p in stats_bzip2["paths"]] == ["events-0000.json.bz2", "events-0001.json.bz2"]
+    with gzip.open(stats_gzip["paths"][0]) as f:
+        assert f.read() == b""
+    with bz2.open(stats_bzip2["paths"][0]) as f:
+        assert f.read() == b""
+
+
+def test_split_rejects_bad_arguments(tmp_path):
+    with pytest.raises(ValueError):
+        prepare_inputs.split_json_files([], str(tmp_path), "songs", 2, "zstd")
+    with pytest.raises(ValueError):
+        prepare_inputs.split_json_files([], str(tmp_path), "songs", 0)
+
+
+class FakeS3:
+    """
+    Records the uploads and manifests written through the S3 client.
+    """
+
+    def __init__(self):
+        self.uploads = []
+        self.objects = {}
+
+    def upload_file(self, path, bucket, key):
+        self.uploads.append((path, bucket, key))
+
+    def put_object(self, Bucket, Key, Body):
+        self.objects[(Bucket, Key)] = Body
+
+
+def test_upload_chunks_writes_manifest_of_uploaded_chunks(tmp_path):
+    stats = prepare_inputs.split_json_files([], str(tmp_path), "events", 3, "gzip")
+    s3 = FakeS3()
+
+    manifest_url = prepare_inputs.upload_chunks(s3, stats["paths"], "s3://bucket/sparkify/prepared/", "events")
+
+    assert manifest_url == "s3://bucket/sparkify/prepared/events.manifest"
+    assert s3.uploads == [
+        (path, "bucket", f"sparkify/prepared/events/events-{i:04d}.json.gz")
+        for i, path in enumerate(stats["paths"])
+    ]
+    manifest = json.loads(s3.objects[("bucket", "sparkify/prepared/events.manifest")])
+    assert manifest == {"entries": [
+        {"url": f"s3://bucket/sparkify/prepared/events/events-{i:04d}.json.gz", "mandatory": True}
+        for i in range(3)
+    ]}
+
+
+def test_prepared_copy_queries_use_manifests_and_compression():
+    config = make_config(PREFIX="s3://bucket/prepared", COMPRESSION="bzip2")
+
+    events_copy, songs_copy = prepare_inputs.get_prepared_copy_queries(config)
+
+    assert "COPY staging_events" in events_copy and "s3://bucket/prepared/events.manifest" in events_copy
+    assert "COPY staging_songs" in songs_copy and "s3://bucket/prepared/songs.manifest" in songs_copy
+    assert all("BZIP2" in query and "MANIFEST" in query for query in (events_copy, songs_copy))
+
+
+class FakePool:
+    def __init__(self, slices=None, error=None):
+        self.slices = slices
+        self.error = error
+
+    @contextmanager
+    def connection(self):
+        if self.error:
+            raise self.error
+
+        class Cursor:
+            def execute(cursor, query):
+                assert query == prepare_inputs.SELECT_SLICE_COUNT
+
+            def fetchone(cursor):
+                return (self.slices,)
+
+        class Connection:
+            def commit(connection):
+                pass
+
+        yield Connection(), Cursor()
+
+
+def test_slice_count_from_stv_slices(monkeypatch):
+    monkeypatch.setattr(prepare_inputs, "get_connection_pool", lambda config: FakePool(slices=8))
+    monkeypatch.setattr(prepare_inputs, "close_connection_pool", lambda: None)
+
+    assert prepare_inputs.get_slice_count(make_config()) == 8
+
+
+def test_slice_count_falls_back_to_node_settings(monkeypatch):
+    monkeypatch.setattr(prepare_inputs, "get_connection_pool", lambda config: FakePool(error=RuntimeError("unreachable")))
+    monkeypatch.setattr(prepare_inputs, "close_connection_pool", lambda: None)
+    monkeypatch.setenv("REDSHIFT_NODE_TYPE", "ra3.4xlarge")
+    monkeypatch.setenv("REDSHIFT_NUM_NODES", "3")
+    monkeypatch.delenv("REDSHIFT_CLUSTER_TYPE", raising=False)
+
+    assert prepare_inputs.get_slice_count(make_config()) == 12
+
+
+def test_slice_count_setting_wins(monkeypatch):
+    monkeypatch.setattr(prepare_inputs, "get_connection_pool", lambda config: pytest.fail("cluster queried"))
+
+    assert prepare_inputs.get_slice_count(make_config(SLICES="6")) == 6
+
+
+def test_node_slice_count():
+    assert prepare_inputs.get_node_slice_count("dc2.large", 4) == 8
+    assert prepare_inputs.get_node_slice_count("dc2.8xlarge", 4, "single-node") == 16
+    with pytest.raises(ValueError):
+        prepare_inputs.get_node_slice_count("dc1.large", 2)
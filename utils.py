@@ -3,8 +3,36 @@ Módulo de utilitários para o projeto Sparkify Data Warehouse.
 Centraliza funções essenciais para o ETL.
 """
 import configparser
+import random
+import re
+import subprocess
+import threading
 import time
+from contextlib import contextmanager
+import pandas as pd
 import psycopg2
+from psycopg2 import errors, sql
+from psycopg2.pool import PoolError
+import metrics
+from dialects import REDSHIFT, DialectConnection, get_dialect
+
+
+# Parâmetros de sessão aceitos na seção [SESSION] do dwh.cfg
+SESSION_SETTINGS = ('search_path', 'statement_timeout', 'query_group')
+
+# Erros transitórios repetidos por execute_query ([TIMEOUTS] RETRIES)
+TRANSIENT_ERRORS = (
+    errors.SerializationFailure,
+    errors.DeadlockDetected,
+    errors.LockNotAvailable,
+    TimeoutError
+)
+
+# Tabela de destino de um COPY ou INSERT, usada como chave na seção [TIMEOUTS]
+STATEMENT_TARGET_PATTERN = re.compile(r"^\s*(?:COPY|INSERT\s+INTO)\s+(\w+)", re.IGNORECASE | re.MULTILINE)
+
+_pool = None
+_pool_lock = threading.Lock()
 
 
 def get_config(config_path='dwh.cfg'):
@@ -22,14 +50,90 @@ def get_config(config_path='dwh.cfg'):
     return config
 
 
-def connect_to_redshift(config=None, max_attempts=3, wait_time=30):
+def get_git_commit():
+    """
+    Retorna o commit git atual, ou None fora de um repositório git.
+    """
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "--short", "HEAD"], stderr=subprocess.DEVNULL, text=True
+        ).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def get_backoff_delay(attempt, wait_time=2, max_wait=60):
+    """
+    Calcula o tempo de espera antes de uma nova tentativa (backoff exponencial com jitter).
+    
+    Args:
+        attempt (int): Número da tentativa que falhou (começando em 0)
+        wait_time (float): Espera base em segundos
+        max_wait (float): Espera máxima em segundos
+        
+    Returns:
+        float: Tempo de espera em segundos
+    """
+    return random.uniform(0, min(max_wait, wait_time * 2 ** attempt))
+
+
+def get_session_settings(config):
+    """
+    Lê os parâmetros de sessão da seção [SESSION] do arquivo de configuração.
+    
+    Args:
+        config (configparser.ConfigParser): Configuração já carregada
+        
+    Returns:
+        dict: Parâmetros de sessão com valor definido
+    """
+    if not config.has_section('SESSION'):
+        return {}
+    
+    return {
+        name: config.get('SESSION', name)
+        for name in SESSION_SETTINGS
+        if config.get('SESSION', name, fallback='').strip()
+    }
+
+
+def apply_session_settings(conn, settings):
+    """
+    Aplica parâmetros de sessão (search_path, statement_timeout, query_group) na conexão.
+    
+    Args:
+        conn: Conexão com o banco de dados
+        settings (dict): Parâmetros de sessão
+    """
+    if not settings:
+        return
+    
+    with conn.cursor() as cur:
+        for name, value in settings.items():
+            if name == 'search_path':
+                schemas = [sql.Identifier(schema.strip()) for schema in value.split(',') if schema.strip()]
+                statement = sql.SQL("SET search_path TO {}").format(sql.SQL(', ').join(schemas))
+            else:
+                statement = sql.SQL("SET {} TO {}").format(sql.SQL(name), sql.Literal(value))
+            cur.execute(statement)
+    
+    # Confirma a transação para que um rollback posterior não desfaça os SETs
+    conn.commit()
+
+
+def connect_to_redshift(config=None, max_attempts=3, wait_time=2, max_wait=60):
     """
     Estabelece conexão com o cluster Redshift com tentativas de reconexão.
     
+    Entre as tentativas, a espera cresce exponencialmente com jitter. Os
+    parâmetros da seção [SESSION] são aplicados na conexão criada. O dialeto
+    SQL ([CLUSTER] DIALECT) define como as queries do Redshift são traduzidas.
+    
     Args:
         config (configparser.ConfigParser, optional): Configuração já carregada
         max_attempts (int): Número máximo de tentativas de conexão
-        wait_time (int): Tempo de espera entre tentativas em segundos
+        wait_time (float): Espera base entre tentativas em segundos
+        max_wait (float): Espera máxima entre tentativas em segundos
         
     Returns:
         tuple: (conexão, cursor) para o banco de dados
@@ -47,9 +151,13 @@ def connect_to_redshift(config=None, max_attempts=3, wait_time=30):
                 dbname=config.get('CLUSTER', 'DB_NAME'),
                 user=config.get('CLUSTER', 'DB_USER'),
                 password=config.get('CLUSTER', 'DB_PASSWORD'),
-                port=config.get('CLUSTER', 'DB_PORT')
+                port=config.get('CLUSTER', 'DB_PORT'),
+                connection_factory=DialectConnection
             )
+            conn.dialect = get_dialect(config)
+            conn.config = config
             conn.autocommit = False  # Controle explícito de transações
+            apply_session_settings(conn, get_session_settings(config))
             cur = conn.cursor()
             print("Conexão estabelecida com sucesso!")
             return conn, cur
@@ -57,18 +165,380 @@ def connect_to_redshift(config=None, max_attempts=3, wait_time=30):
         except psycopg2.OperationalError as e:
             print(f"Tentativa {attempt+1} falhou: {e}")
             if attempt < max_attempts - 1:
-                print(f"Tentando novamente em {wait_time} segundos...")
-                time.sleep(wait_time)
+                delay = get_backoff_delay(attempt, wait_time, max_wait)
+                print(f"Tentando novamente em {delay:.1f} segundos...")
+                time.sleep(delay)
             else:
                 print(f"Todas as {max_attempts} tentativas de conexão falharam.")
                 print("Verifique se o cluster Redshift está disponível e se a configuração está correta.")
                 raise
 
 
+class ConnectionPool:
+    """
+    Pool limitado e thread-safe de conexões com o Redshift.
+    
+    Conexões devolvidas ao pool são reutilizadas, evitando o custo de TLS e
+    autenticação a cada uso. Conexões ociosas há mais de health_check_interval
+    segundos são verificadas com SELECT 1 antes de serem entregues.
+    """
+    
+    def __init__(self, config=None, max_size=8, health_check_interval=60, checkout_timeout=300):
+        """
+        Args:
+            config (configparser.ConfigParser, optional): Configuração já carregada
+            max_size (int): Número máximo de conexões abertas ao mesmo tempo
+            health_check_interval (float): Tempo ocioso em segundos a partir do qual a conexão é verificada
+            checkout_timeout (float): Tempo máximo de espera por uma conexão livre em segundos
+        """
+        self.config = config if config is not None else get_config()
+        self.max_size = max_size
+        self.health_check_interval = health_check_interval
+        self.checkout_timeout = checkout_timeout
+        self._idle = []
+        self._slots = threading.BoundedSemaphore(max_size)
+        self._lock = threading.Lock()
+        self._closed = False
+    
+    def _is_healthy(self, conn, last_used):
+        """
+        Verifica se uma conexão ociosa ainda está utilizável.
+        """
+        if conn.closed:
+            return False
+        if time.time() - last_used < self.health_check_interval:
+            return True
+        
+        try:
+            with conn.cursor() as cur:
+                cur.execute("SELECT 1")
+            conn.rollback()
+            return True
+        except psycopg2.Error:
+            return False
+    
+    @staticmethod
+    def _discard(conn):
+        """
+        Fecha uma conexão sem propagar erros.
+        """
+        try:
+            conn.close()
+        except psycopg2.Error:
+            pass
+    
+    def acquire(self):
+        """
+        Obtém uma conexão do pool, abrindo uma nova se não houver conexão ociosa.
+        
+        Returns:
+            Conexão com o banco de dados
+            
+        Raises:
+            PoolError: Se o pool estiver fechado ou nenhuma conexão ficar livre a tempo
+        """
+        if self._closed:
+            raise PoolError("O pool de conexões está fechado")
+        if not self._slots.acquire(timeout=self.checkout_timeout):
+            raise PoolError(f"Nenhuma conexão livre após {self.checkout_timeout} segundos (max_size={self.max_size})")
+        
+        try:
+            while True:
+                with self._lock:
+                    item = self._idle.pop() if self._idle else None
+                
+                if item is None:
+                    conn, cur = connect_to_redshift(self.config)
+                    cur.close()
+                    return conn
+                
+                conn, last_used = item
+                if self._is_healthy(conn, last_used):
+                    return conn
+                
+                print("Descartando conexão inválida do pool...")
+                self._discard(conn)
+        except Exception:
+            self._slots.release()
+            raise
+    
+    def release(self, conn):
+        """
+        Devolve uma conexão ao pool, desfazendo qualquer transação aberta.
+        
+        Args:
+            conn: Conexão obtida com acquire()
+        """
+        try:
+            if self._closed or conn.closed:
+                self._discard(conn)
+                return
+            
+            try:
+                conn.rollback()
+            except psycopg2.Error:
+                self._discard(conn)
+                return
+            
+            with self._lock:
+                self._idle.append((conn, time.time()))
+        finally:
+            self._slots.release()
+    
+    @contextmanager
+    def connection(self):
+        """
+        Context manager que empresta uma conexão e um cursor do pool.
+        
+        Yields:
+            tuple: (conexão, cursor) para o banco de dados
+        """
+        conn = self.acquire()
+        cur = None
+        try:
+            cur = conn.cursor()
+            yield conn, cur
+        finally:
+            if cur is not None and not cur.closed:
+                try:
+                    cur.close()
+                except psycopg2.Error:
+                    pass
+            self.release(conn)
+    
+    def close(self):
+        """
+        Fecha todas as conexões ociosas e impede novos empréstimos.
+        """
+        self._closed = True
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for conn, _ in idle:
+            self._discard(conn)
+
+
+def get_connection_pool(config=None):
+    """
+    Retorna o pool de conexões compartilhado, criando-o na primeira chamada.
+    
+    O tamanho e a verificação de saúde são lidos da seção [POOL] do dwh.cfg.
+    
+    Args:
+        config (configparser.ConfigParser, optional): Configuração já carregada
+        
+    Returns:
+        ConnectionPool: Pool compartilhado
+    """
+    global _pool
+    
+    with _pool_lock:
+        if _pool is None:
+            if config is None:
+                config = get_config()
+            _pool = ConnectionPool(
+                config,
+                max_size=config.getint('POOL', 'MAX_SIZE', fallback=8),
+                health_check_interval=config.getfloat('POOL', 'HEALTH_CHECK_INTERVAL', fallback=60),
+                checkout_timeout=config.getfloat('POOL', 'CHECKOUT_TIMEOUT', fallback=300)
+            )
+        return _pool
+
+
+def close_connection_pool():
+    """
+    Fecha o pool de conexões compartilhado, se existir.
+    """
+    global _pool
+    
+    with _pool_lock:
+        if _pool is not None:
+            _pool.close()
+            _pool = None
+            print("Pool de conexões fechado.")
+
+
+@contextmanager
+def transaction(conn, name, enabled=True):
+    """
+    Context manager que executa um bloco de statements em uma única transação.
+    
+    Dentro do bloco, execute_query não faz commit após cada statement: o
+    commit é feito uma única vez no final, e qualquer erro desfaz a etapa
+    inteira. Blocos aninhados participam da transação externa.
+    
+    Args:
+        conn: Conexão com o banco de dados
+        name (str): Nome da etapa, usado nos logs e nas métricas
+        enabled (bool): Se False, o bloco roda no modo commit por statement
+    """
+    if not enabled or conn.transaction_batch is not None:
+        yield
+        return
+    
+    conn.transaction_batch = name
+    try:
+        yield
+        
+        start_time = time.time()
+        conn.commit()
+        elapsed_time = time.time() - start_time
+        print(f"Transação {name} confirmada em {elapsed_time:.2f} segundos")
+        metrics.record_statement(None, f"Commit {name}", elapsed_time)
+    
+    except Exception:
+        conn.rollback()
+        print(f"Transação {name} desfeita")
+        raise
+    finally:
+        conn.transaction_batch = None
+
+
+def get_stage_remaining(config):
+    """
+    Retorna quanto resta do timeout da etapa atual ([TIMEOUTS] STAGE_<etapa>).
+    
+    Args:
+        config (configparser.ConfigParser): Configuração já carregada (pode ser None)
+        
+    Returns:
+        float: Segundos restantes (negativo se esgotado), ou None sem timeout de etapa
+    """
+    stage = metrics.get_stage()
+    if config is None or not stage:
+        return None
+    
+    stage_timeout = config.getfloat('TIMEOUTS', f'STAGE_{stage}', fallback=0)
+    return stage_timeout - metrics.get_stage_elapsed() if stage_timeout else None
+
+
+def get_statement_timeout(config, query, query_key=None):
+    """
+    Calcula o timeout de um statement a partir da seção [TIMEOUTS].
+    
+    O timeout vem da chave do statement (tabela de destino de um COPY ou
+    INSERT, ou o nome de uma query analítica) ou, na falta dela, de
+    STATEMENT. Com STAGE_<etapa> definido, fica limitado ao tempo que resta
+    para a etapa atual (veja metrics.set_stage).
+    
+    Args:
+        config (configparser.ConfigParser): Configuração já carregada (pode ser None)
+        query (str): Query SQL
+        query_key (str, optional): Chave do statement; por padrão, a tabela de destino
+        
+    Returns:
+        float: Timeout em segundos, ou None sem timeout
+        
+    Raises:
+        TimeoutError: Se o tempo da etapa atual já se esgotou
+    """
+    if config is None or not config.has_section('TIMEOUTS'):
+        return None
+    
+    if query_key is None:
+        target = STATEMENT_TARGET_PATTERN.search(query)
+        query_key = target.group(1) if target else None
+    
+    timeout = config.getfloat('TIMEOUTS', query_key, fallback=0) if query_key else 0
+    timeout = timeout or config.getfloat('TIMEOUTS', 'STATEMENT', fallback=0)
+    
+    remaining = get_stage_remaining(config)
+    if remaining is not None:
+        if remaining <= 0:
+            raise TimeoutError(f"Etapa {metrics.get_stage()} excedeu seu timeout")
+        timeout = min(timeout, remaining) if timeout else remaining
+    
+    return timeout or None
+
+
+@contextmanager
+def statement_watchdog(conn, timeout, query_desc):
+    """
+    Context manager que cancela o statement em execução quando o timeout expira.
+    
+    Uma thread (threading.Timer) chama conn.cancel() após timeout segundos;
+    o erro de cancelamento é então convertido em TimeoutError.
+    
+    Args:
+        conn: Conexão com o banco de dados
+        timeout (float): Timeout em segundos (None ou 0 desativa o watchdog)
+        query_desc (str): Nome do statement, usado nos logs
+    """
+    if not timeout:
+        yield
+        return
+    
+    fired = threading.Event()
+    
+    def cancel():
+        fired.set()
+        print(f"{query_desc} excedeu {timeout:.0f} segundos; cancelando...")
+        conn.cancel()
+    
+    timer = threading.Timer(timeout, cancel)
+    timer.daemon = True
+    timer.start()
+    try:
+        yield
+    except Exception as e:
+        if fired.is_set():
+            raise TimeoutError(f"{query_desc} cancelada após {timeout:.0f} segundos") from e
+        raise
+    finally:
+        timer.cancel()
+
+
+def retry_transient(conn, query_desc, func):
+    """
+    Executa func(), repetindo-a em erros transitórios.
+    
+    Conflitos de serialização, deadlocks, locks indisponíveis e timeouts são
+    repetidos até [TIMEOUTS] RETRIES vezes, com backoff exponencial a partir
+    de RETRY_WAIT segundos. Não há nova tentativa dentro de uma transação em
+    lote (veja transaction), pois os statements anteriores da etapa já foram
+    desfeitos, nem depois que o timeout da etapa se esgotou.
+    
+    Args:
+        conn: Conexão com o banco de dados
+        query_desc (str): Nome do statement, usado nos logs
+        func (callable): Função sem argumentos que executa o statement
+        
+    Returns:
+        O retorno de func()
+    """
+    config = getattr(conn, 'config', None)
+    retries = config.getint('TIMEOUTS', 'RETRIES', fallback=0) if config is not None else 0
+    retry_wait = config.getfloat('TIMEOUTS', 'RETRY_WAIT', fallback=5) if config is not None else 5
+    
+    for attempt in range(retries + 1):
+        try:
+            return func()
+        except TRANSIENT_ERRORS as e:
+            if attempt >= retries or getattr(conn, 'transaction_batch', None) is not None or conn.closed:
+                raise
+            remaining = get_stage_remaining(config)
+            if remaining is not None and remaining <= 0:
+                raise
+            delay = get_backoff_delay(attempt, retry_wait)
+            print(f"Erro transitório em {query_desc} ({e}); tentativa {attempt + 2}/{retries + 1} em {delay:.1f} segundos")
+            time.sleep(delay)
+
+
 def execute_query(cursor, conn, query, query_name=None):
     """
     Executa uma query SQL com medição de tempo e tratamento de erros.
     
+    Cada execução é registrada no módulo metrics (etapa, nome, tempo e
+    linhas afetadas), com sucesso ou falha.
+    
+    Fora de uma transação (veja transaction), cada statement recebe seu próprio
+    commit. Dentro dela, o commit fica para o final da etapa; no PostgreSQL
+    cada statement roda em um savepoint, para que o erro seja atribuído ao
+    statement que falhou (o Redshift não suporta savepoints).
+    
+    Com a seção [TIMEOUTS], o statement (e seu commit) é cancelado ao
+    exceder seu timeout (veja get_statement_timeout) e erros transitórios
+    são repetidos (veja retry_transient).
+    
     Args:
         cursor: Cursor do banco de dados
         conn: Conexão com o banco de dados
@@ -79,20 +549,95 @@ def execute_query(cursor, conn, query, query_name=None):
         float: Tempo de execução em segundos
     """
     query_desc = query_name or f"Query #{id(query)}"
+    return retry_transient(conn, query_desc, lambda: _execute_once(cursor, conn, query, query_desc))
+
+
+def _execute_once(cursor, conn, query, query_desc):
+    """
+    Executa uma tentativa de execute_query.
+    
+    Returns:
+        float: Tempo de execução em segundos
+    """
     print(f"Executando {query_desc}...")
     
     start_time = time.time()
+    batch = conn.transaction_batch
+    savepoint = batch is not None and conn.dialect != REDSHIFT
     
     try:
-        cursor.execute(query)
-        conn.commit()
+        timeout = get_statement_timeout(getattr(conn, 'config', None), query)
+        with statement_watchdog(conn, timeout, query_desc):
+            if savepoint:
+                cursor.execute("SAVEPOINT execute_query")
+            cursor.execute(query)
+            rows = cursor.rowcount
+            if batch is None:
+                conn.commit()
+            elif savepoint:
+                cursor.execute("RELEASE SAVEPOINT execute_query")
         
         elapsed_time = time.time() - start_time
         print(f"{query_desc} concluída em {elapsed_time:.2f} segundos")
+        metrics.record_statement(cursor, query_desc, elapsed_time, rows, query=query)
         
         return elapsed_time
     
     except Exception as e:
         print(f"Erro ao executar {query_desc}: {e}")
-        conn.rollback()
-        raise 
\ No newline at end of file
+        if savepoint:
+            print(f"Erro dentro da transação {batch}; desfazendo até o savepoint de {query_desc}")
+            cursor.execute("ROLLBACK TO SAVEPOINT execute_query")
+        else:
+            conn.rollback()
+        metrics.record_statement(None, query_desc, time.time() - start_time, success=False)
+        raise
+
+
+def format_query_results(cursor, rows, query_name):
+    """
+    Formata o resultado de uma query como tabela de texto.
+    
+    Args:
+        cursor: Cursor usado na execução da query
+        rows (list): Linhas retornadas pela query
+        query_name (str): Nome da query usado no título
+        
+    Returns:
+        str: Resultado formatado
+    """
+    columns = [column[0] for column in cursor.description]
+    return format_result_table(columns, rows, query_name)
+
+
+def format_result_table(columns, rows, query_name):
+    """
+    Formata colunas e linhas já obtidas como tabela de texto.
+    
+    Args:
+        columns (list): Nomes das colunas
+        rows (list): Linhas do resultado
+        query_name (str): Nome da query usado no título
+        
+    Returns:
+        str: Resultado formatado
+    """
+    if not rows:
+        return f"\n=== {query_name} ===\n(sem resultados)"
+    
+    table = pd.DataFrame(rows, columns=columns).to_string(index=False)
+    return f"\n=== {query_name} ===\n{table}"
+
+
+def format_row(row, separator=" | "):
+    """
+    Formata uma linha de resultado como texto delimitado.
+    
+    Args:
+        row (tuple): Linha retornada pela query
+        separator (str): Separador entre colunas
+        
+    Returns:
+        str: Linha formatada
+    """
+    return separator.join("" if value is None else str(value) for value in row)